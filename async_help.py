@@ -0,0 +1,118 @@
+# async_help.py
+# The asyncio runtime for pizero_mqtt_monitor.py, chosen with -a or runtime: mode: asyncio in the
+# config. One event loop thread does the work of apscheduler's thread pool and paho's loop_start
+# network thread:
+#   - AsyncioMqtt drives the paho client's socket from the loop, through paho's external event
+#     loop callbacks (on_socket_open, on_socket_register_write, ...).
+#   - periodic() runs a polling job as a coroutine on a fixed grid of loop.time() ticks, so the
+#     interval does not drift by the job's own run time. Ticks missed while the loop was busy are
+#     skipped and counted, not run in a burst.
+#   - to_loop() wraps a gpiozero state change callback so it runs on the loop instead of on
+#     pigpio's callback thread.
+# pigpio's and gpiozero's own threads, and the worker threads of the helpers, are still there.
+#
+import asyncio
+import random
+import threading
+import paho.mqtt.client as mqtt
+
+
+def to_loop(loop, fn):
+    # fn, called on loop from whichever thread calls the wrapper.
+    def bridged(*args):
+        loop.call_soon_threadsafe(fn, *args)
+    return bridged
+
+
+async def periodic(fn, interval: float, name: str = None, on_missed=None, on_error=None,
+                   phase: float = None) -> None:
+    # Calls fn every interval seconds, the first call phase seconds from now, by default interval
+    # as apscheduler does. on_missed(name, n) is told of ticks skipped, on_error(name, error) of
+    # exceptions from fn.
+    loop = asyncio.get_running_loop()
+    start = loop.time() + (interval if phase is None else phase)
+    tick = 0
+    while True:
+        await asyncio.sleep(max(0.0, start + tick * interval - loop.time()))
+        try:
+            fn()
+        except Exception as error:
+            if on_error is not None:
+                on_error(name, error)
+        nxt = int((loop.time() - start) // interval) + 1
+        if nxt - tick > 1 and on_missed is not None:
+            on_missed(name, nxt - tick - 1)
+        tick = nxt
+
+
+class AsyncioMqtt:
+    # Runs a paho client's network I/O on loop. paho calls the socket callbacks from the thread
+    # that is in it at the time, ie the publish-queue worker when it publishes, so they are passed
+    # to the loop thread. Lost connections are retried with full jitter back-off.
+
+    def __init__(self, client, loop, base_delay: float = 0.5, max_delay: float = 60.0) -> None:
+        self.client = client
+        self.loop = loop
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.reconnects = 0
+        self.last_error = None
+        self._misc = None
+        self._loop_thread = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _call(self, fn, *args) -> None:
+        if threading.get_ident() == self._loop_thread:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    def on_socket_open(self, client, userdata, sock) -> None:
+        self._call(self.loop.add_reader, sock.fileno(), client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock) -> None:
+        self._call(self.loop.remove_reader, sock.fileno())
+
+    def on_socket_register_write(self, client, userdata, sock) -> None:
+        self._call(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock) -> None:
+        self._call(self.loop.remove_writer, sock.fileno())
+
+    def connect(self, host: str, port: int = 1883, keepalive: int = 60) -> None:
+        # Safe from any thread, ie as BrokerLink's on_reachable.
+        self.loop.call_soon_threadsafe(self._connect, host, port, keepalive)
+
+    def _connect(self, host: str, port: int, keepalive: int) -> None:
+        self._loop_thread = threading.get_ident()
+        try:
+            self.client.connect(host=host, port=port, keepalive=keepalive)
+        except OSError as error:
+            # misc() retries through client.reconnect()
+            self.last_error = error
+        if self._misc is None:
+            self._misc = self.loop.create_task(self.misc())
+
+    async def misc(self) -> None:
+        # paho's housekeeping (keepalive pings, retries) once a second, and reconnecting.
+        failed = 0
+        while True:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                await asyncio.sleep(random.uniform(0.0, min(self.max_delay, self.base_delay * (2 ** failed))))
+                failed += 1
+                try:
+                    self.client.reconnect()
+                    self.reconnects += 1
+                    failed = 0
+                except OSError as error:
+                    self.last_error = error
+                continue
+            await asyncio.sleep(1.0)
+
+    def disconnect(self) -> None:
+        if self._misc is not None:
+            self._misc.cancel()
+        self.client.disconnect()
@@ -0,0 +1,622 @@
+# bench_help.py
+# Benchmarks for the pizero_mqtt_monitor.py helpers. Run on the Pi Zero itself for numbers that mean
+# anything, e.g.
+#   python3 bench_help.py wifi -n 50
+#   python3 bench_help.py batch -n 1000
+# The e2e benchmark runs the whole monitor in simulation (see sim_help.py) so it also runs off a Pi,
+#   python3 bench_help.py e2e -n 200
+# The light benchmark runs the LDR sampler on a synthetic flickering light, n seconds per rate,
+#   python3 bench_help.py light -n 10
+# and the runtime benchmark compares the threads and asyncio runtimes of the monitor in simulation,
+#   python3 bench_help.py runtime -n 60
+# The mqtt benchmark compares MQTT 3.1.1 at qos 0 with MQTT 5 (topic aliases, message expiry, the
+# qos policy) publishing n poll cycles to a SimBroker,
+#   python3 bench_help.py mqtt -n 200
+# The door benchmark times door events through the old Button path and sens_help.EdgeCapture while
+# the publishing side lags behind, n toggles of a bouncing mock contact,
+#   python3 bench_help.py door -n 20
+# The governor benchmark runs gov_help.ThermalGovernor through n evaluations of a simulated hot,
+# busy afternoon (a fake thermal file, load average and publish backlog) and checks how it retimed
+# the jobs,
+#   python3 bench_help.py governor -n 24
+# The payload benchmark compares the precompiled payload templates with json.dumps(default=str)
+# over n poll cycles, after checking they write the same bytes,
+#   python3 bench_help.py payload -n 20000
+#
+import argparse
+import datetime
+import json
+import math
+import os
+import subprocess
+import sys
+import threading
+import time
+import metrics_help
+import net_help
+import pub_help
+import sens_help
+import sched_help
+
+
+def timed_calls(fn, n: int) -> dict:
+    # Wall time, this process's CPU time and child process CPU time per call, in milliseconds.
+    t0 = os.times()
+    w0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    w1 = time.perf_counter()
+    t1 = os.times()
+    return {
+        'wall_ms': (w1 - w0) * 1000.0 / n,
+        'cpu_ms': ((t1.user - t0.user) + (t1.system - t0.system)) * 1000.0 / n,
+        'child_cpu_ms': ((t1.children_user - t0.children_user) +
+                         (t1.children_system - t0.children_system)) * 1000.0 / n,
+    }
+
+
+def print_rows(title: str, rows: list) -> None:
+    print(f'\n{title}')
+    if not rows:
+        return
+    cols = list(rows[0])
+    print('  '.join(f'{c:>14}' for c in cols))
+    for row in rows:
+        print('  '.join(f'{row[c]:>14.3f}' if isinstance(row[c], float) else f'{row[c]:>14}' for c in cols))
+
+
+def bench_wifi(n: int, interface: str = 'wlan0') -> list:
+    # Compares the WiFi stats backends with the old iw subprocess pipelines.
+    rows = []
+    for name in ('netlink', 'proc', 'iw', 'fake'):
+        try:
+            provider = net_help.wifi_backends[name](interface)
+            sample = provider.read()
+        except Exception as error:
+            print(f'{name}: not available here ({error})')
+            continue
+        row = {'backend': name}
+        row.update(timed_calls(provider.read, n))
+        row['reading'] = f'{sample.signal_dbm}/{sample.connected_s}'
+        rows.append(row)
+        provider.close()
+    print_rows(f'WiFi stats read, {n} calls each', rows)
+    return rows
+
+
+def mqtt_publish_size(topic: str, payload) -> int:
+    # Bytes of a qos 0 MQTT 3.1.1 PUBLISH packet: fixed header, remaining length, topic, payload.
+    remaining = 2 + len(topic.encode()) + len(payload if isinstance(payload, bytes) else payload.encode())
+    length_bytes = 1
+    while remaining >= 128 ** length_bytes:
+        length_bytes += 1
+    return 1 + length_bytes + remaining
+
+
+# A poll cycle's worth of readings, as the default config publishes them.
+sample_client_id = 'raspberrypi-z01'
+sample_prefix = 'rpiz01/garage/'
+sample_readings = [
+    ('temperature', {"temperature": '71.6'}, {"temp_unit": "F"}, True),
+    ('garage_dr', {"garage_dr": "closed"}, {}, True),
+    ('pir_a_activity', {"motion": 0.0, "detected": False}, {}, True),
+    ('pir_b_activity', {"motion": 1.0, "detected": True}, {}, True),
+    ('lightsensed', {"light_sensed_state": True, "light_sensed_value": 0.4183}, {}, True),
+    ('cpu_temperature', {"cpu_temp_c": 47.236, "cpu_hot": False}, {}, True),
+    ('wifi', {"iw_dbm": -58, "iw_ctm": 123456}, {}, True),
+    ('device_ip', {"device_ip": "192.168.1.57"}, {}, False),
+]
+
+
+def per_topic_cycle() -> list:
+    # The payloads of one cycle, published on their own topics.
+    pkts = []
+    for topic, values, static, with_client_id in sample_readings:
+        pld = {"time": datetime.datetime.now()}
+        if with_client_id:
+            pld["client_id"] = sample_client_id
+        pld.update(values)
+        pld.update(static)
+        pkts.append((sample_prefix + topic, json.dumps(pld, default=str)))
+    return pkts
+
+
+def bench_batch(n: int) -> list:
+    # Bytes on air and publish CPU time per poll cycle, per topic vs. one batched payload.
+    rows = []
+    pkts = per_topic_cycle()
+    row = {'mode': 'per-topic json', 'publishes': len(pkts),
+           'bytes': sum(mqtt_publish_size(t, p) for t, p in pkts)}
+    row['cpu_us'] = timed_calls(per_topic_cycle, n)['cpu_ms'] * 1000.0
+    rows.append(row)
+    for encoding in ('json', 'cbor', 'msgpack'):
+        sent = []
+        try:
+            batcher = pub_help.BatchPublisher(lambda **k: sent.append(k), sample_prefix + 'state',
+                                              sample_client_id, encoding=encoding)
+        except ValueError as error:
+            print(f'{encoding}: not available here ({error})')
+            continue
+
+        def cycle():
+            for topic, values, _, _ in sample_readings:
+                batcher.add(topic, values)
+            batcher.flush()
+
+        cycle()
+        row = {'mode': f'batched {encoding}', 'publishes': 1,
+               'bytes': mqtt_publish_size(sent[-1]['topic'], sent[-1]['payload'])}
+        row['cpu_us'] = timed_calls(cycle, n)['cpu_ms'] * 1000.0
+        rows.append(row)
+    print_rows(f'One poll cycle of {len(sample_readings)} readings, CPU averaged over {n} cycles', rows)
+    return rows
+
+
+def bench_light(seconds: int, rates=(10, 50, 200)) -> list:
+    # The LightSampler's thread CPU, ring memory and summary() time at each sample rate, on a
+    # 100 Hz flicker over a slow swell, read without touching a pin.
+    rows = []
+    for rate in rates:
+        t0 = time.monotonic()
+        sampler = sens_help.LightSampler(lambda: 0.3 + 0.2 * math.sin((time.monotonic() - t0) / 3.0) +
+                                         0.05 * math.sin((time.monotonic() - t0) * 628.3),
+                                         rate=rate, capacity=int(rate * seconds * 1.25))
+        sampler.start()
+        time.sleep(seconds)
+        w0 = time.perf_counter()
+        summary = sampler.summary()
+        summary_ms = (time.perf_counter() - w0) * 1000.0
+        sampler.stop()
+        rows.append({'rate_hz': rate,
+                     'samples': summary['light_samples'],
+                     'cpu_pct': summary['sampler_cpu_pct'],
+                     'ring_bytes': sampler.ring.itemsize * sampler.capacity,
+                     'summary_ms': summary_ms,
+                     'transitions': summary['transitions']})
+    print_rows(f'LDR sampling for {seconds} s per rate', rows)
+    return rows
+
+
+def bench_e2e(n: int, gap: float = 0.05, config_file: str = None) -> list:
+    # The monitor run in simulation in this process. The door pin is toggled n times, gap seconds
+    # apart, and each toggle is timed from the pin drive to the door publish reaching the SimBroker.
+    # Also measured, the publishes per second the broker saw and the CPU time and memory per publish.
+    import pizero_mqtt_monitor as mon
+    import sens_registry
+
+    if config_file is None and os.path.exists(mon.df_config_file):
+        config_file = mon.df_config_file
+    cfg = sens_registry.load_config(config_file)
+    cfg['simulate']['enabled'] = True
+    cfg['runtime']['mode'] = 'threads'
+    cfg['simulate']['waves'] = []
+    cfg['simulate']['events'] = []
+    cfg['metrics']['http_port'] = 0
+    door = next(s for s in cfg['sensors'] if s['type'] == 'door')
+    door['bounce_time'] = None
+    door['capture'] = False
+    mon.cfg = cfg
+    mon.simulation_setups()
+    mon.monitor_setups()
+    mon.pin_factory_setups()
+    sim = mon.simulation
+    door_topic = cfg['device']['topic_prefix'] + door['topic']
+    rss0 = metrics_help.proc_status()['rss_kb']
+    mon.pub_queue.start()
+    mon.broker_link.start()
+    mon.device_setups()
+    threading.Thread(target=mon.monitor_schedule.start, name='bench-scheduler', daemon=True).start()
+    rows = []
+    try:
+        if not sim.broker.wait_for(lambda rx: any(t == door_topic for _, t, _, _, _ in rx), timeout=30.0):
+            print('e2e: the monitor did not reach the simulated broker')
+            return rows
+        level = not mon.registry.get(door['name']).device.is_active
+        latencies = []
+        p0 = sim.broker.publishes_in
+        b0 = sim.broker.bytes_in
+        c0 = time.process_time()
+        w0 = time.perf_counter()
+        for _ in range(n):
+            seen = sum(1 for _, t, _, _, _ in sim.broker.received if t == door_topic)
+            sim.script.drive(door['pin'], level)
+            driven_ns = sim.script.log[-1][0]
+            level = not level
+            if sim.broker.wait_for(lambda rx: sum(1 for _, t, _, _, _ in rx if t == door_topic) > seen, timeout=2.0):
+                rx_ns = [r[0] for r in sim.broker.received if r[1] == door_topic][seen]
+                latencies.append((rx_ns - driven_ns) / 1e6)
+            time.sleep(gap)
+        wall = time.perf_counter() - w0
+        cpu = time.process_time() - c0
+        publishes = sim.broker.publishes_in - p0
+        rss = metrics_help.proc_status()['rss_kb']
+        rows.append({
+            'toggles': n,
+            'published': len(latencies),
+            'events_s': publishes / wall,
+            'lat_p50_ms': sched_help.percentile(sorted(latencies), 50),
+            'lat_p95_ms': sched_help.percentile(sorted(latencies), 95),
+            'lat_max_ms': max(latencies, default=0.0),
+            'cpu_us_pub': cpu * 1e6 / publishes if publishes else 0.0,
+            'bytes_pub': (sim.broker.bytes_in - b0) / publishes if publishes else 0.0,
+            'rss_kb': rss,
+            'rss_grow_kb': rss - rss0,
+        })
+    finally:
+        mon.monitor_schedule.shutdown(wait=False)
+        mon.registry.close()
+        mon.pub_queue.close()
+        mon.mqttc.loop_stop()
+        sim.stop()
+    print_rows(f'End to end in simulation, door toggled {n} times {gap} s apart', rows)
+    return rows
+
+
+def bench_runtime(seconds: int, config_file: str = None) -> list:
+    # Threads, resident memory and CPU time of the monitor running in simulation for seconds, in
+    # each runtime. Each is its own process, sampled from /proc once a second.
+    monitor = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pizero_mqtt_monitor.py')
+    rows = []
+    for mode, flags in (('threads', []), ('asyncio', ['-a'])):
+        cmd = [sys.executable, monitor, '-s'] + flags + (['-c', config_file] if config_file else [])
+        t0 = os.times()
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        samples = []
+        for _ in range(seconds):
+            time.sleep(1.0)
+            if proc.poll() is not None:
+                break
+            samples.append(metrics_help.proc_status(proc.pid))
+        proc.terminate()
+        proc.wait()
+        t1 = os.times()
+        if not samples:
+            print(f'{mode}: the monitor exited with {proc.returncode}')
+            continue
+        rows.append({
+            'runtime': mode,
+            'seconds': len(samples),
+            'threads_max': max(s['threads'] for s in samples),
+            'rss_kb_last': samples[-1]['rss_kb'],
+            'rss_kb_max': max(s['rss_kb'] for s in samples),
+            'cpu_ms_s': ((t1.children_user - t0.children_user) +
+                         (t1.children_system - t0.children_system)) * 1000.0 / len(samples),
+        })
+    print_rows(f'The monitor in simulation for {seconds} s, per runtime', rows)
+    return rows
+
+
+def bench_mqtt(n: int, gap: float = 0.01, config_file: str = None) -> list:
+    # n poll cycles of readings published through a PublishQueue to a SimBroker, gap seconds
+    # apart, per client set up: protocol, publish policy (None is qos 0 everywhere, the old path),
+    # max_inflight (if1 is 1) and TCP_NODELAY (nd). Bytes are the PUBLISH packets the broker read, latency is from
+    # PublishQueue.publish to the broker having the packet, qos_unacked the qos 1 and 2 publishes
+    # still unacknowledged a second after the last.
+    import paho.mqtt.client as mqtt
+    import sens_registry
+    import sim_help
+
+    mqtt_cfg = sens_registry.load_config(config_file)['mqtt']
+    policy = mqtt_cfg['policy']
+    inflight = mqtt_cfg['max_inflight']
+    setups = [
+        ('3.1.1 qos 0', False, None, inflight, False),
+        ('3.1.1 policy', False, policy, inflight, False),
+        ('3.1.1 policy nd', False, policy, inflight, True),
+        ('5 aliases nd', True, {'qos': 0, 'expiry': 0}, inflight, True),
+        ('5 policy nd', True, policy, inflight, True),
+        ('5 policy nd if1', True, policy, 1, True),
+    ]
+    broker = sim_help.SimBroker()
+    broker.start()
+    rows = []
+    try:
+        for name, v5, pol, max_inflight, no_delay in setups:
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f'bench-{len(rows)}',
+                                 protocol=mqtt.MQTTv5 if v5 else mqtt.MQTTv311)
+            client.max_inflight_messages_set(max_inflight)
+            queue = pub_help.PublishQueue(client)
+            rules = pub_help.PublishPolicy(pol, sample_prefix)
+            if v5:
+                queue.properties = pub_help.PublishProperties(rules.expiry)
+            # on_publish is called once a qos 0 message is written, a qos 1 or 2 one acknowledged
+            done = []
+            connected = threading.Event()
+
+            def on_connect(client, userdata, flags, reason_code, properties,
+                           queue=queue, connected=connected, no_delay=no_delay):
+                if no_delay:
+                    net_help.tcp_no_delay(client)
+                queue.on_connect(properties)
+                connected.set()
+
+            client.on_connect = on_connect
+            client.on_publish = lambda client, userdata, mid, reason_code, properties, done=done: done.append(mid)
+            client.connect(broker.host, broker.port)
+            client.loop_start()
+            if not connected.wait(5.0):
+                print(f'{name}: no connection to the simulated broker')
+                continue
+            sent_ns = []
+            n_qos = 0
+            p0 = broker.publishes_in
+            b0 = broker.bytes_in
+            for _ in range(n):
+                for topic, payload in per_topic_cycle():
+                    qos = rules.qos(topic) if pol else 0
+                    n_qos += bool(qos)
+                    sent_ns.append(time.monotonic_ns())
+                    queue.publish(topic, payload, retain=True, qos=qos)
+                time.sleep(gap)
+            broker.wait_for(lambda rx: broker.publishes_in - p0 >= len(sent_ns), timeout=10.0)
+            time.sleep(1.0)
+            publishes = broker.publishes_in - p0
+            received = list(broker.received)[-publishes:] if publishes else []
+            latencies = sorted((rx[0] - tx) / 1e6 for rx, tx in zip(received, sent_ns))
+            rows.append({
+                'setup': name,
+                'publishes': publishes,
+                'bytes_cycle': (broker.bytes_in - b0) / n,
+                'bytes_pub': (broker.bytes_in - b0) / publishes if publishes else 0.0,
+                'lat_p50_ms': sched_help.percentile(latencies, 50),
+                'lat_p95_ms': sched_help.percentile(latencies, 95),
+                'lat_max_ms': latencies[-1] if latencies else 0.0,
+                'qos_unacked': len(sent_ns) - len(done),
+            })
+            client.disconnect()
+            client.loop_stop()
+            queue.close()
+    finally:
+        broker.stop()
+    print_rows(f'{n} poll cycles of {len(sample_readings)} readings, {gap} s apart', rows)
+    return rows
+
+
+def bench_door(n: int, gap: float = 0.2, delay: float = 0.3, bounces: int = 3, settle: float = 0.05) -> list:
+    # n door toggles gap seconds apart, each followed by bounces contact bounces, while whatever
+    # publishes the events takes delay seconds over each (a busy publish thread). The old path, a
+    # Button with bounce_time (its bounces taken out as pigpio's glitch filter would), reads the
+    # state and the time when the callback gets to run; EdgeCapture has both from the edge ticks.
+    # Compared are the errors of the event times and the events with the wrong state.
+    import queue
+    import sim_help
+    from gpiozero import Button
+
+    rows = []
+    for name in ('button', 'capture'):
+        factory = sim_help.mock_factory()
+        script = sim_help.PinScript(factory)
+        button = Button(27, pull_up=None, active_state=True, bounce_time=None, pin_factory=factory)
+        pending = queue.Queue()
+        events = []
+
+        if name == 'button':
+            def publish_side():
+                while pending.get() is not None:
+                    time.sleep(delay)
+                    events.append((time.time(), button.is_active))
+
+            button.when_activated = lambda: pending.put(1)
+            button.when_deactivated = lambda: pending.put(1)
+            capture = None
+        else:
+            def publish_side():
+                while pending.get() is not None:
+                    time.sleep(delay)
+                    events.extend((e["time"], e["level"]) for e in capture.take())
+
+            capture = sens_help.EdgeCapture(button.pin, settle=settle, on_event=lambda level: pending.put(1))
+            capture.start()
+        worker = threading.Thread(target=publish_side, name='bench-publish', daemon=True)
+        worker.start()
+        driven = []
+        level = not button.pin.state
+        for _ in range(n):
+            driven.append((time.time(), level))
+            script.drive(27, level)
+            if capture is not None:
+                script.bounce(27, level, bounces, 0.002)
+            level = not level
+            time.sleep(gap)
+        time.sleep(settle)
+        pending.put(None)
+        worker.join(timeout=n * delay + 5.0)
+        errors = sorted(abs(at - driven_at) * 1000.0 for (at, _), (driven_at, _) in zip(events, driven))
+        rows.append({'path': name,
+                     'toggles': n,
+                     'events': len(events),
+                     'wrong_state': sum(1 for (_, lv), (_, dlv) in zip(events, driven) if lv != dlv),
+                     'time_err_p50_ms': sched_help.percentile(errors, 50),
+                     'time_err_max_ms': errors[-1] if errors else 0.0,
+                     'bounces': capture.report()['bounces'] if capture is not None else 0})
+        if capture is not None:
+            capture.stop()
+        button.close()
+    print_rows(f'Door, {n} toggles {gap} s apart, {delay} s to publish each event', rows)
+    return rows
+
+
+def bench_governor(n: int) -> list:
+    # n governor evaluations over a simulated afternoon: the CPU warms from 60 to 84 °C and back,
+    # the load average climbs in the middle third and the broker drops out near the end, backing
+    # up the publish queue. The intervals it sets for a job of each tier and the door are shown,
+    # then checked: the first tier stretches at least as far as the second at every step, the door
+    # and PIR intervals never change, stretches stay within 1 and max_stretch, every interval is its
+    # base times its tier's stretch, and a stretch only comes down cool_down evaluations after its
+    # last change. An AssertionError lists what failed.
+    import sim_help
+    import gov_help
+    from gpiozero import Device
+
+    if Device.pin_factory is None:
+        Device.pin_factory = sim_help.mock_factory()
+    sysfs = sim_help.FakeSysfs()
+    cpu = sens_help.CPUTempState(sensor_file=sysfs.thermal_file, threshold=80.0)
+    step = {'load': 0.0, 'backlog': 0}
+    intervals = {'wifi': 60, 'device_ip': 300, 'temperature': 60, 'garage_dr': 60, 'pir_a': 1}
+    bases = dict(intervals)
+    published = []
+    gov = gov_help.ThermalGovernor(cpu,
+                                   backlog=lambda: step['backlog'],
+                                   reschedule=lambda job_id, seconds: intervals.__setitem__(job_id, seconds),
+                                   publish=lambda topic, payload, retain, qos: published.append(payload),
+                                   topic='rpiz01/garage/governor',
+                                   client_id='bench',
+                                   tiers=[['wifi', 'device_ip'], ['temperature', 'lightsensed']],
+                                   cool_down=2,
+                                   read_load=lambda: step['load'],
+                                   log=lambda msg: None)
+    for job_id, seconds in intervals.items():
+        gov.add(job_id, seconds)
+    rows = []
+    stretches = []
+    c0 = time.process_time()
+    try:
+        for i in range(n):
+            x = i / max(1, n - 1)
+            sim_help.write_thermal(sysfs.thermal_file, 60.0 + 24.0 * math.sin(math.pi * x))
+            step['load'] = 2.2 if 1 / 3 <= x < 2 / 3 else 0.4
+            step['backlog'] = 120 if 0.75 <= x < 0.9 else 0
+            n_pub = len(published)
+            gov.evaluate()
+            stretches.append(list(gov.stretch))
+            rd = gov.last
+            rows.append({'step': i,
+                         'cpu_temp_c': rd['cpu_temp_c'],
+                         'load': rd['load'],
+                         'backlog': rd['backlog'],
+                         'pressure': rd['pressure'],
+                         'wifi_s': float(intervals['wifi']),
+                         'device_ip_s': float(intervals['device_ip']),
+                         'temperature_s': float(intervals['temperature']),
+                         'garage_dr_s': float(intervals['garage_dr']),
+                         'published': len(published) - n_pub})
+    finally:
+        cpu.cpu_temp.close()
+        sysfs.close()
+    cpu_ms = (time.process_time() - c0) * 1000.0 / n
+    print_rows(f'Governor over {n} evaluations, {len(published)} adjustments published, '
+               f'{cpu_ms:.3f} ms CPU an evaluation', rows)
+    problems = []
+    last_change = [0] * len(gov.tiers)
+    prev = [1.0] * len(gov.tiers)
+    for i, stretch in enumerate(stretches):
+        if stretch[0] < stretch[1]:
+            problems.append(f'step {i}: tier 1 stretched {stretch[1]} past tier 0 {stretch[0]}')
+        for k, value in enumerate(stretch):
+            if not 1.0 <= value <= gov.max_stretch:
+                problems.append(f'step {i}: tier {k} stretch {value} outside 1 to {gov.max_stretch}')
+            if value < prev[k] and i + 1 - last_change[k] < gov.cool_down:
+                problems.append(f'step {i}: tier {k} came down {i + 1 - last_change[k]} evaluations after '
+                                f'its last change, cool_down is {gov.cool_down}')
+            if value != prev[k]:
+                last_change[k] = i + 1
+        prev = stretch
+    for row, stretch in zip(rows, stretches):
+        for job_id, k in (('wifi', 0), ('device_ip', 0), ('temperature', 1)):
+            if row[job_id + '_s'] != bases[job_id] * stretch[k]:
+                problems.append(f"step {row['step']}: {job_id} at {row[job_id + '_s']} s, not "
+                                f'{bases[job_id]} x {stretch[k]}')
+    for job_id in ('garage_dr', 'pir_a'):
+        if intervals[job_id] != bases[job_id]:
+            problems.append(f'{job_id} retimed to {intervals[job_id]} s')
+    if n >= 12:
+        # the afternoon is long enough to stretch both tiers and bring them back down
+        if max(s[1] for s in stretches) <= 1.0:
+            problems.append('tier 1 never stretched')
+        if not any(b[0] < a[0] for a, b in zip(stretches, stretches[1:])):
+            problems.append('tier 0 never came down')
+    if problems:
+        raise AssertionError('Governor checks failed:\n  ' + '\n  '.join(problems))
+    print(f'Governor checks passed over {n} evaluations')
+    return rows
+
+
+def bench_payload(n: int) -> list:
+    # The reading payloads of n poll cycles, built as they were (a dict, datetime.datetime.now() and
+    # json.dumps(default=str)) and from pub_help.PayloadTemplate with a pub_help.Timestamps time.
+    # First checked: the same bytes for the sample readings and some awkward ones, and the same
+    # time text as str(datetime) over whole seconds, rounding up to the next second and the rest.
+    readings = sample_readings + [
+        ('garage_dr', {"garage_dr": "open", "bounces": 6, "settle_ms": 13.07, "closed_s": 15.0,
+                       "latency_ms": 264.3}, {}, True),
+        ('lightsensed', {"light_sensed_state": False, "light_min": 0.0, "transitions": 2,
+                         "transition_times": [["2024-06-01 10:00:00.5", True]], "light_now": None}, {}, True),
+        ('odd', {"nan": float('nan'), "inf": float('-inf'), "text": 'tab\tquote" é', "big": 2 ** 70,
+                 "taken": datetime.datetime(2024, 6, 1, 10, 0, 0)}, {"unit": "°F"}, True),
+        ('clash', {"temp_unit": "C", "time": 0}, {"temp_unit": "F"}, True),
+    ]
+    templates = [pub_help.PayloadTemplate(sample_client_id if with_client_id else None, static)
+                 for _, _, static, with_client_id in readings]
+    mismatches = 0
+    for dt in (datetime.datetime(2024, 6, 1, 10, 0, 0), datetime.datetime(2024, 6, 1, 10, 0, 0, 250)):
+        for (_, values, static, with_client_id), template in zip(readings, templates):
+            pld = {"time": dt}
+            if with_client_id:
+                pld["client_id"] = sample_client_id
+            pld.update(values)
+            pld.update(static)
+            mismatches += json.dumps(pld, default=str) != template.render(values, str(dt))
+    clock = pub_help.Timestamps()
+    base = float(int(time.time()))
+    times = [base, base + 0.5, base + 0.9999996, base + 0.0000004, base + 1e-6] + \
+            [base + i * 0.0123457 for i in range(20000)]
+    time_mismatches = sum(clock.text(t) != str(datetime.datetime.fromtimestamp(t)) for t in times)
+
+    def dumps_cycle():
+        for topic, values, static, with_client_id in sample_readings:
+            pld = {"time": datetime.datetime.now()}
+            if with_client_id:
+                pld["client_id"] = sample_client_id
+            pld.update(values)
+            pld.update(static)
+            json.dumps(pld, default=str)
+
+    cycle_templates = templates[:len(sample_readings)]
+
+    def template_cycle():
+        for (topic, values, static, with_client_id), template in zip(sample_readings, cycle_templates):
+            template.render(values, clock.now())
+
+    rows = []
+    for name, fn in (('json.dumps', dumps_cycle), ('template', template_cycle)):
+        fn()
+        row = timed_calls(fn, n)
+        rows.append({'path': name,
+                     'us_reading': row['cpu_ms'] * 1000.0 / len(sample_readings),
+                     'payload_mismatches': mismatches if name == 'template' else 0,
+                     'time_mismatches': time_mismatches if name == 'template' else 0})
+    print_rows(f'Reading payloads, CPU averaged over {n} cycles of {len(sample_readings)}, '
+               f'{len(readings) * 2} payloads and {len(times)} times checked', rows)
+    return rows
+
+
+def main():
+    prsr = argparse.ArgumentParser(description='Benchmark the monitor helpers.')
+    prsr.add_argument('bench', choices=['wifi', 'batch', 'light', 'e2e', 'runtime', 'mqtt', 'door', 'governor', 'payload'], help='Which benchmark to run.')
+    prsr.add_argument('-n', type=int, default=20, help='Iterations, seconds for light and runtime.')
+    prsr.add_argument('-i', default='wlan0', help='WiFi interface name.')
+    prsr.add_argument('-c', metavar='CONFIG', default=None, help='Monitor config file for e2e, runtime and mqtt.')
+    args = prsr.parse_args()
+    if args.bench == 'wifi':
+        bench_wifi(args.n, args.i)
+    elif args.bench == 'batch':
+        bench_batch(args.n)
+    elif args.bench == 'light':
+        bench_light(args.n)
+    elif args.bench == 'e2e':
+        bench_e2e(args.n, config_file=args.c)
+    elif args.bench == 'runtime':
+        bench_runtime(args.n, config_file=args.c)
+    elif args.bench == 'mqtt':
+        bench_mqtt(args.n, config_file=args.c)
+    elif args.bench == 'door':
+        bench_door(args.n)
+    elif args.bench == 'governor':
+        bench_governor(args.n)
+    elif args.bench == 'payload':
+        bench_payload(args.n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+# cmd_help.py
+# The command topic of pizero_mqtt_monitor.py, for changing the running monitor without editing the
+# config and restarting it (which also restarts the PIR warm-up). Commands are JSON sent to
+# <prefix>cmd, ie
+#   {"id": "c1", "cmd": "set_interval", "sensor": "wifi", "seconds": 300}
+#   {"id": "c2", "cmd": "set_deadband", "sensor": "temperature", "field": "temperature", "value": 0.5}
+#   {"id": "c3", "cmd": "set_threshold", "sensor": "pir_a", "value": 0.6}
+#   {"id": "c4", "cmd": "read_now", "sensor": "garage_dr"}     (every sensor without sensor)
+#   {"id": "c5", "cmd": "debug", "on": true}
+#   {"id": "c6", "cmd": "get", "sensor": "wifi"}               (every sensor without sensor)
+# and each is answered on <prefix>cmd/ack with
+#   {"time": ..., "client_id": ..., "id": "c1", "cmd": "set_interval", "ok": true, "result": {...}}
+# or "ok": false and an "error". Changes last until the monitor restarts.
+#
+# Commands are run one at a time by a worker thread, never on the paho network thread. A token
+# bucket (rate commands a second, bursts of up to burst) limits how many are taken, and at most
+# max_queue wait; the rest are dropped, with at most one "rate limited" ack a second saying how
+# many. So a flood of commands costs the sensor jobs little more than the parsing. A command that
+# fails for any reason is acked as failed and the worker goes on to the next.
+#
+import datetime
+import json
+import math
+import queue
+import threading
+import time
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(float(self.burst), self.tokens + (now - self._at) * self.rate)
+            self._at = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+
+
+class CommandChannel:
+    # registry is the monitor's SensorRegistry and publish its publish(topic, payload, retain,
+    # qos). reschedule(job id, seconds) applies a new poll interval to the running scheduler and
+    # set_debug(on) turns the debug output on or off; without them those commands fail.
+
+    def __init__(self,
+                 registry,
+                 publish,
+                 topic_prefix: str,
+                 topic: str = 'cmd',
+                 rate: float = 0.5,
+                 burst: int = 5,
+                 max_queue: int = 10,
+                 min_interval: float = 5.0,
+                 reschedule=None,
+                 set_debug=None,
+                 log=print
+                 ) -> None:
+        self.registry = registry
+        self.publish = publish
+        self.request_topic = topic_prefix + topic
+        self.ack_topic = topic_prefix + topic + '/ack'
+        self.min_interval = min_interval
+        self.reschedule = reschedule
+        self.set_debug = set_debug
+        self.log = log
+        self.bucket = TokenBucket(rate, burst)
+        self.counts = {'accepted': 0, 'done': 0, 'failed': 0, 'limited': 0, 'bad': 0}
+        self.handlers = {
+            'set_interval': self.cmd_set_interval,
+            'set_deadband': self.cmd_set_deadband,
+            'set_threshold': self.cmd_set_threshold,
+            'read_now': self.cmd_read_now,
+            'debug': self.cmd_debug,
+            'get': self.cmd_get,
+        }
+        self._commands = queue.Queue(maxsize=max_queue)
+        self._limited = 0
+        self._limited_ack_at = 0.0
+        self._thread = None
+
+    def on_request(self, client, userdata, msg) -> None:
+        # paho message callback for the command topic, kept short as it runs on the network thread
+        if not self.bucket.take():
+            self._drop()
+            return
+        try:
+            self._commands.put_nowait(msg.payload)
+            self.counts['accepted'] += 1
+        except queue.Full:
+            self._drop()
+
+    def _drop(self) -> None:
+        self.counts['limited'] += 1
+        self._limited += 1
+        now = time.monotonic()
+        if now - self._limited_ack_at >= 1.0:
+            self._limited_ack_at = now
+            self.ack({}, False, error='rate limited', dropped=self._limited)
+            self._limited = 0
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='commands', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        try:
+            self._commands.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _run(self) -> None:
+        while True:
+            payload = self._commands.get()
+            if payload is None:
+                return
+            try:
+                req = json.loads(payload)
+                if not isinstance(req, dict):
+                    raise ValueError('not an object')
+            except Exception as error:
+                self.counts['bad'] += 1
+                self.ack({}, False, error=f'not understood: {error}')
+                continue
+            self.run(req)
+
+    def run(self, req: dict) -> None:
+        handler = self.handlers.get(req.get('cmd'))
+        if handler is None:
+            self.counts['bad'] += 1
+            self.ack(req, False, error=f"unknown command {req.get('cmd')}")
+            return
+        try:
+            result = handler(req)
+        except Exception as error:
+            # a bad value, a sensor that failed to read or a monitor not yet up, this worker
+            # thread is the only one taking commands so it must carry on
+            self.counts['failed'] += 1
+            self.log(f"Command {req.get('cmd')} failed: {error}")
+            self.ack(req, False, error=str(error))
+            return
+        self.counts['done'] += 1
+        self.ack(req, True, result=result)
+
+    def ack(self, req: dict, ok: bool, **fields) -> None:
+        pld = {"time": datetime.datetime.now(), "client_id": self.registry.client_id,
+               "id": req.get('id'), "cmd": req.get('cmd'), "ok": ok}
+        pld.update(fields)
+        self.publish(topic=self.ack_topic, payload=json.dumps(pld, default=str), retain=False, qos=1)
+
+    # -- the commands, each returns the ack's result or raises, ie KeyError, ValueError or TypeError
+    def sensor(self, req: dict):
+        try:
+            return self.registry.get(req['sensor'])
+        except KeyError:
+            raise KeyError(f"no sensor {req.get('sensor')}") from None
+
+    def sensors(self, req: dict) -> list:
+        return [self.sensor(req)] if req.get('sensor') else list(self.registry.sensors)
+
+    def cmd_set_interval(self, req: dict) -> dict:
+        sensor = self.sensor(req)
+        seconds = float(req['seconds'])
+        if not math.isfinite(seconds):
+            raise ValueError('seconds must be a finite number')
+        if not sensor.interval:
+            raise ValueError(f'{sensor.name} is not polled')
+        if seconds < self.min_interval:
+            raise ValueError(f'seconds under the minimum {self.min_interval}')
+        if self.reschedule is None:
+            raise ValueError('intervals cannot be changed here')
+        self.reschedule(sensor.name, seconds)
+        sensor.interval = seconds
+        return {"sensor": sensor.name, "interval": seconds}
+
+    def cmd_set_deadband(self, req: dict) -> dict:
+        sensor = self.sensor(req)
+        value = float(req['value'])
+        if not math.isfinite(value):
+            raise ValueError('value must be a finite number')
+        if value < 0:
+            raise ValueError('a deadband cannot be negative')
+        for topic in sensor.topics():
+            self.registry.pub_filter.set_deadband(topic, req['field'], value,
+                                                  max_silence=self.registry.cfg['publish']['max_silence'])
+        return {"sensor": sensor.name, "field": req['field'], "deadband": value}
+
+    def cmd_set_threshold(self, req: dict) -> dict:
+        sensor = self.sensor(req)
+        sensor.set_threshold(float(req['value']))
+        return {"sensor": sensor.name, "threshold": sensor.threshold()}
+
+    def cmd_read_now(self, req: dict) -> dict:
+        # published even when the filter would have held the reading back
+        names = []
+        for sensor in self.sensors(req):
+            for topic in sensor.topics():
+                self.registry.pub_filter.forget(topic)
+            self.registry.snd(sensor)
+            names.append(sensor.name)
+        return {"read": names}
+
+    def cmd_debug(self, req: dict) -> dict:
+        if self.set_debug is None:
+            raise ValueError('debug cannot be changed here')
+        on = req['on']
+        if not isinstance(on, bool):
+            raise TypeError('on is true or false')
+        self.set_debug(on)
+        return {"debug": on}
+
+    def cmd_get(self, req: dict) -> dict:
+        pub_filter = self.registry.pub_filter
+        return {sensor.name: {"interval": sensor.interval,
+                              "threshold": sensor.threshold(),
+                              "deadbands": {topic: pub_filter.deadbands(topic) for topic in sensor.topics()}}
+                for sensor in self.sensors(req)}
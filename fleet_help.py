@@ -0,0 +1,282 @@
+# fleet_help.py
+# Fleet mode for pizero_mqtt_monitor.py: one gateway process serving several sensor groups (garages,
+# sheds, ...), each its own device with its own topic prefix, availability topic, sensors and
+# Home Assistant device. A group's pins can be on this Pi or on a remote Pi running pigpiod,
+# reached through PiGPIOFactory(host=pigpio_host, port=pigpio_port).
+#
+# The groups are shared out over worker processes (workers, by default one per CPU core), so the
+# polling and publishing of one group does not wait on another's. Each worker has a pool of
+# connections MQTT connections, the groups taking turns over them. A connection's last will is on
+# <fleet status_topic><connection client id>/LWT and every group on it lists that as well as its
+# own availability topic in its discovery configs, so Home Assistant shows a group unavailable when
+# either the connection drops or the group is stopped. With as many connections as groups each
+# group has one to itself.
+#
+# Not in fleet mode: the asyncio runtime, metrics, history, the command topic and the governor.
+# They stay single device features.
+#
+import copy
+import datetime
+import json
+import multiprocessing
+import os
+import paho.mqtt.client as mqtt
+from apscheduler.schedulers.background import BlockingScheduler
+import sens_registry
+import net_help
+import pub_help
+import ha_help
+import sched_help
+
+
+def group_configs(cfg: dict) -> list:
+    # A full monitor config for each fleet group. A group gives its name, client_id, topic_prefix,
+    # pigpio_host and pigpio_port, its sensors (default the top level ones) and may override any
+    # other section. The discovery state file gets the group's name in it.
+    base = {k: v for k, v in cfg.items() if k != 'fleet'}
+    cfgs = []
+    for group in cfg['fleet']['groups']:
+        name = group['name']
+        over = {k: v for k, v in group.items()
+                if k not in ('name', 'client_id', 'topic_prefix', 'pigpio_host', 'pigpio_port')}
+        gcfg = sens_registry.merge_config(base, over)
+        gcfg['device'] = dict(base['device'], name=name,
+                              client_id=group.get('client_id', name),
+                              topic_prefix=group.get('topic_prefix', f'{name}/'))
+        gcfg['pigpio'] = {'host': group.get('pigpio_host'), 'port': group.get('pigpio_port', 8888)}
+        stem, ext = os.path.splitext(gcfg['discovery']['state_file'])
+        gcfg['discovery']['state_file'] = f'{stem}-{name}{ext}'
+        cfgs.append(gcfg)
+    return cfgs
+
+
+def pin_factory(gcfg: dict):
+    if gcfg['simulate']['enabled']:
+        import sim_help
+        ldr_pins = [s['pin'] for s in gcfg['sensors'] if s['type'] == 'ldr']
+        factory = sim_help.mock_factory(ldr_pins, gcfg['simulate']['ldr_charge_time'])
+        sim_help.PinScript(factory, waves=gcfg['simulate']['waves'], events=gcfg['simulate']['events']).start()
+        return factory
+    from gpiozero.pins.pigpio import PiGPIOFactory
+    if gcfg['pigpio']['host']:
+        return PiGPIOFactory(host=gcfg['pigpio']['host'], port=gcfg['pigpio']['port'])
+    return PiGPIOFactory()
+
+
+class Connection:
+    # One pooled MQTT connection, with its own publish queue and spool.
+
+    def __init__(self, cfg: dict, client_id: str, will_topic: str, spool_dir: str, log=print) -> None:
+        self.client_id = client_id
+        self.no_delay = cfg['mqtt']['no_delay']
+        self.will_topic = will_topic
+        self.log = log
+        self.groups = []
+        v5 = pub_help.protocol_v5(cfg['mqtt'])
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id,
+                                  protocol=mqtt.MQTTv5 if v5 else mqtt.MQTTv311)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.will_set(topic=will_topic, payload='offline', qos=0, retain=True)
+        pub_cfg = cfg['publish']
+        self.client.max_inflight_messages_set(cfg['mqtt']['max_inflight'])
+        self.client.max_queued_messages_set(pub_cfg['max_mem'])
+        self.queue = pub_help.PublishQueue(self.client,
+                                           spool_dir=spool_dir,
+                                           max_mem=pub_cfg['max_mem'],
+                                           max_disk_bytes=pub_cfg['max_disk_bytes'],
+                                           replay_rate=pub_cfg['replay_rate']
+                                           )
+        if v5:
+            self.queue.properties = pub_help.PublishProperties(self.expiry)
+        self.client.message_callback_add(cfg['discovery']['prefix'] + '/status', self.on_ha_status)
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code == 0:
+            self.log(f'{self.client_id} connected with result code {str(reason_code)}')
+            if self.no_delay:
+                net_help.tcp_no_delay(client)
+            client.publish(topic=self.will_topic, payload='online', qos=0, retain=True)
+            self.queue.on_connect(properties)
+            for group in self.groups:
+                group.on_connect(client)
+
+    def expiry(self, topic: str) -> int:
+        # by the policy of the group the topic is under
+        for group in self.groups:
+            if topic.startswith(group.registry.topic_prefix):
+                return group.registry.policy.expiry(topic)
+        return 0
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.queue.on_disconnect()
+
+    def on_ha_status(self, client, userdata, msg):
+        # one callback per topic, passed on to every group on this connection
+        for group in self.groups:
+            if group.discovery is not None:
+                group.discovery.on_ha_status(client, userdata, msg)
+
+
+class Group:
+    # One sensor group, a SensorRegistry publishing through its connection.
+
+    def __init__(self, gcfg: dict, conn: Connection, factory, log=print, verbose: bool = False) -> None:
+        self.cfg = gcfg
+        self.conn = conn
+        self.name = gcfg['device']['name']
+        self.client_id = gcfg['device']['client_id']
+        prefix = gcfg['device']['topic_prefix']
+        self.avail_topic = prefix + gcfg['publish']['avail_topic']
+        self.startup_topic = prefix + gcfg['publish']['startup_topic']
+        self.registry = sens_registry.SensorRegistry(gcfg, conn.queue.publish, log=log, pin_factory=factory)
+        self.registry.verbose = verbose
+        self.discovery = None
+        if gcfg['discovery']['enabled']:
+            self.discovery = ha_help.DiscoveryPublisher(self.registry,
+                                                        avail_topic=self.avail_topic,
+                                                        device_name=self.name,
+                                                        prefix=gcfg['discovery']['prefix'],
+                                                        state_file=gcfg['discovery']['state_file'],
+                                                        log=log,
+                                                        extra_avail_topics=[conn.will_topic]
+                                                        )
+        self.started = None
+        conn.groups.append(self)
+
+    def setup(self) -> None:
+        self.registry.setup()
+        if self.discovery is not None:
+            self.discovery.build()
+            # when the connection came up first on_connect had nothing to publish yet
+            if self.conn.client.is_connected():
+                self.discovery.publish_changed(self.conn.client)
+        self.registry.start()
+        self.registry.register_callbacks()
+        self.started = datetime.datetime.now()
+
+    def on_connect(self, client) -> None:
+        client.publish(topic=self.avail_topic, payload='online', qos=0, retain=True)
+        if self.discovery is not None:
+            self.discovery.on_connect(client)
+        pld = {"time": datetime.datetime.now(), "client_id": self.client_id,
+               "gateway": self.conn.client_id, "started": self.started}
+        client.publish(topic=self.startup_topic, payload=json.dumps(pld, default=str), retain=True, qos=0)
+
+    def snd_still_alive(self) -> None:
+        self.conn.client.publish(topic=self.avail_topic, payload='online', qos=0, retain=True)
+
+    def jobs(self) -> list:
+        # [(job id, function, interval seconds), ...], ids prefixed with the group name
+        jobs = [(f'{self.name}.{job_id}', job, seconds) for job_id, job, seconds in self.registry.jobs()]
+        jobs.append((f'{self.name}.still_alive', self.snd_still_alive, self.cfg['publish']['still_alive_int']))
+        return jobs
+
+    def startup_reads(self) -> None:
+        self.registry.startup_reads()
+
+    def close(self) -> None:
+        self.conn.client.publish(topic=self.avail_topic, payload='offline', qos=0, retain=True)
+        self.registry.close()
+
+
+def run_worker(index: int, cfg: dict, gcfgs: list, log=print, verbose: bool = False) -> None:
+    # Runs gcfgs in this process until interrupted.
+    from gpiozero import Device
+
+    fleet_cfg = cfg['fleet']
+    gateway = fleet_cfg.get('gateway_id') or cfg['device']['client_id']
+    n_conns = max(1, min(fleet_cfg['connections'], len(gcfgs)))
+    spool_dir = cfg['publish']['spool_dir']
+    conns = []
+    for i in range(n_conns):
+        client_id = f'{gateway}-w{index}-c{i}'
+        conns.append(Connection(cfg, client_id,
+                                will_topic=f"{fleet_cfg['status_topic']}{client_id}/LWT",
+                                spool_dir=os.path.join(spool_dir, client_id) if spool_dir else None,
+                                log=log))
+    groups = []
+    for n, gcfg in enumerate(gcfgs):
+        factory = pin_factory(gcfg)
+        if Device.pin_factory is None:
+            # for the devices without pins, ie CPUTemperature
+            Device.pin_factory = factory
+        groups.append(Group(gcfg, conns[n % n_conns], factory, log=log, verbose=verbose))
+
+    def connect_all():
+        for conn in conns:
+            conn.client.connect(host=cfg['mqtt']['broker'], port=cfg['mqtt']['port'],
+                                keepalive=cfg['mqtt']['keepalive'])
+            conn.client.loop_start()
+
+    for conn in conns:
+        conn.queue.start()
+    net_help.BrokerLink(cfg['mqtt']['broker'], port=cfg['mqtt']['port'], on_reachable=connect_all).start()
+
+    schedule = BlockingScheduler()
+    phases = sched_help.PhaseScheduler(slot=cfg['schedule']['slot'], max_io=cfg['schedule']['max_io'])
+    for group in groups:
+        group.setup()
+        for job_id, job, seconds in group.jobs():
+            phases.add(job_id, job, seconds)
+    if cfg['schedule']['spread']:
+        plan = phases.plan()
+        log(f'Worker {index}: {len(groups)} groups, most jobs in one slot {plan["max_per_slot"]}')
+    phases.start()
+    start = datetime.datetime.now()
+    for job_id, job, seconds, phase in phases.planned():
+        schedule.add_job(job, 'interval', seconds=seconds, id=job_id,
+                         start_date=start + datetime.timedelta(seconds=phase))
+    for group in groups:
+        group.startup_reads()
+    try:
+        schedule.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for group in groups:
+            group.close()
+        for conn in conns:
+            conn.queue.close()
+            conn.client.disconnect()
+
+
+def run(cfg: dict, log=print, verbose: bool = False) -> None:
+    # Runs every fleet group, in workers processes (one per CPU core by default).
+    cfg = copy.deepcopy(cfg)
+    sim = None
+    if cfg['simulate']['enabled']:
+        import sim_help
+        sim = sim_help.Simulation(cfg, pins=False)
+        sim.start()
+    gcfgs = group_configs(cfg)
+    if sim is not None:
+        for gcfg in gcfgs:
+            sim_help.sim_config(gcfg, sim.sysfs, sim.broker)
+            stem, ext = os.path.splitext(gcfg['discovery']['state_file'])
+            gcfg['discovery']['state_file'] = f"{stem}-{gcfg['device']['name']}{ext}"
+    workers = cfg['fleet']['workers'] or os.cpu_count() or 1
+    workers = max(1, min(workers, len(gcfgs)))
+    shares = [gcfgs[i::workers] for i in range(workers)]
+    log(f'Fleet: {len(gcfgs)} groups over {workers} worker processes')
+    try:
+        if workers == 1:
+            run_worker(0, cfg, shares[0], log, verbose)
+            return
+        # fork, so the workers need nothing pickled
+        ctx = multiprocessing.get_context('fork')
+        procs = [ctx.Process(target=run_worker, args=(i, cfg, share, log, verbose),
+                                         name=f'fleet-worker-{i}')
+                 for i, share in enumerate(shares)]
+        for proc in procs:
+            proc.start()
+        try:
+            for proc in procs:
+                proc.join()
+        except KeyboardInterrupt:
+            # the workers get the interrupt too and close down
+            for proc in procs:
+                proc.join(timeout=5.0)
+    finally:
+        if sim is not None:
+            sim.stop()
@@ -0,0 +1,175 @@
+# gov_help.py
+# A governor for the polling intervals of pizero_mqtt_monitor.py. In a hot garage the Pi Zero
+# throttles at about 80 °C, yet every job kept its fixed interval. ThermalGovernor looks at three
+# pressures every interval seconds, each 0 (fine) to 1 (too much):
+#   temp     the CPU temperature (sens_help.CPUTempState) from temp_high - temp_band up to temp_high,
+#            by default the cpu sensor's own threshold
+#   load     the 1 minute load average per core from load_low to load_high
+#   backlog  readings waiting in the publish queue from backlog_low to backlog_high
+# and stretches the intervals of the jobs in tiers by up to max_stretch times as the highest of
+# them rises. The first tier stretches from any pressure at all, each later one only once the
+# pressure is past its share (a half for the second of two tiers, and so on), so the WiFi and IP
+# jobs give way before the readings do. Jobs in no tier (the door, the PIRs, the CPU temperature
+# itself, still alive) are never touched.
+#
+# Stretches go up in steps of step as soon as the pressure calls for it, and come down only after
+# cool_down evaluations in a row asking for less, so a job is not retimed every evaluation. Each
+# change of stretch, whether or not any job of the tier is scheduled, is published (retained) to
+# <prefix>governor as
+#   {"time": ..., "client_id": ..., "pressure": 0.62, "pressures": {"temp": 0.62, "load": 0.1,
+#    "backlog": 0.0}, "cpu_temp_c": 76.2, "load": 0.9, "backlog": 3,
+#    "stretch": [3.0, 1.5], "changed": {"wifi": [60, 180.0], ...}, "intervals": {...}}
+#
+import datetime
+import json
+import os
+import threading
+
+
+def ramp(value, low: float, high: float) -> float:
+    # 0 at or below low, 1 at or above high, straight between
+    if value is None or high <= low:
+        return 0.0
+    return min(1.0, max(0.0, (value - low) / (high - low)))
+
+
+class ThermalGovernor:
+    # cpu_state is the cpu sensor's sens_help.CPUTempState, or None to go by load and backlog only.
+    # backlog() is the publish queue's backlog, reschedule(job id, seconds) applies an interval to
+    # the running scheduler and publish(topic, payload, retain, qos) sends the adjustments.
+
+    def __init__(self,
+                 cpu_state,
+                 backlog,
+                 reschedule,
+                 publish,
+                 topic: str,
+                 client_id: str,
+                 qos: int = 0,
+                 tiers=(),
+                 temp_high: float = None,
+                 temp_band: float = 10.0,
+                 load_low: float = 0.8,
+                 load_high: float = 2.0,
+                 backlog_low: int = 20,
+                 backlog_high: int = 150,
+                 max_stretch: float = 4.0,
+                 step: float = 0.5,
+                 cool_down: int = 3,
+                 read_load=None,
+                 log=print
+                 ) -> None:
+        self.cpu_state = cpu_state
+        self.backlog = backlog
+        self.reschedule = reschedule
+        self.publish = publish
+        self.topic = topic
+        self.client_id = client_id
+        self.qos = qos
+        self.tiers = [list(tier) for tier in tiers]
+        self.temp_high = temp_high
+        self.temp_band = temp_band
+        self.load_low = load_low
+        self.load_high = load_high
+        self.backlog_low = backlog_low
+        self.backlog_high = backlog_high
+        self.max_stretch = max_stretch
+        self.step = step
+        self.cool_down = cool_down
+        self.read_load = read_load or (lambda: os.getloadavg()[0] / (os.cpu_count() or 1))
+        self.log = log
+        # job id -> base interval, of the jobs in a tier that are scheduled
+        self.base = {}
+        self.stretch = [1.0] * len(self.tiers)
+        self._lower = [0] * len(self.tiers)
+        self.last = {}
+        self.counts = {'evaluations': 0, 'adjustments': 0, 'read_errors': 0}
+        self._lock = threading.Lock()
+
+    def add(self, job_id: str, interval: float) -> None:
+        if any(job_id in tier for tier in self.tiers):
+            self.base[job_id] = interval
+
+    def tier_of(self, job_id: str) -> int:
+        for k, tier in enumerate(self.tiers):
+            if job_id in tier:
+                return k
+        return None
+
+    def interval(self, job_id: str) -> float:
+        return self.base[job_id] * self.stretch[self.tier_of(job_id)]
+
+    def set_base(self, job_id: str, seconds: float) -> float:
+        # A new interval for a job, ie from the command topic, stretched as its tier is now.
+        # Returns the interval applied. The base is kept only once the scheduler has taken it.
+        with self._lock:
+            if job_id not in self.base:
+                self.reschedule(job_id, seconds)
+                return seconds
+            applied = seconds * self.stretch[self.tier_of(job_id)]
+        self.reschedule(job_id, applied)
+        with self._lock:
+            self.base[job_id] = seconds
+        return applied
+
+    def readings(self) -> dict:
+        temp = None
+        temp_high = self.temp_high
+        if self.cpu_state is not None:
+            try:
+                temp, _ = self.cpu_state.cpu_temp_state()
+                temp_high = temp_high or self.cpu_state.cpu_temp.threshold
+            except (OSError, ValueError):
+                self.counts['read_errors'] += 1
+        try:
+            load = self.read_load()
+        except OSError:
+            self.counts['read_errors'] += 1
+            load = None
+        backlog = self.backlog()
+        pressures = {"temp": round(ramp(temp, (temp_high or 0.0) - self.temp_band, temp_high or 0.0), 3),
+                     "load": round(ramp(load, self.load_low, self.load_high), 3),
+                     "backlog": round(ramp(backlog, self.backlog_low, self.backlog_high), 3)}
+        return {"pressure": max(pressures.values()), "pressures": pressures,
+                "cpu_temp_c": temp, "load": None if load is None else round(load, 2), "backlog": backlog}
+
+    def target(self, k: int, pressure: float) -> float:
+        # tier k of n stretches from pressure k / n up to max_stretch at 1, in steps
+        start = k / len(self.tiers)
+        share = min(1.0, max(0.0, (pressure - start) / (1.0 - start)))
+        return 1.0 + round(share * (self.max_stretch - 1.0) / self.step) * self.step
+
+    def evaluate(self) -> dict:
+        # The governor's own polling job. Returns the jobs retimed, {job id: [old, new]}.
+        rd = self.readings()
+        changed = {}
+        stretched = False
+        with self._lock:
+            self.counts['evaluations'] += 1
+            for k in range(len(self.tiers)):
+                want = self.target(k, rd["pressure"])
+                if want < self.stretch[k]:
+                    self._lower[k] += 1
+                    if self._lower[k] < self.cool_down:
+                        continue
+                self._lower[k] = 0
+                if want == self.stretch[k]:
+                    continue
+                old = {job_id: self.interval(job_id) for job_id in self.tiers[k] if job_id in self.base}
+                self.stretch[k] = want
+                stretched = True
+                for job_id, seconds in old.items():
+                    changed[job_id] = [seconds, self.interval(job_id)]
+            self.last = rd
+        if not stretched:
+            return changed
+        for job_id, (_, seconds) in changed.items():
+            self.reschedule(job_id, seconds)
+        self.counts['adjustments'] += 1
+        pld = {"time": datetime.datetime.now(), "client_id": self.client_id}
+        pld.update(rd)
+        pld.update({"stretch": list(self.stretch), "changed": changed,
+                    "intervals": {job_id: self.interval(job_id) for job_id in self.base}})
+        self.log(f'Governor: pressure {rd["pressure"]}, stretch {self.stretch}, {changed}')
+        self.publish(topic=self.topic, payload=json.dumps(pld, default=str), retain=True, qos=self.qos)
+        return changed
@@ -0,0 +1,148 @@
+# ha_help.py
+# Home Assistant MQTT discovery for the sensors built by sens_registry.py, so entities no longer
+# have to be written by hand in Home Assistant's configuration.yaml to match the topics here.
+#
+# The discovery payloads are worked out once. Each has a content hash, and a payload is only
+# published (retained) when its hash differs from the one last sent, so reconnects do not flood
+# the broker with unchanged configs. The hashes sent are kept in state_file so a restart does not
+# resend either, and entities dropped from the config are removed from Home Assistant by
+# publishing an empty retained config for them.
+#
+# In the aggregated (batched) mode the entities read the device state topic instead, picking their
+# sensor's key out of the JSON. CBOR and MessagePack state payloads can not be read by Home Assistant,
+# so nothing is discovered with those.
+#
+# Home Assistant publishes 'online' on <prefix>/status when it starts. If it lost its view of the
+# retained configs, everything is resent then.
+#
+# In fleet mode (see fleet_help.py) a group shares its MQTT connection, and so the connection's last
+# will, with other groups. Its entities are then available only while both the group's own
+# availability topic and the connection's are online (extra_avail_topics).
+#
+import hashlib
+import json
+import os
+import threading
+
+
+class DiscoveryPublisher:
+
+    def __init__(self,
+                 registry,
+                 avail_topic: str,
+                 device_name: str,
+                 prefix: str = 'homeassistant',
+                 state_file: str = None,
+                 log=print,
+                 extra_avail_topics=()
+                 ) -> None:
+        self.registry = registry
+        self.avail_topic = avail_topic
+        self.extra_avail_topics = list(extra_avail_topics)
+        self.device_name = device_name
+        self.prefix = prefix
+        self.state_file = state_file
+        self.log = log
+        self.status_topic = prefix + '/status'
+        # discovery topic -> (payload, hash), None until build()
+        self.configs = None
+        # discovery topic -> hash last published
+        self.sent = self._load_state()
+        # publish_changed may be called from the client's network thread and the main thread
+        self._lock = threading.Lock()
+
+    def _load_state(self) -> dict:
+        if self.state_file and os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, 'r') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                pass
+        return {}
+
+    def _save_state(self) -> None:
+        if not self.state_file:
+            return
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.sent, f)
+        os.replace(tmp, self.state_file)
+
+    def device_info(self) -> dict:
+        return {
+            "identifiers": [self.registry.client_id],
+            "name": self.device_name,
+            "model": "Raspberry Pi Zero W",
+            "manufacturer": "Raspberry Pi"
+        }
+
+    def build(self) -> None:
+        # Works out every discovery payload from the registry. Call again after the registry changes.
+        configs = {}
+        device = self.device_info()
+        batcher = self.registry.batcher
+        if batcher is not None and batcher.encoding != 'json':
+            self.log(f'Home Assistant discovery: {batcher.encoding} state payloads can not be discovered')
+            self.configs = configs
+            return
+        for sensor in self.registry.sensors:
+            for state_topic, component, key, fields in sensor.ha_entities():
+                if batcher is not None:
+                    fields = dict(fields)
+                    state_key = sensor.state_key(state_topic)
+                    fields['value_template'] = fields['value_template'].replace('value_json.',
+                                                                                f"value_json['{state_key}'].")
+                    state_topic = batcher.topic
+                object_id = f'{self.device_name}-{key}'.replace('/', '_')
+                cfg = {
+                    "name": key,
+                    "unique_id": object_id,
+                    "object_id": object_id,
+                    "state_topic": state_topic,
+                    "availability_topic": self.avail_topic,
+                    "payload_available": "online",
+                    "payload_not_available": "offline",
+                    "qos": self.registry.policy.qos(state_topic),
+                    "device": device
+                }
+                if self.extra_avail_topics:
+                    del cfg["availability_topic"]
+                    cfg["availability"] = [{"topic": t} for t in [self.avail_topic] + self.extra_avail_topics]
+                    cfg["availability_mode"] = "all"
+                cfg.update(fields)
+                payload = json.dumps(cfg, sort_keys=True, separators=(',', ':'))
+                digest = hashlib.sha1(payload.encode()).hexdigest()
+                configs[f'{self.prefix}/{component}/{object_id}/config'] = (payload, digest)
+        self.configs = configs
+
+    def publish_changed(self, client, force: bool = False) -> int:
+        # Publishes the configs whose hash changed since last sent (all of them with force) and
+        # clears the ones no longer configured. Returns how many were published. Nothing is done
+        # before build(), the devices may still be coming up.
+        with self._lock:
+            if self.configs is None:
+                return 0
+            n = 0
+            for topic, (payload, digest) in self.configs.items():
+                if force or self.sent.get(topic) != digest:
+                    client.publish(topic=topic, payload=payload, retain=True, qos=1)
+                    self.sent[topic] = digest
+                    n += 1
+            for topic in [t for t in self.sent if t not in self.configs]:
+                client.publish(topic=topic, payload='', retain=True, qos=1)
+                del self.sent[topic]
+                n += 1
+            if n:
+                self.log(f'Home Assistant discovery: published {n} of {len(self.configs)} configs')
+                self._save_state()
+            return n
+
+    def on_connect(self, client) -> None:
+        # Call from the client's on_connect.
+        client.subscribe(self.status_topic, qos=0)
+        self.publish_changed(client)
+
+    def on_ha_status(self, client, userdata, msg) -> None:
+        # paho message callback for <prefix>/status
+        if msg.payload == b'online':
+            self.publish_changed(client, force=True)
@@ -0,0 +1,429 @@
+# history_help.py
+# On-device history of the published readings, so gaps in Home Assistant's or the broker's view
+# (restarts, outages) can be backfilled by asking the device for them.
+#
+# TimeSeriesRing keeps the readings in a fixed size memory mapped file, a ring of blocks. When the
+# ring is full the oldest block is reused. Inside a block records are packed with varints:
+#   record:  dt ms since the block's previous record, topic, n fields, then per field: name, value
+#   strings: 0 + length + utf-8 the first time in a block, after that index + 1 into the block's
+#            strings, so topics and field names are written out once a block
+#   numbers: a float with up to 6 decimals is kept as an integer of that many decimals; numbers are
+#            zigzag deltas from the same topic and field's previous value in the block
+# Every block starts afresh (absolute time, no strings, no previous values), so losing the oldest
+# block never spoils the rest. Records are kept in time order: a reading up to max_skew seconds
+# older than the last one written (a DS18x20 sample taken a little before, a door event stamped
+# with its first edge) is kept at the last one's time, only a bigger step back of the clock starts
+# a new block. The file survives restarts. Pages are written back by the kernel and by flush(), so
+# SD card writes are a few pages per flush, not a write per reading.
+#
+# HistoryServer answers range queries sent to <prefix>history/query as JSON,
+#   {"id": "ha-1", "topic": "rpiz01/garage/#", "since": 1717000000, "until": 1717003600, "chunk": 50}
+# with since and until unix seconds (until defaults to now, since to the oldest kept) and topic an
+# MQTT filter (default everything). Replies stream to <prefix>history/result/<id> in chunks of
+#   {"id": "ha-1", "seq": 0, "last": false, "rows": [[unix seconds, topic, {values}], ...]}
+# the last flagged "last": true with the row count. A query that fails gets a last reply with an
+# "error" instead.
+#
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from paho.mqtt.client import topic_matches_sub
+
+MAGIC = b'PZTS'
+VERSION = 1
+# magic, version, block size, blocks, next block sequence number
+FILE_HEADER = struct.Struct('<4sHIIQ')
+# block sequence number (0 is unused), base unix ms, bytes used
+BLOCK_HEADER = struct.Struct('<QQI')
+
+T_NONE, T_FALSE, T_TRUE, T_INT, T_DEC, T_DOUBLE, T_STR, T_JSON = range(8)
+
+
+def put_varint(buf: bytearray, n: int) -> None:
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def get_varint(data, pos: int) -> tuple:
+    n = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return n, pos
+        shift += 7
+
+
+def zigzag(n: int) -> int:
+    return n * 2 if n >= 0 else -n * 2 - 1
+
+
+def unzigzag(n: int) -> int:
+    return n // 2 if not n & 1 else -(n + 1) // 2
+
+
+def decimals(value: float):
+    # The decimals value is written with, None when it does not fit an integer of up to 6 decimals.
+    text = repr(value)
+    if 'e' in text or 'n' in text:
+        return None
+    d = len(text) - text.index('.') - 1 if '.' in text else 0
+    return d if d <= 6 else None
+
+
+class BlockCodec:
+    # The string table and previous values of the block being written or read.
+
+    def __init__(self) -> None:
+        self.strings = []
+        self.index = {}
+        self.prev = {}  # (topic, field) -> previous integer value
+        self.end = 0  # where the last whole record read ended
+
+    def put_str(self, buf: bytearray, s: str) -> None:
+        i = self.index.get(s)
+        if i is not None:
+            put_varint(buf, i + 1)
+            return
+        raw = s.encode()
+        put_varint(buf, 0)
+        put_varint(buf, len(raw))
+        buf += raw
+        self.index[s] = len(self.strings)
+        self.strings.append(s)
+
+    def get_str(self, data, pos: int) -> tuple:
+        i, pos = get_varint(data, pos)
+        if i:
+            return self.strings[i - 1], pos
+        n, pos = get_varint(data, pos)
+        s = bytes(data[pos:pos + n]).decode()
+        self.strings.append(s)
+        return s, pos + n
+
+    def put_value(self, buf: bytearray, key: tuple, value) -> None:
+        if value is None:
+            buf.append(T_NONE)
+        elif value is True or value is False:
+            buf.append(T_TRUE if value else T_FALSE)
+        elif isinstance(value, int):
+            buf.append(T_INT)
+            put_varint(buf, zigzag(value - self.prev.get(key, 0)))
+            self.prev[key] = value
+        elif isinstance(value, float):
+            d = decimals(value)
+            if d is None:
+                buf.append(T_DOUBLE)
+                buf += struct.pack('<d', value)
+                return
+            scaled = int(round(value * 10 ** d))
+            buf.append(T_DEC)
+            buf.append(d)
+            put_varint(buf, zigzag(scaled - self.prev.get(key, 0)))
+            self.prev[key] = scaled
+        elif isinstance(value, str):
+            buf.append(T_STR)
+            self.put_str(buf, value)
+        else:
+            buf.append(T_JSON)
+            self.put_str(buf, json.dumps(value, default=str))
+
+    def get_value(self, data, pos: int, key: tuple) -> tuple:
+        tag = data[pos]
+        pos += 1
+        if tag == T_NONE:
+            return None, pos
+        if tag in (T_FALSE, T_TRUE):
+            return tag == T_TRUE, pos
+        if tag == T_INT:
+            n, pos = get_varint(data, pos)
+            value = self.prev.get(key, 0) + unzigzag(n)
+            self.prev[key] = value
+            return value, pos
+        if tag == T_DEC:
+            d = data[pos]
+            n, pos = get_varint(data, pos + 1)
+            scaled = self.prev.get(key, 0) + unzigzag(n)
+            self.prev[key] = scaled
+            return round(scaled / 10 ** d, d), pos
+        if tag == T_DOUBLE:
+            return struct.unpack_from('<d', data, pos)[0], pos + 8
+        s, pos = self.get_str(data, pos)
+        return (s if tag == T_STR else json.loads(s)), pos
+
+
+class TimeSeriesRing:
+
+    def __init__(self, path: str, size_bytes: int = 1_048_576, block_size: int = 4096,
+                 max_skew: float = 300.0) -> None:
+        self.path = path
+        self.block_size = block_size
+        self.max_skew_ms = int(max_skew * 1000)
+        self.n_blocks = max(2, (size_bytes - block_size) // block_size)
+        self.counts = {'records': 0, 'blocks_reused': 0, 'too_big': 0, 'skewed': 0}
+        self._lock = threading.Lock()
+        size = block_size * (self.n_blocks + 1)
+        fresh = not os.path.exists(path) or os.path.getsize(path) != size
+        with open(path, 'a+b') as f:
+            f.truncate(size)
+        self._file = open(path, 'r+b')
+        self.mm = mmap.mmap(self._file.fileno(), size)
+        if not fresh:
+            magic, version, bsize, nblocks, next_seq = FILE_HEADER.unpack_from(self.mm, 0)
+            fresh = (magic, version, bsize, nblocks) != (MAGIC, VERSION, block_size, self.n_blocks)
+        if fresh:
+            self.mm[:] = bytes(size)
+            self.next_seq = 1
+            self._write_file_header()
+        else:
+            self.next_seq = next_seq
+        # the block being written is the one with the highest sequence number
+        self.head = None
+        best = 0
+        for i in range(self.n_blocks):
+            seq = self._block_header(i)[0]
+            if seq > best:
+                best, self.head = seq, i
+        self.codec = None
+        if self.head is not None:
+            # its strings and previous values are needed to carry on writing it
+            self.codec = BlockCodec()
+            self._last_ms = self._block_header(self.head)[1]
+            for ts_ms, _, _ in self._decode_block(self.head, self.codec):
+                self._last_ms = ts_ms
+            # a torn last record is written over
+            seq, base_ms, used = self._block_header(self.head)
+            body = self._offset(self.head) + BLOCK_HEADER.size
+            BLOCK_HEADER.pack_into(self.mm, self._offset(self.head), seq, base_ms, max(0, self.codec.end - body))
+
+    def _write_file_header(self) -> None:
+        FILE_HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.block_size, self.n_blocks, self.next_seq)
+
+    def _offset(self, i: int) -> int:
+        return self.block_size * (i + 1)
+
+    def _block_header(self, i: int) -> tuple:
+        return BLOCK_HEADER.unpack_from(self.mm, self._offset(i))
+
+    def _new_block(self, base_ms: int) -> None:
+        self.head = 0 if self.head is None else (self.head + 1) % self.n_blocks
+        if self._block_header(self.head)[0]:
+            self.counts['blocks_reused'] += 1
+        BLOCK_HEADER.pack_into(self.mm, self._offset(self.head), self.next_seq, base_ms, 0)
+        self.next_seq += 1
+        self._write_file_header()
+        self.codec = BlockCodec()
+        self._last_ms = base_ms
+
+    def _encode(self, ts_ms: int, topic: str, values: dict) -> bytearray:
+        codec = self.codec
+        buf = bytearray()
+        put_varint(buf, max(0, ts_ms - self._last_ms))
+        codec.put_str(buf, topic)
+        put_varint(buf, len(values))
+        for field, value in values.items():
+            codec.put_str(buf, field)
+            codec.put_value(buf, (topic, field), value)
+        return buf
+
+    def append(self, topic: str, values: dict, ts: float = None) -> None:
+        ts_ms = int(round((time.time() if ts is None else ts) * 1000))
+        room = self.block_size - BLOCK_HEADER.size
+        with self._lock:
+            if self.head is None:
+                self._new_block(ts_ms)
+            used = self._block_header(self.head)[2]
+            if ts_ms < self._last_ms - self.max_skew_ms:
+                # the clock stepped back, keep the records in order
+                self._new_block(ts_ms)
+                used = 0
+            elif ts_ms < self._last_ms:
+                # sampled a little before the last record written
+                self.counts['skewed'] += 1
+                ts_ms = self._last_ms
+            # the block's strings and previous values must not change if the record will not fit
+            saved = (list(self.codec.strings), dict(self.codec.index), dict(self.codec.prev))
+            rec = self._encode(ts_ms, topic, values)
+            if used + len(rec) > room:
+                self.codec.strings, self.codec.index, self.codec.prev = saved
+                self._new_block(ts_ms)
+                used = 0
+                rec = self._encode(ts_ms, topic, values)
+                if len(rec) > room:
+                    self.counts['too_big'] += 1
+                    return
+            start = self._offset(self.head) + BLOCK_HEADER.size + used
+            self.mm[start:start + len(rec)] = rec
+            seq, base_ms, _ = self._block_header(self.head)
+            BLOCK_HEADER.pack_into(self.mm, self._offset(self.head), seq, base_ms, used + len(rec))
+            self._last_ms = ts_ms
+            self.counts['records'] += 1
+
+    def _decode_block(self, i: int, codec: BlockCodec):
+        # Yields (unix ms, topic, values) from block i, oldest first. A record torn by a power cut
+        # ends the block.
+        seq, base_ms, used = self._block_header(i)
+        data = self.mm
+        pos = self._offset(i) + BLOCK_HEADER.size
+        end = pos + min(used, self.block_size - BLOCK_HEADER.size)
+        ts_ms = base_ms
+        while pos < end:
+            try:
+                dt, pos = get_varint(data, pos)
+                topic, pos = codec.get_str(data, pos)
+                n, pos = get_varint(data, pos)
+                values = {}
+                for _ in range(n):
+                    field, pos = codec.get_str(data, pos)
+                    values[field], pos = codec.get_value(data, pos, (topic, field))
+            except (IndexError, ValueError, struct.error):
+                return
+            ts_ms += dt
+            codec.end = pos
+            yield ts_ms, topic, values
+
+    def query(self, topic_filter: str = '#', since: float = None, until: float = None):
+        # Yields (unix seconds, topic, values) oldest first. A block is decoded under the lock and
+        # its rows yielded after, so a long query does not hold up append().
+        since_ms = None if since is None else since * 1000
+        until_ms = None if until is None else until * 1000
+        with self._lock:
+            blocks = sorted((self._block_header(i)[:2], i) for i in range(self.n_blocks)
+                            if self._block_header(i)[0])
+        for n, ((seq, base_ms), i) in enumerate(blocks):
+            if until_ms is not None and base_ms > until_ms:
+                break
+            nxt_base = blocks[n + 1][0][1] if n + 1 < len(blocks) else None
+            if since_ms is not None and nxt_base is not None and nxt_base < since_ms:
+                continue
+            with self._lock:
+                if self._block_header(i)[0] != seq:
+                    # reused while the query ran
+                    continue
+                rows = list(self._decode_block(i, BlockCodec()))
+            for ts_ms, topic, values in rows:
+                if since_ms is not None and ts_ms < since_ms:
+                    continue
+                if until_ms is not None and ts_ms > until_ms:
+                    return
+                if topic_matches_sub(topic_filter, topic):
+                    yield ts_ms / 1000.0, topic, values
+
+    def flush(self) -> None:
+        with self._lock:
+            self.mm.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self.mm.flush()
+            self.mm.close()
+            self._file.close()
+
+
+class HistoryServer:
+    # Runs the queries off the paho network thread, one at a time, in a worker thread. publish is
+    # publish(topic, payload, retain, qos), ie the monitor's. Replies are paced chunk_gap seconds
+    # apart so a big backfill does not crowd out the live readings.
+
+    def __init__(self,
+                 store: TimeSeriesRing,
+                 publish,
+                 topic_prefix: str,
+                 topic: str = 'history',
+                 chunk: int = 50,
+                 max_rows: int = 5000,
+                 chunk_gap: float = 0.05,
+                 log=print
+                 ) -> None:
+        self.store = store
+        self.publish = publish
+        self.topic_prefix = topic_prefix
+        self.request_topic = topic_prefix + topic + '/query'
+        self.reply_prefix = topic_prefix + topic + '/result/'
+        self.chunk = chunk
+        self.max_rows = max_rows
+        self.chunk_gap = chunk_gap
+        self.log = log
+        self.counts = {'queries': 0, 'rows': 0, 'bad': 0}
+        self._requests = queue.SimpleQueue()
+        self._thread = None
+
+    def on_request(self, client, userdata, msg) -> None:
+        # paho message callback for the request topic
+        self._requests.put(msg.payload)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='history', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._requests.put(None)
+
+    def _run(self) -> None:
+        while True:
+            payload = self._requests.get()
+            if payload is None:
+                return
+            req = None
+            try:
+                req = json.loads(payload)
+                if not isinstance(req, dict):
+                    raise ValueError('not an object')
+                self.answer(req)
+            except Exception as error:
+                # ie "chunk": 1e400, the only worker thread must carry on
+                self.counts['bad'] += 1
+                self.log(f'History query {payload[:80]!r} not understood: {error}')
+                self._reply_error(req if isinstance(req, dict) else {}, error)
+
+    @staticmethod
+    def reply_id(req: dict) -> str:
+        return str(req.get('id', 'query')).replace('/', '_').replace('+', '_').replace('#', '_')
+
+    def answer(self, req: dict) -> None:
+        req_id = self.reply_id(req)
+        topic = self.reply_prefix + req_id
+        chunk = max(1, min(int(req.get('chunk', self.chunk)), 500))
+        limit = min(int(req.get('limit', self.max_rows)), self.max_rows)
+        since = req.get('since')
+        until = req.get('until')
+        self.counts['queries'] += 1
+        rows = []
+        n = 0
+        seq = 0
+        for ts, row_topic, values in self.store.query(req.get('topic', '#'),
+                                                      None if since is None else float(since),
+                                                      None if until is None else float(until)):
+            rows.append([ts, row_topic, values])
+            n += 1
+            if len(rows) == chunk:
+                self._reply(topic, req_id, seq, rows, False)
+                seq += 1
+                rows = []
+                time.sleep(self.chunk_gap)
+            if n >= limit:
+                break
+        self._reply(topic, req_id, seq, rows, True, n)
+        self.counts['rows'] += n
+
+    def _reply(self, topic: str, req_id: str, seq: int, rows: list, last: bool, total: int = None) -> None:
+        pld = {"id": req_id, "seq": seq, "last": last, "rows": rows}
+        if last:
+            pld["count"] = total
+        self.publish(topic=topic, payload=json.dumps(pld, default=str, separators=(',', ':')), retain=False, qos=1)
+
+    def _reply_error(self, req: dict, error: Exception) -> None:
+        req_id = self.reply_id(req)
+        pld = {"id": req_id, "seq": 0, "last": True, "rows": [], "count": 0, "error": str(error)}
+        try:
+            self.publish(topic=self.reply_prefix + req_id, payload=json.dumps(pld, separators=(',', ':')),
+                         retain=False, qos=1)
+        except Exception as pub_error:
+            self.log(f'History error reply not sent: {pub_error}')
@@ -0,0 +1,254 @@
+# metrics_help.py
+# Instrumentation for pizero_mqtt_monitor.py. Counters, gauges and timing histograms (from
+# time.perf_counter, a monotonic clock) are kept in a Metrics object. They are served in the
+# Prometheus text format by a small local HTTP server on /metrics, and a JSON snapshot can be
+# published to a diagnostics MQTT topic.
+#
+# StartupTimer times the phases of start up, so a change that slows it down shows in the startup
+# message and the metrics.
+#
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds
+df_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def proc_status(pid='self') -> dict:
+    # Resident memory and thread count (every OS thread, pigpio's too, not only Python's) of a
+    # process, from /proc. Zeros where /proc is not there.
+    stats = {'rss_kb': 0, 'threads': 0}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    stats['rss_kb'] = int(line.split()[1])
+                elif line.startswith('Threads:'):
+                    stats['threads'] = int(line.split()[1])
+    except OSError:
+        pass
+    return stats
+
+
+def proc_age() -> float:
+    # Seconds since this process started (to 1/100 s), from /proc. 0.0 where /proc is not there.
+    try:
+        with open('/proc/self/stat') as f:
+            # the fields after the command name, which may have spaces in it
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return 0.0
+    return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+
+
+class StartupTimer:
+    # Phases are timed with phase(name) around them, and can overlap (ie each device's bring-up in
+    # its own thread). mark(name) notes the first time something happened. Times are seconds since
+    # t0, a time.monotonic(), and before_t0_s is how long the process ran before t0 (interpreter
+    # start and imports).
+
+    def __init__(self, t0: float) -> None:
+        self.t0 = t0
+        self.before_t0 = round(max(0.0, proc_age() - (time.monotonic() - t0)), 3)
+        # name -> (seconds from t0 to its start, seconds it took)
+        self.phases = {}
+        self.marks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            with self._lock:
+                self.phases[name] = (round(start - self.t0, 3), round(end - start, 3))
+
+    def mark(self, name: str) -> None:
+        with self._lock:
+            if name not in self.marks:
+                self.marks[name] = round(time.monotonic() - self.t0, 3)
+
+    def report(self) -> dict:
+        # {"before_t0_s": .., <mark>: .., "phases": {name: [start, seconds], ...}}
+        with self._lock:
+            rpt = {"before_t0_s": self.before_t0}
+            rpt.update(self.marks)
+            rpt["phases"] = {name: list(times) for name, times in self.phases.items()}
+        return rpt
+
+
+class Histogram:
+
+    def __init__(self, buckets=df_buckets) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        for i, le in enumerate(self.buckets):
+            if value <= le:
+                self.counts[i] += 1
+                break
+
+
+def label_str(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Metrics:
+    # Names are Prometheus metric names. labels is a dict, ie {'job': 'temperature'}. Gauges can
+    # also be functions, read when the metrics are collected.
+
+    def __init__(self, prefix: str = 'pizero_') -> None:
+        self.prefix = prefix
+        self.help = {}
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, text: str) -> None:
+        self.help[name] = text
+
+    def inc(self, name: str, labels: dict = None, n: float = 1) -> None:
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def set(self, name: str, value, labels: dict = None) -> None:
+        # value may be a number or a function returning one
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, value: float, labels: dict = None) -> None:
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    def timed(self, name: str, fn, labels: dict = None):
+        # Wraps fn so every call is timed into the name histogram and exceptions are counted in
+        # name_errors_total.
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                self.inc(name + '_errors_total', labels)
+                raise
+            finally:
+                self.observe(name, time.perf_counter() - t0, labels)
+        return wrapper
+
+    def _gauge_values(self) -> dict:
+        values = {}
+        for key, value in list(self.gauges.items()):
+            try:
+                value = value() if callable(value) else value
+            except Exception:
+                continue
+            # None is no value yet, ie a latency before the first event
+            if value is not None:
+                values[key] = value
+        return values
+
+    def prometheus_text(self) -> str:
+        lines = []
+        typed = set()
+
+        def head(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append(f'# HELP {self.prefix}{name} {self.help[name]}')
+                lines.append(f'# TYPE {self.prefix}{name} {kind}')
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, (h.buckets, list(h.counts), h.count, h.sum)) for k, h in self.histograms.items())
+        for (name, labels), value in counters:
+            head(name, 'counter')
+            lines.append(f'{self.prefix}{name}{label_str(labels)} {value}')
+        for (name, labels), value in sorted(self._gauge_values().items()):
+            head(name, 'gauge')
+            lines.append(f'{self.prefix}{name}{label_str(labels)} {value}')
+        for (name, labels), (buckets, counts, count, total) in histograms:
+            head(name, 'histogram')
+            cumulative = 0
+            for le, n in zip(buckets, counts):
+                cumulative += n
+                lines.append(f'{self.prefix}{name}_bucket{label_str(labels + (("le", le),))} {cumulative}')
+            lines.append(f'{self.prefix}{name}_bucket{label_str(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{self.prefix}{name}_sum{label_str(labels)} {total}')
+            lines.append(f'{self.prefix}{name}_count{label_str(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        # A compact JSON friendly view: counters and gauges by name[label values], histograms as
+        # count, mean and max seconds.
+        def key_str(name, labels):
+            return name + ('[' + ','.join(str(v) for _, v in labels) + ']' if labels else '')
+
+        snap = {}
+        with self._lock:
+            for (name, labels), value in self.counters.items():
+                snap[key_str(name, labels)] = value
+            for (name, labels), hist in self.histograms.items():
+                snap[key_str(name, labels)] = {"count": hist.count,
+                                               "mean": round(hist.sum / hist.count, 6) if hist.count else 0.0,
+                                               "max": round(hist.max, 6)}
+        for (name, labels), value in self._gauge_values().items():
+            snap[key_str(name, labels)] = value
+        return snap
+
+
+class MetricsServer:
+    # Serves metrics.prometheus_text() on http://host:port/metrics from a daemon thread.
+
+    def __init__(self, metrics: Metrics, host: str = '127.0.0.1', port: int = 9108) -> None:
+        # only loaded when there is a server
+        import http.server
+        self.metrics = metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] != '/metrics':
+                    handler.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, fmt, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='metrics-http', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
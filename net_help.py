@@ -0,0 +1,599 @@
+# net_help.py
+# Network helpers used by pizero_mqtt_monitor.py.
+#
+# BrokerLink waits for the MQTT broker in the background with a TCP connect probe, so the monitor
+# can start sampling before the broker answers. tcp_no_delay turns Nagle's algorithm off on the
+# MQTT client's socket.
+#
+# get_ipv4_address finds this device's address with psutil. IfaceMonitor keeps it cached instead,
+# taking a fresh look only when an rtnetlink notification says a link or an address changed.
+# PollIfaceSource is the psutil fallback and FakeNetlinkSource stands in off-device.
+#
+# WiFi statistics are read without forking any processes. The preferred backend keeps one
+# generic netlink socket open to the kernel's nl80211 family and asks it for the station info,
+# which is the same data `iw dev wlan0 station dump` prints. /proc/net/wireless is the fallback.
+# IwWifiStats keeps the old subprocess pipeline around for comparison (see bench_help.py), and
+# FakeWifiStats stands in off-device.
+#
+import os
+import random
+import select
+import socket
+import struct
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+# signal_dbm: int dBm, connected_s: int seconds. Either may be None when not known.
+WifiStats = namedtuple('WifiStats', ['signal_dbm', 'connected_s'])
+
+# -- netlink plumbing
+NETLINK_ROUTE = 0
+NETLINK_GENERIC = 16
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+
+NLA_TYPE_MASK = 0x3fff
+
+NLMSG_HDR = struct.Struct('=IHHII')  # len, type, flags, seq, pid
+NLA_HDR = struct.Struct('=HH')  # len, type
+GENL_HDR = struct.Struct('=BBH')  # cmd, version, reserved
+
+GENL_ID_CTRL = 0x10
+CTRL_CMD_GETFAMILY = 3
+CTRL_ATTR_FAMILY_ID = 1
+CTRL_ATTR_FAMILY_NAME = 2
+
+NL80211_CMD_GET_STATION = 17
+NL80211_ATTR_IFINDEX = 3
+NL80211_ATTR_STA_INFO = 21
+NL80211_STA_INFO_SIGNAL = 7
+NL80211_STA_INFO_CONNECTED_TIME = 16
+
+
+def nl_align(n: int) -> int:
+    return (n + 3) & ~3
+
+
+def nl_attr(attr_type: int, data: bytes) -> bytes:
+    attr = NLA_HDR.pack(NLA_HDR.size + len(data), attr_type) + data
+    return attr + b'\0' * (nl_align(len(attr)) - len(attr))
+
+
+def nl_parse_attrs(data: bytes, offset: int = 0) -> dict:
+    # Returns {attr type: attr payload bytes}. Nested attributes are left as bytes.
+    attrs = {}
+    while offset + NLA_HDR.size <= len(data):
+        a_len, a_type = NLA_HDR.unpack_from(data, offset)
+        if a_len < NLA_HDR.size:
+            break
+        attrs[a_type & NLA_TYPE_MASK] = data[offset + NLA_HDR.size:offset + a_len]
+        offset += nl_align(a_len)
+    return attrs
+
+
+def nl_messages(buf: bytes):
+    # Yields (msg type, flags, seq, payload) for each netlink message in buf.
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(buf):
+        m_len, m_type, m_flags, m_seq, _ = NLMSG_HDR.unpack_from(buf, offset)
+        if m_len < NLMSG_HDR.size:
+            break
+        yield m_type, m_flags, m_seq, buf[offset + NLMSG_HDR.size:offset + m_len]
+        offset += nl_align(m_len)
+
+
+def nl_message(msg_type: int, flags: int, seq: int, payload: bytes) -> bytes:
+    return NLMSG_HDR.pack(NLMSG_HDR.size + len(payload), msg_type, flags, seq, 0) + payload
+
+
+def nl_transact(sock, msg_type: int, flags: int, seq: int, payload: bytes) -> list:
+    # Sends one request and collects the reply payloads. Dump requests are read until NLMSG_DONE,
+    # anything else until the first reply or ack. A netlink error is raised as OSError.
+    sock.send(nl_message(msg_type, flags | NLM_F_REQUEST, seq, payload))
+    replies = []
+    while True:
+        buf = sock.recv(65536)
+        for m_type, m_flags, m_seq, m_payload in nl_messages(buf):
+            if m_seq != seq:
+                continue
+            if m_type == NLMSG_DONE:
+                return replies
+            if m_type == NLMSG_ERROR:
+                err = struct.unpack_from('=i', m_payload)[0]
+                if err:
+                    raise OSError(-err, os.strerror(-err))
+                return replies
+            replies.append(m_payload)
+            if not flags & NLM_F_DUMP:
+                return replies
+
+
+# -- WiFi statistics backends
+class NetlinkWifiStats:
+    # Long-lived nl80211 socket. One read() is one request/response on an already open socket.
+
+    def __init__(self, interface: str = 'wlan0') -> None:
+        self.interface = interface
+        self.ifindex = socket.if_nametoindex(interface)
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_GENERIC)
+        self.sock.bind((0, 0))
+        self.sock.settimeout(2.0)
+        self.seq = 0
+        self.family_id = self._resolve_family('nl80211')
+
+    def _next_seq(self) -> int:
+        self.seq = (self.seq + 1) & 0xffffffff
+        return self.seq
+
+    def _resolve_family(self, name: str) -> int:
+        payload = GENL_HDR.pack(CTRL_CMD_GETFAMILY, 1, 0) + nl_attr(CTRL_ATTR_FAMILY_NAME, name.encode() + b'\0')
+        for reply in nl_transact(self.sock, GENL_ID_CTRL, 0, self._next_seq(), payload):
+            attrs = nl_parse_attrs(reply, GENL_HDR.size)
+            if CTRL_ATTR_FAMILY_ID in attrs:
+                return struct.unpack('=H', attrs[CTRL_ATTR_FAMILY_ID][:2])[0]
+        raise OSError(f'generic netlink family {name} not found')
+
+    def read(self) -> WifiStats:
+        payload = GENL_HDR.pack(NL80211_CMD_GET_STATION, 0, 0) + nl_attr(NL80211_ATTR_IFINDEX,
+                                                                         struct.pack('=I', self.ifindex))
+        for reply in nl_transact(self.sock, self.family_id, NLM_F_DUMP, self._next_seq(), payload):
+            attrs = nl_parse_attrs(reply, GENL_HDR.size)
+            if NL80211_ATTR_STA_INFO not in attrs:
+                continue
+            sta = nl_parse_attrs(attrs[NL80211_ATTR_STA_INFO])
+            signal = sta.get(NL80211_STA_INFO_SIGNAL)
+            ctm = sta.get(NL80211_STA_INFO_CONNECTED_TIME)
+            # A managed interface has one station, the access point.
+            return WifiStats(struct.unpack('=b', signal[:1])[0] if signal else None,
+                             struct.unpack('=I', ctm[:4])[0] if ctm else None)
+        return WifiStats(None, None)
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class ProcWifiStats:
+    # Signal level from /proc/net/wireless. The kernel does not expose the association time there,
+    # so connected time is counted from when this process first saw the link up (a lower bound)
+    # and restarted whenever sysfs carrier_changes moves.
+
+    def __init__(self, interface: str = 'wlan0',
+                 proc_file: str = '/proc/net/wireless',
+                 sys_dir: str = '/sys/class/net/') -> None:
+        self.interface = interface
+        self.proc_file = proc_file
+        self.carrier_file = os.path.join(sys_dir, interface, 'carrier_changes')
+        self._carrier_changes = None
+        self._up_since = None
+
+    def _signal(self):
+        with open(self.proc_file, 'r') as f:
+            for line in f:
+                name, sep, rest = line.partition(':')
+                if sep and name.strip() == self.interface:
+                    # status, link quality, signal level, noise, ...
+                    return int(float(rest.split()[2]))
+        return None
+
+    def _carrier(self):
+        try:
+            with open(self.carrier_file, 'r') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def read(self) -> WifiStats:
+        signal = self._signal()
+        now = time.monotonic()
+        changes = self._carrier()
+        if signal is None:
+            self._up_since = None
+        elif self._up_since is None or changes != self._carrier_changes:
+            self._up_since = now
+        self._carrier_changes = changes
+        connected = int(now - self._up_since) if self._up_since is not None else None
+        return WifiStats(signal, connected)
+
+    def close(self) -> None:
+        pass
+
+
+class IwWifiStats:
+    # The original `iw | grep | cut` pipelines. Two shells and about six processes per read.
+
+    def __init__(self, interface: str = 'wlan0') -> None:
+        self.interface = interface
+
+    def read(self) -> WifiStats:
+        strip = {ord(i): None for i in "\n\t"}
+        cmd = f"iw dev {self.interface} station dump | grep signal: | cut -d' ' -f3"
+        iw_dbm = subprocess.check_output(cmd, shell=True).decode("utf-8").translate(strip)
+        cmd = f"iw dev {self.interface} station dump | grep 'connected time' | cut -d' ' -f2 | cut -d'\t' -f2"
+        iw_ctm = subprocess.check_output(cmd, shell=True).decode("utf-8").translate(strip)
+        return WifiStats(int(iw_dbm) if iw_dbm else None, int(iw_ctm) if iw_ctm else None)
+
+    def close(self) -> None:
+        pass
+
+
+class FakeWifiStats:
+    # Off-device stand-in. Cycles through the given signal levels and counts connected time
+    # from creation.
+
+    def __init__(self, interface: str = 'wlan0', signals=(-52, -55, -61, -58)) -> None:
+        self.interface = interface
+        self.signals = list(signals)
+        self.n = 0
+        self.t0 = time.monotonic()
+
+    def read(self) -> WifiStats:
+        signal = self.signals[self.n % len(self.signals)] if self.signals else None
+        self.n += 1
+        return WifiStats(signal, int(time.monotonic() - self.t0))
+
+    def close(self) -> None:
+        pass
+
+
+wifi_backends = {
+    'netlink': NetlinkWifiStats,
+    'proc': ProcWifiStats,
+    'iw': IwWifiStats,
+    'fake': FakeWifiStats,
+}
+
+
+def wifi_stats_provider(interface: str = 'wlan0', backend: str = 'auto'):
+    # 'auto' tries nl80211 first and falls back to /proc/net/wireless.
+    if backend != 'auto':
+        return wifi_backends[backend](interface)
+    try:
+        return NetlinkWifiStats(interface)
+    except (OSError, AttributeError):
+        # AttributeError: no AF_NETLINK on this platform
+        return ProcWifiStats(interface)
+
+
+class BrokerLink:
+    # Probes host:port with a plain TCP connect until it answers, backing off exponentially with full
+    # jitter between attempts (a random wait between 0 and base_delay * 2**attempt, capped at
+    # max_delay). Once reachable, on_reachable() is called from the probe thread. If that raises
+    # OSError, for example the broker went away again before the MQTT connect, probing resumes.
+
+    def __init__(self,
+                 host: str,
+                 port: int = 1883,
+                 on_reachable=None,
+                 base_delay: float = 0.5,
+                 max_delay: float = 60.0,
+                 probe_timeout: float = 2.0
+                 ) -> None:
+        self.host = host
+        self.port = port
+        self.on_reachable = on_reachable
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.probe_timeout = probe_timeout
+        self.attempts = 0
+        self.reachable_at = None  # time.monotonic() of the first good probe
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def probe(self) -> bool:
+        try:
+            socket.create_connection((self.host, self.port), timeout=self.probe_timeout).close()
+            return True
+        except OSError as error:
+            self.last_error = error
+            return False
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0.0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='broker-link', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        failed = 0
+        while not self._stop.is_set():
+            self.attempts += 1
+            if self.probe():
+                if self.reachable_at is None:
+                    self.reachable_at = time.monotonic()
+                try:
+                    if self.on_reachable is not None:
+                        self.on_reachable()
+                    return
+                except OSError as error:
+                    self.last_error = error
+            self._stop.wait(self.backoff(failed))
+            failed += 1
+
+
+def tcp_no_delay(client) -> None:
+    # For a connected paho client, ie from on_connect. paho leaves Nagle's algorithm on, so once the
+    # broker is acknowledging qos 1 publishes each small PUBLISH can wait for the ack of the one
+    # before it, 20 to 40 ms with delayed acks (see bench_help.py mqtt).
+    sock = client.socket()
+    if sock is not None:
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (OSError, AttributeError):
+            # not a TCP socket, ie websockets
+            pass
+
+
+# -- this device's IPv4 address
+# An interface snapshot is {name: (rank, loopback, [IPv4 addresses])}. The address reported is the
+# first of interface when it has one, otherwise the first on the best ranked (up, then full duplex
+# or running) non-loopback interface, or "Off LAN".
+OFF_LAN = "Off LAN"
+
+
+def find_single_ipv4_address(addrs):
+    for addr in addrs:
+        if addr.family == socket.AddressFamily.AF_INET:  # IPv4
+            return addr.address
+
+
+def pick_address(ifaces: dict, interface_name: str = None) -> str:
+    if isinstance(interface_name, str) and interface_name in ifaces:
+        ips = ifaces[interface_name][2]
+        return ips[0] if ips else OFF_LAN
+    for rank, loopback, ips in sorted(ifaces.values(), key=lambda x: x[0], reverse=True):
+        if not loopback and ips:
+            return ips[0]
+    return OFF_LAN
+
+
+def psutil_ifaces() -> dict:
+    # imported here, with the rtnetlink source it is not needed at all
+    import psutil
+    if_addrs = psutil.net_if_addrs()
+    if_stats = psutil.net_if_stats()
+    ifaces = {}
+    for name, addrs in if_addrs.items():
+        stat = if_stats.get(name)
+        # duplex mode (full: 2, half: 1, unknown: 0)
+        rank = (stat.isup, stat.duplex) if stat is not None else (False, 0)
+        loopback = stat is not None and "loopback" in stat.flags
+        ips = [addr.address for addr in addrs if addr.family == socket.AddressFamily.AF_INET]
+        ifaces[name] = (rank, loopback, ips)
+    return ifaces
+
+
+def get_ipv4_address(interface_name=None):
+    return pick_address(psutil_ifaces(), interface_name)
+
+
+# rtnetlink
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+IFF_RUNNING = 0x40
+
+IFINFO_MSG = struct.Struct('=BxHiII')  # family, type, index, flags, change
+IFADDR_MSG = struct.Struct('=BBBBI')  # family, prefix length, flags, scope, index
+
+
+def rt_ifaces(links: list, addrs: list) -> dict:
+    # An interface snapshot from RTM_NEWLINK and RTM_NEWADDR payloads.
+    names = {}
+    for payload in links:
+        _, _, index, flags, _ = IFINFO_MSG.unpack_from(payload)
+        attrs = nl_parse_attrs(payload, IFINFO_MSG.size)
+        name = attrs.get(IFLA_IFNAME, b'').split(b'\0')[0].decode()
+        names[index] = (name, flags)
+    ifaces = {name: ((bool(flags & IFF_UP), bool(flags & IFF_RUNNING)), bool(flags & IFF_LOOPBACK), [])
+              for name, flags in names.values()}
+    for payload in addrs:
+        family, _, _, _, index = IFADDR_MSG.unpack_from(payload)
+        if family != socket.AF_INET or index not in names:
+            continue
+        attrs = nl_parse_attrs(payload, IFADDR_MSG.size)
+        raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+        if raw:
+            ifaces[names[index][0]][2].append(socket.inet_ntoa(raw[:4]))
+    return ifaces
+
+
+class NetlinkIfaceSource:
+    # One rtnetlink socket subscribed to the link and IPv4 address change groups, and one for
+    # dumping the current links and addresses when they change.
+
+    def __init__(self) -> None:
+        self.events = self._open(RTMGRP_LINK | RTMGRP_IPV4_IFADDR)
+        self.query = self._open(0)
+        self.query.settimeout(2.0)
+        self.seq = 0
+
+    def _open(self, groups: int):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        sock.bind((0, groups))
+        return sock
+
+    def dump(self, msg_type: int, payload: bytes) -> list:
+        self.seq = (self.seq + 1) & 0xffffffff
+        return nl_transact(self.query, msg_type, NLM_F_DUMP, self.seq, payload)
+
+    def snapshot(self) -> dict:
+        links = self.dump(RTM_GETLINK, IFINFO_MSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+        addrs = self.dump(RTM_GETADDR, IFADDR_MSG.pack(socket.AF_INET, 0, 0, 0, 0))
+        return rt_ifaces(links, addrs)
+
+    def wait(self, timeout: float) -> int:
+        # The link and address notifications received within timeout, 0 when none. A burst of
+        # them (ie DHCP renewing) is read in one go.
+        ready, _, _ = select.select([self.events], [], [], timeout)
+        n = 0
+        while ready:
+            try:
+                buf = self.events.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            n += sum(1 for m_type, _, _, _ in nl_messages(buf)
+                     if m_type in (RTM_NEWLINK, RTM_DELLINK, RTM_NEWADDR, RTM_DELADDR))
+        return n
+
+    def close(self) -> None:
+        self.events.close()
+        self.query.close()
+
+
+class PollIfaceSource:
+    # The fallback where there is no rtnetlink: psutil, looked at every wait, and no later than
+    # poll_int seconds whatever the monitor's resync_int, as no notification will come in between.
+    # close ends a wait at once, so the monitor is not held up for a whole resync_int when stopping.
+
+    def __init__(self, poll_int: float = 60.0) -> None:
+        self.poll_int = poll_int
+        self._closed = threading.Event()
+
+    def snapshot(self) -> dict:
+        return psutil_ifaces()
+
+    def wait(self, timeout: float) -> int:
+        if self._closed.wait(min(timeout, self.poll_int)):
+            return 0
+        return 1
+
+    def close(self) -> None:
+        self._closed.set()
+
+
+class FakeNetlinkSource(NetlinkIfaceSource):
+    # Off-device test double. The interfaces are kept here and turned into real RTM_NEWLINK and
+    # RTM_NEWADDR payloads for the snapshots, and changes are sent as netlink notifications through
+    # a socket pair, so the parsing and the event path are the ones used on the Pi.
+
+    def __init__(self, ifaces: dict = None) -> None:
+        # name -> [flags, [IPv4 addresses]]
+        self.ifaces = {name: [flags, list(ips)] for name, (flags, ips) in (ifaces or {
+            'lo': (IFF_UP | IFF_RUNNING | IFF_LOOPBACK, ['127.0.0.1']),
+            'wlan0': (IFF_UP | IFF_RUNNING, ['192.168.1.57']),
+        }).items()}
+        self.events, self._notify = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.query = None
+        self.seq = 0
+
+    def dump(self, msg_type: int, payload: bytes) -> list:
+        replies = []
+        for index, (name, (flags, ips)) in enumerate(self.ifaces.items(), start=1):
+            if msg_type == RTM_GETLINK:
+                replies.append(IFINFO_MSG.pack(socket.AF_UNSPEC, 1, index, flags, 0) +
+                               nl_attr(IFLA_IFNAME, name.encode() + b'\0'))
+            else:
+                for ip in ips:
+                    replies.append(IFADDR_MSG.pack(socket.AF_INET, 24, 0, 0, index) +
+                                   nl_attr(IFA_LOCAL, socket.inet_aton(ip)))
+        return replies
+
+    def set_iface(self, name: str, flags: int = IFF_UP | IFF_RUNNING, ips=()) -> None:
+        link_event = name not in self.ifaces or self.ifaces[name][0] != flags
+        old_ips = self.ifaces.get(name, [0, []])[1]
+        self.ifaces[name] = [flags, list(ips)]
+        msgs = b''
+        if link_event:
+            msgs += nl_message(RTM_NEWLINK, 0, 0, IFINFO_MSG.pack(socket.AF_UNSPEC, 1, 0, flags, 0))
+        for ip in set(old_ips) ^ set(ips):
+            msgs += nl_message(RTM_NEWADDR if ip in ips else RTM_DELADDR, 0, 0,
+                               IFADDR_MSG.pack(socket.AF_INET, 24, 0, 0, 0) + nl_attr(IFA_LOCAL, socket.inet_aton(ip)))
+        if msgs:
+            self._notify.send(msgs)
+
+    def close(self) -> None:
+        self.events.close()
+        self._notify.close()
+
+
+iface_sources = {
+    'netlink': NetlinkIfaceSource,
+    'poll': PollIfaceSource,
+    'fake': FakeNetlinkSource,
+}
+
+
+def iface_source(backend: str = 'auto', poll_int: float = 60.0):
+    # 'auto' tries rtnetlink first and falls back to polling psutil every poll_int seconds.
+    if backend == 'poll':
+        return PollIfaceSource(poll_int)
+    if backend != 'auto':
+        return iface_sources[backend]()
+    try:
+        return NetlinkIfaceSource()
+    except (OSError, AttributeError):
+        # AttributeError: no AF_NETLINK on this platform
+        return PollIfaceSource(poll_int)
+
+
+class IfaceMonitor:
+    # Keeps this device's address (see pick_address) from a source's snapshots, taking a new one
+    # only when the source reports a change, or every resync_int seconds in case a notification
+    # was missed (with the polling source that is how often psutil is looked at). on_change(address)
+    # is called from the monitor thread when the address changes, not on every look.
+
+    def __init__(self, source, interface_name: str = None, on_change=None, resync_int: float = 300.0) -> None:
+        self.source = source
+        self.interface_name = interface_name
+        self.on_change = on_change
+        self.resync_int = resync_int
+        self.address = None
+        self.counts = {'events': 0, 'snapshots': 0, 'changes': 0, 'errors': 0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self) -> bool:
+        # Takes a snapshot, True when the address changed.
+        try:
+            address = pick_address(self.source.snapshot(), self.interface_name)
+        except OSError:
+            self.counts['errors'] += 1
+            return False
+        self.counts['snapshots'] += 1
+        if address == self.address:
+            return False
+        self.address = address
+        self.counts['changes'] += 1
+        return True
+
+    def start(self) -> None:
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name='iface-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.counts['events'] += self.source.wait(self.resync_int)
+            except OSError:
+                self.counts['errors'] += 1
+                self._stop.wait(self.resync_int)
+            if self._stop.is_set():
+                break
+            if self.refresh() and self.on_change is not None:
+                self.on_change(self.address)
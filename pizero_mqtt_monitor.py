@@ -11,102 +11,97 @@
 # Apscheduler is also used to publish Availability MQTT posts at set time intervals for Homeassistant
 # to see.
 #
+# What is monitored is described by a config file, see pizero_mqtt_monitor.yaml and sens_registry.py.
+# Pins, topics, poll intervals and change-only publish deadbands are set there.
+#
+# Start up is staged: the MQTT client and broker probe first, so the LWT goes out as soon as the
+# broker answers, then the pin factory, then the devices, brought up concurrently with each
+# sensor's first reading published as soon as it is ready, then discovery and the scheduler. The
+# modules only some configs need (gpiozero's pigpio factory, apscheduler or asyncio, history,
+# discovery, commands) are imported by the stage that needs them. Each stage is timed and the
+# times are in the startup message.
+#
 # NOTE - coding for paho version 2.x. The python IDE and online information is not
 # currently up to date with the 2.x breaking changes. The same applies to some gpiozero classes.
 #
 import paho.mqtt.client as mqtt
 import json
 import datetime
-from datetime import timedelta
-import psutil
-import socket
-from collections import OrderedDict
-import sens_help
-# from gpiozero.pins.native import NativeFactory
-from gpiozero.pins.pigpio import PiGPIOFactory
-from gpiozero import Device
-from gpiozero import MotionSensor
-from gpiozero import Button
-from gpiozero import LightSensor
-from gpiozero import LED
-from apscheduler.schedulers.background import BlockingScheduler
+import sens_registry
+import net_help
+import pub_help
+import metrics_help
 import time
+import os
 import argparse
-import subprocess
+import threading
+import traceback
 
-# setting the default pin_factory to be the enhanced pigpio
-# note: the pigpiod daemon must be running as a service
-# ie sudo systemctl enable pigpiod
-# Device.pin_factory = NativeFactory()
-Device.pin_factory = PiGPIOFactory()
-
-monitor_schedule = BlockingScheduler()
+# The apscheduler BlockingScheduler in the threads runtime, set by device_setups()
+monitor_schedule = None
 
 # The PIR motion sensor takes about 60 sec. to stabilize. Just in case it has
 # not warmed up during the Pizero boot time, st_t is used to wait at least 60
 # seconds after st_t.
 st_t = time.monotonic()
 
-mqtt_broker_url = "192.168.1.110"
-this_hostname = "raspberrypi-z01"
-this_dev = "pizero-z01"
+# Start up phase times, seconds from st_t
+startup = metrics_help.StartupTimer(st_t)
+startup_lock = threading.Lock()
+startup_sent = False
+
 en_out = False  # enable output for debug purposes
 
-# Establish a client_id
-client_id = this_hostname
-
-network_interface_name = None
-
-# set topics for each sensor
-tp_this_dev = 'rpiz01/garage/'
-tp_avail_st = tp_this_dev + 'LWT'
-tp_dr_state = tp_this_dev + 'garage_dr'
-tp_temp = tp_this_dev + 'temperature'
-tp_lt = tp_this_dev + 'lightsensed'
-tp_pir_motion = tp_this_dev + 'pir_motion'
-tp_cpu_t_state = tp_this_dev + 'cpu_temperature'
-tp_pir_a_activity = tp_this_dev + 'pir_a_activity'
-tp_pir_b_activity = tp_this_dev + 'pir_b_activity'
-tp_wifi = tp_this_dev + 'wifi'
-tp_device_ip = tp_this_dev + 'device_ip'
-
-# Default data gpio numbers.
-# Note: The temp sensor is 1-wire. 1-wire data is set up outside the program.
-dp_lt = 23  # LDR
-dp_pir_a = 24  # PIR A
-dp_pir_b = 11  # PIR B
-dp_dr = 27  # Door (a reed switch seeing a strong magnet)
-dp_wifi_state_led = 20   # wifi state LED pin
-
-# Default pir_a settings
-pir_a_queue_len = 1
-pir_a_poll_rate = 10
-pir_a_thresh = 0.5
-
-# Default pir_b settings
-pir_b_queue_len = 1
-pir_b_poll_rate = 10
-pir_b_thresh = 0.5
-
-# Default poll rate seconds
-df_ds18x20_poll_int: int = 60
-df_garage_dr_poll_int: int = 60
-df_ldr_poll_int: int = 66
-df_pizero_cpu_poll_int: int = 30
-df_pir_a_poll_int: int = 90
-df_pir_b_poll_int: int = 90
-df_still_alive_int: int = 62
-df_iw_int: int = 60
+# The config file used when -c is not given. Without it the sens_registry defaults are used.
+df_config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pizero_mqtt_monitor.yaml')
+
+# Set from the config by monitor_setups()
+cfg = None
+mqtt_broker_url = None
+this_dev = None
+client_id = None
+tp_avail_st = None
+tp_startup = None
+mqttc = None
+pub_queue = None
+broker_link = None
+registry = None
+discovery = None
+history = None
+history_server = None
+commands = None
+governor = None
+metrics = None
+tp_diagnostics = None
+simulation = None
+# Set by monitor_setups() in the asyncio runtime
+aio_loop = None
+aio_mqtt = None
+# job id -> (function, asyncio task) of the polling jobs, set by run_async()
+aio_jobs = {}
+# Set by planned_jobs() when the jobs are spread
+phase_sched = None
+# mids of the paho publishes not yet sent (qos 0) or acknowledged (qos 1, 2), for the in-flight
+# count, and of those paho reported done before their publish call returned
+inflight_mids = set()
+early_mids = set()
+inflight_lock = threading.Lock()
 
 
 def process_any_arguments() -> None:
     """
     Process any command line arguments
     """
-    global en_out
+    global en_out, cfg
 
     prsr = argparse.ArgumentParser(description='Process command line settings.')
     prsr.add_argument('-d', action='store_true', help='Intended for debug purposes.')
+    prsr.add_argument('-c', metavar='CONFIG', default=None,
+                      help='Sensor config file (.yaml, .toml or .json).')
+    prsr.add_argument('-s', action='store_true',
+                      help='Simulate the hardware and broker, see sim_help.py.')
+    prsr.add_argument('-a', action='store_true',
+                      help='Run on an asyncio event loop instead of threads, see async_help.py.')
 
     args = prsr.parse_args()
     en_out = args.d
@@ -114,6 +109,16 @@ def process_any_arguments() -> None:
         print(f'\nNot reporting the MQTT message events to the console.')
         print(f'Use the -d argument to see reporting events to the console.')
 
+    config_file = args.c
+    if config_file is None and os.path.exists(df_config_file):
+        config_file = df_config_file
+    cfg = sens_registry.load_config(config_file)
+    do_msg(f'Using config {config_file or "defaults"}')
+    if args.s:
+        cfg['simulate']['enabled'] = True
+    if args.a:
+        cfg['runtime']['mode'] = 'asyncio'
+
 
 def do_msg(msg):
     if en_out:
@@ -125,6 +130,8 @@ def on_connect(client, userdata, flags, reason_code, properties):
     if reason_code == 0:
         # success connecting
         do_msg(f'\nMQTT Broker {mqtt_broker_url} connected with result code {str(reason_code)}')
+        if cfg['mqtt']['no_delay']:
+            net_help.tcp_no_delay(client)
 
         # Subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed. But this applies to what this client
@@ -133,355 +140,533 @@ def on_connect(client, userdata, flags, reason_code, properties):
         # Update mqttc availability
         rpt_online(client, tp_avail_st)
         do_msg(f'MQTT subscribed as {this_dev}\n')
+        pub_queue.on_connect(properties)
+        if discovery is not None:
+            discovery.on_connect(client)
+        if history_server is not None:
+            client.subscribe(history_server.request_topic, qos=1)
+        if commands is not None:
+            client.subscribe(commands.request_topic, qos=1)
+        startup.mark('broker_connected_s')
+        rpt_startup(client)
+
+
+# The version2 callback for a lost connection, the broker forgets the topic aliases
+def on_disconnect(client, userdata, flags, reason_code, properties):
+    pub_queue.on_disconnect()
 
 
 def rpt_online(client, tp):
     client.publish(topic=tp, payload='online', qos=0)
 
 
-# Create MQTT mqttc instance and connect it to Broker
-mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)  # breaking change in paho version 2.0
-# Set on_connect callback function to ensure broker accepted mqttc connection
-mqttc.on_connect = on_connect
-# Set last will and testament message (required before .connect)
-mqttc.will_set(topic=tp_avail_st, payload='offline', qos=0)
+def publish(topic, payload, retain=True, qos=0):
+    startup.mark('first_sample_s')
+    pub_queue.publish(topic=topic, payload=payload, retain=retain, qos=qos)
 
-do_msg(f'\nChecking for reachable mqtt broker at {mqtt_broker_url}')
 
-while not sens_help.is_host_reachable(mqtt_broker_url):
-    try:
-        do_msg(f'... Checking again for reachable {mqtt_broker_url}')
-    except KeyboardInterrupt:
-        do_msg(f'Stopping due to [Ctrl + C]')
-
-do_msg(f'Ok, {mqtt_broker_url} is reachable.')
-do_msg(f'\nAttempting MQTT Broker connection to {mqtt_broker_url}')
-
-# Now connect.
-mqttc.connect(host=mqtt_broker_url, port=1883, keepalive=90)
-
-# set the sensor objects
-ds18x20 = sens_help.TheDS18x20()
-ds18x20_poll_int = df_ds18x20_poll_int
-
-# wifi state LED
-wifi_LED = LED(dp_wifi_state_led)
-wifi_LED.off()
-
-# The apscheduler and gpiozero events will be used for the garage dr.
-garage_dr_sens = Button(pin=dp_dr,
-                        pull_up=None,
-                        active_state=False,
-                        bounce_time=0.25
-                        )
-garage_dr_poll_int = df_garage_dr_poll_int
-# The apscheduler and gpiozero events will be used for the PIR motion detectors.
-pir_a = MotionSensor(pin=dp_pir_a,
-                     pull_up=None,
-                     queue_len=pir_a_queue_len,
-                     active_state=True,
-                     sample_rate=pir_a_poll_rate,
-                     threshold=pir_a_thresh,
-                     partial=False
-                     )
-pir_a_poll_int = df_pir_a_poll_int
-
-pir_b = MotionSensor(pin=dp_pir_b,
-                     pull_up=None,
-                     queue_len=pir_b_queue_len,
-                     active_state=True,
-                     sample_rate=pir_b_poll_rate,
-                     threshold=pir_b_thresh,
-                     partial=False
-                     )
-pir_b_poll_int = df_pir_b_poll_int
-
-ldr = LightSensor(pin=dp_lt,
-                  queue_len=5,
-                  charge_time_limit=0.01,
-                  threshold=0.1,
-                  partial=False
-                  )
-ldr_poll_int = df_ldr_poll_int
-
-pizero_cpu = sens_help.CPUTempState(threshold=80.0, event_delay=10.0)
-pizero_cpu_poll_int = df_pizero_cpu_poll_int
+# The version2 callback for when a message has been sent (qos 0) or acknowledged (qos 1, 2).
+def on_publish(client, userdata, mid, reason_code, properties):
+    with inflight_lock:
+        if mid in inflight_mids:
+            inflight_mids.discard(mid)
+        else:
+            early_mids.add(mid)
 
 
-def snd_still_alive():
-    rpt_online(mqttc, tp_avail_st)
-    if en_out:
-        print(f'\nsnd_still_alive published {tp_avail_st} as online - {datetime.datetime.now()}\n')
+def tracked_publish(client_publish):
+    # Wraps mqttc.publish so every publisher, the publish queue, discovery, the LWT and startup
+    # reports, has its message counted in flight until on_publish. paho keeps qos 1 and 2 messages
+    # published while disconnected and sends them on reconnect; qos 0 ones it drops.
+    def publish(topic, payload=None, qos=0, retain=False, properties=None):
+        info = client_publish(topic, payload=payload, qos=qos, retain=retain, properties=properties)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS or (qos and info.rc == mqtt.MQTT_ERR_NO_CONN):
+            with inflight_lock:
+                if info.mid in early_mids:
+                    early_mids.discard(info.mid)
+                else:
+                    inflight_mids.add(info.mid)
+        return info
+    return publish
 
 
-def snd_pizero_cpu_state():
-    try:
-        pizero_cpu_state = pizero_cpu.cpu_temp_state()
-        if en_out:
-            print(f'Pizero CPU: {pizero_cpu_state} - {datetime.datetime.now()}')
-
-        # payload
-        pizero_cpu_pld = {
-            "time": datetime.datetime.now(),
-            "client_id": client_id,
-            "cpu_temp_c": pizero_cpu_state[0],
-            "cpu_hot": pizero_cpu_state[1]
-        }
-        # payload to JSON
-        pld_pizero_cpu = json.dumps(pizero_cpu_pld, default=str)
-        mqttc.publish(topic=tp_cpu_t_state, payload=pld_pizero_cpu, retain=True, qos=0)
-
-    except Exception as error:
-        do_msg("Exception error reading dr state.")
-        raise error
-
-
-def snd_ip():
-    try:
-        device_ip = get_ip(network_interface_name)
-        if en_out:
-            print(f'This ip: {device_ip} F - {datetime.datetime.now()}')
+def on_publish_result(rc, seconds):
+    # Called by pub_queue after every mqttc.publish
+    metrics.observe('publish_seconds', seconds)
+    if rc != mqtt.MQTT_ERR_SUCCESS:
+        metrics.inc('publish_failed_total', {'rc': rc})
 
-        # payload
-        ip_pld = {
-            "time": datetime.datetime.now(),
-            "device_ip": device_ip
-        }
-        # payload to JSON
-        pld_ip = json.dumps(ip_pld, default=str)
-        mqttc.publish(topic=tp_device_ip, payload=pld_ip, retain=True, qos=0)
 
-    except Exception as error:
-        do_msg("Exception error reading ip address.")
-        raise error
+def on_job_event(event):
+    from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_ERROR
+    if event.code == EVENT_JOB_MISSED:
+        metrics.inc('job_misfires_total', {'job': event.job_id})
+    elif event.code == EVENT_JOB_MAX_INSTANCES:
+        metrics.inc('job_max_instances_total', {'job': event.job_id})
+    elif event.code == EVENT_JOB_ERROR:
+        metrics.inc('job_scheduler_errors_total', {'job': event.job_id})
 
 
-def snd_temp():
-    try:
-        ds18x20_temp = ds18x20.read_temp_f()
-        if en_out:
-            print(f'Temperature: {ds18x20_temp} F - {datetime.datetime.now()}')
-
-        # payload
-        temp_pld = {
-            "time": datetime.datetime.now(),
-            "client_id": client_id,
-            "temperature": ds18x20_temp,
-            "temp_unit": "F"
-        }
-        # payload to JSON
-        pld_temp = json.dumps(temp_pld, default=str)
-        mqttc.publish(topic=tp_temp, payload=pld_temp, retain=True, qos=0)
-
-    except Exception as error:
-        do_msg("Exception error reading temperature.")
-        raise error
-
-
-def snd_dr_state():
-    try:
-        if garage_dr_sens.is_active:
-            rd_dr_state = "closed"
-        else:
-            rd_dr_state = "open"
-        if en_out:
-            print(f'Garage dr: {rd_dr_state} - {datetime.datetime.now()}')
-
-        # payload
-        dr_state_pld = {
-            "time": datetime.datetime.now(),
-            "client_id": client_id,
-            "garage_dr": rd_dr_state
-        }
-        # payload to JSON
-        pld_dr_state = json.dumps(dr_state_pld, default=str)
-        mqttc.publish(topic=tp_dr_state, payload=pld_dr_state, retain=True, qos=0)
-
-    except Exception as error:
-        do_msg("Exception error reading dr state.")
-        raise error
-
-
-def snd_lt_sense():
-    try:
-        rd_lt_sensed_s = ldr.light_detected
-        rd_lt_sensed_v = ldr.value
-        if en_out:
-            print(f'Light Sensed: {rd_lt_sensed_s} - {datetime.datetime.now()}')
-
-        # payload
-        lt_sensed_pld = {
-            "time": datetime.datetime.now(),
-            "client_id": client_id,
-            "light_sensed_state": rd_lt_sensed_s,
-            "light_sensed_value": rd_lt_sensed_v
-        }
-        # payload to JSON
-        pld_lt_sensed = json.dumps(lt_sensed_pld, default=str)
-        mqttc.publish(topic=tp_lt, payload=pld_lt_sensed, retain=True, qos=0)
-
-    except Exception as error:
-        do_msg("Exception error reading light_sensed.")
-        raise error
-
-
-def snd_pir_a_state():
-    try:
-        if timedelta(seconds=time.monotonic() - st_t).total_seconds() > 60.0:
-            if en_out:
-                print(f'Garage PIR_A motion: {pir_a.is_active} - {datetime.datetime.now()}')
-
-            # payload
-            motion_pld = {
-                "time": datetime.datetime.now(),
-                "client_id": client_id,
-                "motion": pir_a.value,
-                "detected": pir_a.is_active
-            }
-            # payload to JSON
-            pld_pir_activity = json.dumps(motion_pld, default=str)
-            mqttc.publish(topic=tp_pir_a_activity, payload=pld_pir_activity, retain=True, qos=0)
-
-    except Exception as error:
-        do_msg("Exception error reading PIR state.")
-        raise error
-
-
-def snd_pir_b_state():
-    try:
-        if timedelta(seconds=time.monotonic() - st_t).total_seconds() > 60.0:
-            if en_out:
-                print(f'Garage PIR_B motion: {pir_b.is_active} - {datetime.datetime.now()}')
-
-            # payload
-            motion_pld = {
-                "time": datetime.datetime.now(),
-                "client_id": client_id,
-                "motion": pir_b.value,
-                "detected": pir_b.is_active
-            }
-            # payload to JSON
-            pld_pir_activity = json.dumps(motion_pld, default=str)
-            mqttc.publish(topic=tp_pir_b_activity, payload=pld_pir_activity, retain=True, qos=0)
-
-    except Exception as error:
-        do_msg("Exception error reading PIR state.")
-        raise error
-
-
-def snd_wifi_strength():
-    try:
-        # CalledProcessError
-        # wifi signal dBm
-        cmd = "iw dev wlan0 station dump | grep signal: | cut -d' ' -f3"
-        iw_dbm = subprocess.check_output(cmd, shell=True).decode("utf-8").translate({ord(i): None for i in "\n\t"})
-        # wifi connected time seconds
-        cmd = "iw dev wlan0 station dump | grep 'connected time' | cut -d' ' -f2 | cut -d'\t' -f2"
-        iw_ctm = subprocess.check_output(cmd, shell=True).decode("utf-8").translate({ord(i): None for i in "\n\t"})
-
-        if en_out:
-            print(f'WiFi signal strength: {iw_dbm} dBm')
-            print(f'WiFi connected time: {iw_ctm} seconds')
-
-        # payload
-        iw_pld = {
-            "time": datetime.datetime.now(),
-            "client_id": client_id,
-            "iw_dbm": iw_dbm,
-            "iw_ctm": iw_ctm
-        }
-        # payload to JSON
-        pld_wifi = json.dumps(iw_pld, default=str)
-        mqttc.publish(topic=tp_wifi, payload=pld_wifi, retain=True, qos=0)
-
-    except subprocess.CalledProcessError as error:
-        do_msg("Exception error reading wifi state.")
-        raise error
-
-
-# -- functions for getting ip address
-def find_single_ipv4_address(addrs):
-    for addr in addrs:
-        if addr.family == socket.AddressFamily.AF_INET:  # IPv4
-            return addr.address
-
-
-def get_ipv4_address(interface_name=None):
-    if_addrs = psutil.net_if_addrs()
-
-    if isinstance(interface_name, str) and interface_name in if_addrs:
-        addrs = if_addrs.get(interface_name)
-        address = find_single_ipv4_address(addrs)
-        return address if isinstance(address, str) else "Off LAN"
-    else:
-        if_stats = psutil.net_if_stats()
-        # remove loopback
-        if_stats_filtered = {key: if_stats[key] for key, stat in if_stats.items() if "loopback" not in stat.flags}
-        # sort interfaces by
-        # 1. Up/Dow
-        # 2. Duplex mode (full: 2, half: 1, unknown: 0)
-        if_names_sorted = [stat[0] for stat in
-                           sorted(if_stats_filtered.items(), key=lambda x: (x[1].isup, x[1].duplex), reverse=True)]
-        if_addrs_sorted = OrderedDict((key, if_addrs[key]) for key in if_names_sorted if key in if_addrs)
-
-        for _, addrs in if_addrs_sorted.items():
-            address = find_single_ipv4_address(addrs)
-            if isinstance(address, str):
-                return address
-
-        return "Off LAN"
-
-
-def get_ip(netwrk_int_name):
-    ip_state = get_ipv4_address(netwrk_int_name)
-    if ip_state == 'Off LAN':
-        wifi_LED.off()
-    else:
-        wifi_LED.blink(1,4)
-    return "%s" % ip_state
+def on_job_missed(job_id, n):
+    # The asyncio runtime's misfires, see async_help.periodic
+    if metrics is not None:
+        metrics.inc('job_misfires_total', {'job': job_id}, n)
 
 
-def startup_reads():
-    snd_temp()
-    snd_dr_state()
-    snd_pizero_cpu_state()
-    snd_lt_sense()
-    snd_wifi_strength()
+def on_job_error(job_id, error):
+    print(f'Job {job_id} raised')
+    traceback.print_exception(type(error), error, error.__traceback__)
+    if metrics is not None:
+        metrics.inc('job_scheduler_errors_total', {'job': job_id})
 
 
-def device_setups():
-    # Register the gpiozero state change callbacks.
-    pir_a.when_activated = snd_pir_a_state
-    pir_a.when_deactivated = snd_pir_a_state
-    pir_b.when_activated = snd_pir_b_state
-    pir_b.when_deactivated = snd_pir_b_state
-    garage_dr_sens.when_activated = snd_dr_state
-    garage_dr_sens.when_deactivated = snd_dr_state
-    ldr.when_dark = snd_lt_sense
-    ldr.when_light = snd_lt_sense
-
-    # Setup polling schedule
-    monitor_schedule.add_job(snd_temp, 'interval', seconds=ds18x20_poll_int)
-    monitor_schedule.add_job(snd_dr_state, 'interval', seconds=garage_dr_poll_int)
-    monitor_schedule.add_job(snd_pizero_cpu_state, 'interval', seconds=pizero_cpu_poll_int)
-    monitor_schedule.add_job(snd_lt_sense, 'interval', seconds=ldr_poll_int)
-    monitor_schedule.add_job(snd_pir_a_state, 'interval', seconds=pir_a_poll_int)
-    monitor_schedule.add_job(snd_pir_b_state, 'interval', seconds=pir_b_poll_int)
-    monitor_schedule.add_job(snd_wifi_strength, 'interval', seconds=df_iw_int)
-    monitor_schedule.add_job(snd_ip, 'interval', seconds=df_iw_int)
+def metrics_setups():
+    """
+    Instrument the jobs, the state change callbacks and every mqttc.publish.
+    """
+    global metrics, tp_diagnostics
+
+    metrics = metrics_help.Metrics()
+    metrics.describe('job_seconds', 'Run time of each polling job and state change callback.')
+    metrics.describe('publish_seconds', 'Time spent in mqttc.publish.')
+    metrics.describe('mqtt_inflight', 'Messages handed to paho and not yet sent or acknowledged.')
+    metrics.describe('governor_stretch', 'How many times its configured interval each governor tier runs at.')
+    metrics.describe('door_edges', 'Door edge capture counts, edge to publish latency and settle times (ms).')
+    tp_diagnostics = cfg['device']['topic_prefix'] + cfg['metrics']['topic']
+    registry.instrument = lambda name, fn: metrics.timed('job_seconds', fn, {'job': name})
+    pub_queue.observer = on_publish_result
+    mqttc.on_publish = on_publish
+    mqttc.publish = tracked_publish(mqttc.publish)
+    metrics.set('mqtt_inflight', lambda: len(inflight_mids))
+    metrics.set('mqtt_connected', lambda: int(mqttc.is_connected()))
+    metrics.set('publish_backlog', pub_queue.backlog)
+    for event in pub_queue.counts:
+        metrics.set('publish_queue_events', lambda event=event: pub_queue.counts[event], {'event': event})
+    if pub_queue.properties is not None:
+        # MQTT v5 publishes sent with the topic alias alone or with the full topic
+        for form in pub_queue.properties.counts:
+            metrics.set('publish_topic_form', lambda form=form: pub_queue.properties.counts[form], {'form': form})
+    if history is not None:
+        for event in history.counts:
+            metrics.set('history_events', lambda event=event: history.counts[event], {'event': event})
+        for event in history_server.counts:
+            metrics.set('history_queries', lambda event=event: history_server.counts[event], {'event': event})
+    if commands is not None:
+        for event in commands.counts:
+            metrics.set('command_events', lambda event=event: commands.counts[event], {'event': event})
+    for result in ('sent', 'suppressed'):
+        metrics.set('filter_readings', lambda result=result: registry.pub_filter.totals()[result],
+                    {'result': result})
+    metrics.set('uptime_seconds', lambda: round(time.monotonic() - st_t, 1))
+    metrics.set('process_resident_kb', lambda: metrics_help.proc_status()['rss_kb'])
+    metrics.set('process_threads', lambda: metrics_help.proc_status()['threads'])
+
+
+def snd_diagnostics():
+    diag_pld = {
+        "time": datetime.datetime.now(),
+        "client_id": client_id
+    }
+    diag_pld.update(metrics.snapshot())
+    publish(topic=tp_diagnostics, payload=json.dumps(diag_pld, default=str), retain=False, qos=0)
+
+
+def rpt_startup(client):
+    # Published once, when both the broker is connected and the devices are up.
+    global startup_sent
+    with startup_lock:
+        if startup_sent or 'devices_up_s' not in startup.marks or not client.is_connected():
+            return
+        startup_sent = True
+    if broker_link.reachable_at is not None:
+        startup.marks['broker_reachable_s'] = round(broker_link.reachable_at - st_t, 3)
+    startup_stats = startup.report()
+    startup_pld = {
+        "time": datetime.datetime.now(),
+        "client_id": client_id,
+        "probe_attempts": broker_link.attempts,
+        "runtime": cfg['runtime']['mode']
+    }
+    startup_pld.update(startup_stats)
+    startup_pld.update(metrics_help.proc_status())
+    do_msg(f'Startup: {startup_stats}')
+    client.publish(topic=tp_startup, payload=json.dumps(startup_pld, default=str), retain=True, qos=0)
+
+
+def connect_broker():
+    do_msg(f'Ok, {mqtt_broker_url} is reachable.')
+    do_msg(f'\nAttempting MQTT Broker connection to {mqtt_broker_url}')
+    mqttc.connect(host=mqtt_broker_url, port=cfg['mqtt']['port'], keepalive=cfg['mqtt']['keepalive'])
+    mqttc.loop_start()
 
+
+def local_path(path):
+    # Relative paths in the config are taken from where this file is.
+    if path and not os.path.isabs(path):
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return path
+
+
+def simulation_setups():
+    """
+    In simulation start the sim_help broker and sysfs stand-ins, with the config pointed at them.
+    """
+    global simulation
+
+    if cfg['simulate']['enabled']:
+        import sim_help
+        simulation = sim_help.Simulation(cfg)
+        simulation.start()
+        do_msg(f'Simulating, broker on {simulation.broker.host}:{simulation.broker.port}')
+
+
+def pin_factory_setups():
+    """
+    Set the gpiozero pin factory, a MockFactory in simulation.
+    """
+    from gpiozero import Device
+
+    if simulation is not None:
+        Device.pin_factory = simulation.factory
+        return
+    # setting the default pin_factory to be the enhanced pigpio
+    # note: the pigpiod daemon must be running as a service
+    # ie sudo systemctl enable pigpiod
+    # from gpiozero.pins.native import NativeFactory
+    # Device.pin_factory = NativeFactory()
+    from gpiozero.pins.pigpio import PiGPIOFactory
+    Device.pin_factory = PiGPIOFactory()
+
+
+def monitor_setups():
+    """
+    Create the MQTT client, the publish queue, the broker reachability probe and the sensor
+    registry from the config.
+    """
+    global mqtt_broker_url, this_dev, client_id, tp_avail_st, tp_startup
+    global mqttc, pub_queue, broker_link, registry, discovery, aio_loop, aio_mqtt
+    global history, history_server, commands
+
+    mqtt_broker_url = cfg['mqtt']['broker']
+    this_dev = cfg['device']['name']
+    client_id = cfg['device']['client_id']
+    tp_this_dev = cfg['device']['topic_prefix']
+    pub_cfg = cfg['publish']
+    tp_avail_st = tp_this_dev + pub_cfg['avail_topic']
+    tp_startup = tp_this_dev + pub_cfg['startup_topic']
+
+    # Create MQTT mqttc instance
+    v5 = pub_help.protocol_v5(cfg['mqtt'])
+    mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id,  # breaking change in paho version 2.0
+                        protocol=mqtt.MQTTv5 if v5 else mqtt.MQTTv311)
+    # Set on_connect callback function to ensure broker accepted mqttc connection
+    mqttc.on_connect = on_connect
+    mqttc.on_disconnect = on_disconnect
+    # qos 1 and 2 messages awaiting their acknowledgement, then queued in paho up to max_mem, past
+    # that they are left to the publish queue
+    mqttc.max_inflight_messages_set(cfg['mqtt']['max_inflight'])
+    mqttc.max_queued_messages_set(pub_cfg['max_mem'])
+    # Set last will and testament message (required before .connect)
+    mqttc.will_set(topic=tp_avail_st, payload='offline', qos=0)
+
+    # Readings taken while the broker is not connected are queued and replayed on connect. Past
+    # max_mem readings the oldest are spooled to the SD card, up to max_disk_bytes.
+    pub_queue = pub_help.PublishQueue(mqttc,
+                                      spool_dir=local_path(pub_cfg['spool_dir']),
+                                      max_mem=pub_cfg['max_mem'],
+                                      max_disk_bytes=pub_cfg['max_disk_bytes'],
+                                      replay_rate=pub_cfg['replay_rate']
+                                      )
+
+    on_reachable = connect_broker
+    registry = sens_registry.SensorRegistry(cfg, publish, log=do_msg, st_t=st_t)
+    if v5:
+        pub_queue.properties = pub_help.PublishProperties(registry.policy.expiry)
+    registry.verbose = en_out
+
+    if cfg['runtime']['mode'] == 'asyncio':
+        import asyncio
+        import async_help
+        aio_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(aio_loop)
+        aio_mqtt = async_help.AsyncioMqtt(mqttc, aio_loop)
+        on_reachable = lambda: aio_mqtt.connect(mqtt_broker_url, port=cfg['mqtt']['port'],
+                                                keepalive=cfg['mqtt']['keepalive'])
+        registry.edge_runner = lambda fn: async_help.to_loop(aio_loop, fn)
+
+    # The broker is waited for in the background, sensor sampling does not wait on it.
+    broker_link = net_help.BrokerLink(mqtt_broker_url, port=cfg['mqtt']['port'], on_reachable=on_reachable)
+
+    # Home Assistant MQTT discovery, published on connect
+    disc_cfg = cfg['discovery']
+    if disc_cfg['enabled']:
+        import ha_help
+        discovery = ha_help.DiscoveryPublisher(registry,
+                                               avail_topic=tp_avail_st,
+                                               device_name=this_dev,
+                                               prefix=disc_cfg['prefix'],
+                                               state_file=local_path(disc_cfg['state_file']),
+                                               log=do_msg
+                                               )
+        mqttc.message_callback_add(discovery.status_topic, discovery.on_ha_status)
+
+    # Every published reading is kept on the device too, for backfilling gaps on request
+    hist_cfg = cfg['history']
+    if hist_cfg['enabled']:
+        import history_help
+        history = history_help.TimeSeriesRing(local_path(hist_cfg['file']), size_bytes=hist_cfg['size_kb'] * 1024)
+        registry.recorder = lambda topic, values, when: history.append(topic, values,
+                                                                       when.timestamp() if when else None)
+        history_server = history_help.HistoryServer(history, publish,
+                                                    topic_prefix=tp_this_dev,
+                                                    topic=hist_cfg['topic'],
+                                                    chunk=hist_cfg['chunk'],
+                                                    max_rows=hist_cfg['max_rows'],
+                                                    log=print
+                                                    )
+        mqttc.message_callback_add(history_server.request_topic, history_server.on_request)
+
+    # Live changes sent to the command topic, see cmd_help.py
+    cmd_cfg = cfg['command']
+    if cmd_cfg['enabled']:
+        import cmd_help
+        commands = cmd_help.CommandChannel(registry, publish,
+                                           topic_prefix=tp_this_dev,
+                                           topic=cmd_cfg['topic'],
+                                           rate=cmd_cfg['rate'],
+                                           burst=cmd_cfg['burst'],
+                                           max_queue=cmd_cfg['max_queue'],
+                                           min_interval=cmd_cfg['min_interval'],
+                                           reschedule=set_interval,
+                                           set_debug=set_debug,
+                                           log=print
+                                           )
+        mqttc.message_callback_add(commands.request_topic, commands.on_request)
+
+    if cfg['metrics']['enabled']:
+        metrics_setups()
+
+
+def snd_still_alive():
+    rpt_online(mqttc, tp_avail_st)
+    if en_out:
+        print(f'\nsnd_still_alive published {tp_avail_st} as online - {datetime.datetime.now()}')
+        print(f'Change-only publishing: {registry.pub_filter.totals()}')
+        if phase_sched is not None:
+            print(f'Schedule: {phase_sched.report()}')
+        print()
+
+
+def scheduled_jobs():
+    # [(job id, function, interval seconds), ...]
+    jobs = list(registry.jobs())
     # A patch keeping the LWT 'online'. The mqtt broker marks the subscription offline when
     # the pizero takes too long to wifi reconnect after it happens to lose wifi service. There
     # might be other reasons why the broker marks the subscription offline.
-    monitor_schedule.add_job(snd_still_alive, 'interval', seconds=df_still_alive_int)
+    jobs.append(('still_alive', snd_still_alive, cfg['publish']['still_alive_int']))
+    if metrics is not None and cfg['metrics']['publish_int']:
+        jobs.append(('diagnostics', snd_diagnostics, cfg['metrics']['publish_int']))
+    if history is not None:
+        jobs.append(('history_flush', history.flush, cfg['history']['flush_int']))
+    if governor is not None:
+        for job_id, _, seconds in jobs:
+            governor.add(job_id, seconds)
+        jobs.append(('governor', governor.evaluate, cfg['governor']['interval']))
+    return jobs
+
+
+def planned_jobs():
+    """
+    The scheduled jobs with their first run, seconds from now. Spread over their intervals by a
+    sched_help.PhaseScheduler unless schedule: spread is off.
+    """
+    global phase_sched
+
+    sched_cfg = cfg['schedule']
+    if not sched_cfg['spread']:
+        return [(job_id, job, seconds, seconds) for job_id, job, seconds in scheduled_jobs()]
+    import sched_help
+    phase_sched = sched_help.PhaseScheduler(slot=sched_cfg['slot'], max_io=sched_cfg['max_io'])
+    for job_id, job, seconds in scheduled_jobs():
+        phase_sched.add(job_id, job, seconds)
+    plan = phase_sched.plan()
+    do_msg(f'Job phases {({job_id: job[2] for job_id, job in phase_sched.jobs.items()})}, most jobs in '
+           f'one slot {plan["max_per_slot"]}, {plan["max_per_slot_unspread"]} unspread')
+    phase_sched.start()
+    if metrics is not None:
+        metrics.set('schedule_jitter_ms', lambda: phase_sched.report()['jitter_ms_p95'], {'quantile': '0.95'})
+        metrics.set('schedule_jitter_ms', lambda: phase_sched.report()['jitter_ms_max'], {'quantile': '1'})
+        metrics.set('schedule_max_tick_load', lambda: phase_sched.report()['max_tick_load'])
+        metrics.set('schedule_io_waits', lambda: phase_sched.report()['io_waits'])
+    return phase_sched.planned()
+
+
+def start_periodic(job_id, job, seconds, phase):
+    import async_help
+    aio_jobs[job_id] = (job, aio_loop.create_task(async_help.periodic(job, seconds, name=job_id, phase=phase,
+                                                                      on_missed=on_job_missed,
+                                                                      on_error=on_job_error)))
+
+
+async def run_async():
+    # The loop drives the MQTT client, so it is running while the devices come up.
+    await aio_loop.run_in_executor(None, device_setups)
+    for job_id, job, seconds, phase in planned_jobs():
+        start_periodic(job_id, job, seconds, phase)
+    # the jobs run until the loop is stopped
+    await aio_loop.create_future()
+
+
+def reschedule_job(job_id, seconds):
+    # A new interval for a polling job, from the command topic. The next run is about an interval
+    # from now.
+    delay = seconds if phase_sched is None else phase_sched.retime(job_id, seconds)
+    if aio_loop is not None:
+        def restart():
+            job, task = aio_jobs[job_id]
+            task.cancel()
+            start_periodic(job_id, job, seconds, delay)
+        aio_loop.call_soon_threadsafe(restart)
+    else:
+        monitor_schedule.reschedule_job(job_id, trigger='interval', seconds=seconds,
+                                        start_date=datetime.datetime.now() + datetime.timedelta(seconds=delay))
+
+
+def set_interval(job_id, seconds):
+    # From the command topic, stretched by the governor as the job's tier is now
+    if governor is not None:
+        governor.set_base(job_id, seconds)
+    else:
+        reschedule_job(job_id, seconds)
+
+
+def governor_setups():
+    # Stretches the less urgent jobs when the Pi runs hot or busy, see gov_help.py. After the
+    # devices, as it reads the cpu sensor.
+    global governor
+
+    gov_cfg = cfg['governor']
+    import gov_help
+    cpu = next((sensor for sensor in registry.sensors if sensor.kind == 'cpu'), None)
+    topic = cfg['device']['topic_prefix'] + gov_cfg['topic']
+    governor = gov_help.ThermalGovernor(cpu.device if cpu is not None else None,
+                                        backlog=pub_queue.backlog,
+                                        reschedule=reschedule_job,
+                                        publish=publish,
+                                        topic=topic,
+                                        client_id=client_id,
+                                        qos=registry.policy.qos(topic),
+                                        tiers=gov_cfg['tiers'],
+                                        temp_high=gov_cfg['temp_high'],
+                                        temp_band=gov_cfg['temp_band'],
+                                        load_low=gov_cfg['load_low'],
+                                        load_high=gov_cfg['load_high'],
+                                        backlog_low=gov_cfg['backlog_low'],
+                                        backlog_high=gov_cfg['backlog_high'],
+                                        max_stretch=gov_cfg['max_stretch'],
+                                        step=gov_cfg['step'],
+                                        cool_down=gov_cfg['cool_down'],
+                                        log=do_msg
+                                        )
+
+
+def set_debug(on):
+    # The -d output, from the command topic
+    global en_out
+    en_out = on
+    registry.verbose = on
+
+
+def device_setups():
+    global monitor_schedule
+
+    # The devices, concurrently, each publishing its first reading as soon as it is up, with the
+    # gpiozero state change callbacks registered.
+    with startup.phase('devices'):
+        registry.bring_up(workers=cfg['runtime']['bring_up_workers'], phase=startup.phase)
+    startup.mark('devices_up_s')
+    if discovery is not None:
+        with startup.phase('discovery'):
+            discovery.build()
+            # when the broker connected first on_connect had nothing to publish yet
+            if mqttc.is_connected():
+                discovery.publish_changed(mqttc)
+
+    # Setup polling schedule, run by run_async() in the asyncio runtime
+    with startup.phase('scheduler'):
+        if cfg['governor']['enabled']:
+            governor_setups()
+        if aio_loop is None:
+            from apscheduler.schedulers.background import BlockingScheduler
+            from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_ERROR, EVENT_JOB_MAX_INSTANCES
+            monitor_schedule = BlockingScheduler()
+            start = datetime.datetime.now()
+            for job_id, job, seconds, phase in planned_jobs():
+                monitor_schedule.add_job(job, 'interval', seconds=seconds, id=job_id,
+                                         start_date=start + datetime.timedelta(seconds=phase))
+            if metrics is not None:
+                monitor_schedule.add_listener(on_job_event, EVENT_JOB_MISSED | EVENT_JOB_ERROR | EVENT_JOB_MAX_INSTANCES)
+    rpt_startup(mqttc)
+
+    if metrics is not None:
+        for name in startup.phases:
+            metrics.set('startup_phase_seconds', lambda name=name: startup.phases[name][1], {'phase': name})
+        if governor is not None:
+            for k in range(len(governor.tiers)):
+                metrics.set('governor_stretch', lambda k=k: governor.stretch[k], {'tier': str(k)})
+            for source in ('temp', 'load', 'backlog'):
+                metrics.set('governor_pressure', lambda source=source: governor.last.get('pressures', {}).get(source),
+                            {'source': source})
+        for sensor in registry.sensors:
+            capture = getattr(sensor, 'capture', None)
+            if capture is not None:
+                for key in capture.report():
+                    metrics.set('door_edges', lambda capture=capture, key=key: capture.report()[key],
+                                {'sensor': sensor.name, 'stat': key})
+        if cfg['metrics']['http_port']:
+            metrics_help.MetricsServer(metrics,
+                                       host=cfg['metrics']['http_host'],
+                                       port=cfg['metrics']['http_port']
+                                       ).start()
 
 
 def main():
-    process_any_arguments()
-    mqttc.loop_start()
-    device_setups()
-    startup_reads()
-    monitor_schedule.start()
+    with startup.phase('config'):
+        process_any_arguments()
+    if cfg['fleet']['groups']:
+        import fleet_help
+        cfg['publish']['spool_dir'] = local_path(cfg['publish']['spool_dir'])
+        cfg['discovery']['state_file'] = local_path(cfg['discovery']['state_file'])
+        fleet_help.run(cfg, log=do_msg, verbose=en_out)
+        return
+    # The broker connection first, so the LWT and readings go out as soon as there are any
+    with startup.phase('mqtt'):
+        simulation_setups()
+        monitor_setups()
+        do_msg(f'\nChecking for reachable mqtt broker at {mqtt_broker_url}')
+        pub_queue.start()
+        broker_link.start()
+    if history_server is not None:
+        history_server.start()
+    if commands is not None:
+        commands.start()
+    with startup.phase('pin_factory'):
+        pin_factory_setups()
+    try:
+        if aio_loop is not None:
+            aio_loop.run_until_complete(run_async())
+        else:
+            device_setups()
+            monitor_schedule.start()
+    finally:
+        # keep whatever has not been sent for the next run
+        pub_queue.close()
+        if history is not None:
+            history.close()
+        if aio_mqtt is not None:
+            aio_mqtt.disconnect()
+        if simulation is not None:
+            simulation.stop()
 
 
 # Execute main() function
@@ -0,0 +1,648 @@
+# pub_help.py
+# Publishing helpers used by pizero_mqtt_monitor.py.
+#
+# PublishQueue sits in front of the paho client's publish. While the broker is connected and
+# nothing is waiting, messages go straight out. Otherwise they are queued in memory and, once the
+# memory cap is reached, the oldest are spilled to append-only spool files on the SD card. On
+# reconnect the backlog is replayed oldest first at a limited rate.
+#
+# PublishPolicy picks each topic's qos and, with MQTT v5, how long a retained reading stays valid.
+# PublishProperties adds the v5 publish properties, topic aliases and message expiry.
+#
+# PublishFilter decides per topic whether a new reading is worth publishing at all.
+#
+# PayloadTemplate writes a topic's reading payload, the same bytes json.dumps(default=str) gives,
+# with the parts that never change encoded once. Timestamps gives str(datetime.datetime.now())
+# formatting the date and time once a second.
+#
+# BatchPublisher is the optional aggregated mode, one device state payload in place of a publish per
+# sensor topic, encoded as compact JSON, CBOR (needs cbor2) or MessagePack (needs msgpack).
+#
+import base64
+import datetime
+import json
+import os
+import threading
+import time
+from collections import deque
+
+# paho's MQTT_ERR_SUCCESS
+PUB_OK = 0
+
+
+def spool_record(topic: str, payload, retain: bool, qos: int) -> dict:
+    # Binary payloads (CBOR, MessagePack) are spooled base64 encoded.
+    if isinstance(payload, (bytes, bytearray)):
+        return {'t': topic, 'b': base64.b64encode(payload).decode('ascii'), 'r': retain, 'q': qos}
+    return {'t': topic, 'p': payload, 'r': retain, 'q': qos}
+
+
+class PublishQueue:
+    # Spooling keeps flash wear down: records are written in batches (batch_size records or
+    # flush_int seconds, whichever comes first), fsync is done at most every fsync_int seconds, and
+    # nothing touches the card unless the memory queue overflows. Spool files are segments of
+    # about segment_bytes. When the segments add up to more than max_disk_bytes the oldest segment
+    # is deleted, so the oldest readings are the ones given up. With spool_dir None nothing is
+    # written and the oldest in-memory records are dropped instead.
+    #
+    # Spool segments left by a previous run are replayed too, so readings survive a restart.
+
+    def __init__(self,
+                 client,
+                 spool_dir: str = None,
+                 max_mem: int = 200,
+                 max_disk_bytes: int = 2_000_000,
+                 segment_bytes: int = 64 * 1024,
+                 batch_size: int = 20,
+                 flush_int: float = 5.0,
+                 fsync_int: float = 30.0,
+                 replay_rate: float = 20.0
+                 ) -> None:
+        self.client = client
+        self.spool_dir = spool_dir
+        self.max_mem = max_mem
+        self.max_disk_bytes = max_disk_bytes
+        self.segment_bytes = segment_bytes
+        self.batch_size = batch_size
+        self.flush_int = flush_int
+        self.fsync_int = fsync_int
+        self.replay_rate = replay_rate
+        # PublishProperties with MQTT v5, None otherwise
+        self.properties = None
+        self.counts = {'sent': 0, 'queued': 0, 'spilled': 0, 'replayed': 0, 'evicted': 0}
+        # observer(rc, seconds) is called after every client.publish, ie for metrics
+        self.observer = None
+        # newest records, (topic, payload, retain, qos)
+        self._mem = deque()
+        # records spilled from _mem but not yet written to a segment
+        self._wbuf = []
+        self._wbuf_since = None
+        # records loaded from the oldest segment being replayed, sent before anything else
+        self._replay_buf = deque()
+        self._replay_seg = None
+        self._seg_file = None
+        self._seg_path = None
+        self._seg_seq = 0
+        # True while there may be spooled records on disk
+        self._on_disk = False
+        # records in the segments on disk, not yet loaded for replay
+        self._spooled = 0
+        self._last_fsync = time.monotonic()
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+            segs = self._segments()
+            if segs:
+                self._seg_seq = int(segs[-1][6:14]) + 1
+                self._on_disk = True
+                self._spooled = sum(self._seg_lines(os.path.join(spool_dir, seg)) for seg in segs)
+
+    # -- spool segments
+    def _segments(self) -> list:
+        if not self.spool_dir:
+            return []
+        return sorted(f for f in os.listdir(self.spool_dir) if f.startswith('spool-') and f.endswith('.jsonl'))
+
+    @staticmethod
+    def _seg_lines(path: str) -> int:
+        try:
+            with open(path, 'r') as f:
+                return sum(1 for _ in f)
+        except OSError:
+            return 0
+
+    def _disk_bytes(self) -> int:
+        total = 0
+        for seg in self._segments():
+            try:
+                total += os.path.getsize(os.path.join(self.spool_dir, seg))
+            except OSError:
+                pass
+        return total
+
+    def _open_segment(self) -> None:
+        self._seg_path = os.path.join(self.spool_dir, f'spool-{self._seg_seq:08d}.jsonl')
+        self._seg_seq += 1
+        self._seg_file = open(self._seg_path, 'a')
+
+    def _close_segment(self) -> None:
+        if self._seg_file is not None:
+            self._seg_file.flush()
+            os.fsync(self._seg_file.fileno())
+            self._seg_file.close()
+            self._seg_file = None
+            self._last_fsync = time.monotonic()
+
+    def _write_batch(self) -> None:
+        if not self._wbuf:
+            return
+        if self._seg_file is None:
+            self._open_segment()
+        lines = ''.join(json.dumps(spool_record(t, p, r, q), separators=(',', ':')) + '\n'
+                        for t, p, r, q in self._wbuf)
+        self._seg_file.write(lines)
+        self._seg_file.flush()
+        self.counts['spilled'] += len(self._wbuf)
+        self._spooled += len(self._wbuf)
+        self._on_disk = True
+        self._wbuf = []
+        self._wbuf_since = None
+        if time.monotonic() - self._last_fsync >= self.fsync_int:
+            os.fsync(self._seg_file.fileno())
+            self._last_fsync = time.monotonic()
+        if self._seg_file.tell() >= self.segment_bytes:
+            self._close_segment()
+        self._evict()
+
+    def _evict(self) -> None:
+        # Oldest first. The segment being written and the one being replayed are kept.
+        while self._disk_bytes() > self.max_disk_bytes:
+            keep = {self._replay_seg, self._seg_path if self._seg_file is not None else None}
+            segs = [s for s in self._segments() if os.path.join(self.spool_dir, s) not in keep]
+            if not segs:
+                break
+            path = os.path.join(self.spool_dir, segs[0])
+            lines = self._seg_lines(path)
+            self.counts['evicted'] += lines
+            self._spooled = max(0, self._spooled - lines)
+            os.remove(path)
+
+    def _load_oldest_segment(self) -> bool:
+        segs = self._segments() if self._on_disk else []
+        if not segs:
+            self._on_disk = False
+            self._spooled = 0
+            return False
+        path = os.path.join(self.spool_dir, segs[0])
+        if path == self._seg_path and self._seg_file is not None:
+            # replaying has caught up with the segment being written
+            self._close_segment()
+        with open(path, 'r') as f:
+            for line in f:
+                self._spooled = max(0, self._spooled - 1)
+                try:
+                    rec = json.loads(line)
+                    payload = base64.b64decode(rec['b']) if 'b' in rec else rec['p']
+                    self._replay_buf.append((rec['t'], payload, rec['r'], rec['q']))
+                except (ValueError, KeyError):
+                    # a torn last line from a power cut
+                    continue
+        self._replay_seg = path
+        return True
+
+    # -- queueing
+    def backlog(self) -> int:
+        with self._lock:
+            return len(self._replay_buf) + len(self._wbuf) + len(self._mem) + self._spooled
+
+    def _enqueue(self, rec: tuple) -> None:
+        self._mem.append(rec)
+        self.counts['queued'] += 1
+        while len(self._mem) > self.max_mem:
+            oldest = self._mem.popleft()
+            if not self.spool_dir:
+                self.counts['evicted'] += 1
+                continue
+            if self._wbuf_since is None:
+                self._wbuf_since = time.monotonic()
+            self._wbuf.append(oldest)
+        if len(self._wbuf) >= self.batch_size:
+            self._write_batch()
+
+    def _send(self, topic: str, payload, retain: bool, qos: int) -> int:
+        t0 = time.perf_counter()
+        if self.properties is None:
+            rc = self.client.publish(topic=topic, payload=payload, retain=retain, qos=qos).rc
+        else:
+            sent_topic, props = self.properties.prepare(topic, retain, qos)
+            rc = self.client.publish(topic=sent_topic, payload=payload, retain=retain, qos=qos, properties=props).rc
+            if rc != PUB_OK:
+                self.properties.failed(topic)
+        if self.observer is not None:
+            self.observer(rc, time.perf_counter() - t0)
+        return rc
+
+    def publish(self, topic: str, payload, retain: bool = False, qos: int = 0) -> None:
+        rec = (topic, payload, retain, qos)
+        with self._lock:
+            if self.client.is_connected() and not self.backlog():
+                if self._send(topic, payload, retain, qos) == PUB_OK:
+                    self.counts['sent'] += 1
+                    return
+            self._enqueue(rec)
+        self._wake.set()
+
+    def _next_record(self):
+        # Oldest waiting record, without removing it.
+        if not self._replay_buf and self._replay_seg is not None:
+            os.remove(self._replay_seg)
+            self._replay_seg = None
+        if not self._replay_buf and self._load_oldest_segment():
+            return self._next_record()
+        if self._replay_buf:
+            return self._replay_buf, self._replay_buf[0]
+        if self._wbuf:
+            return self._wbuf, self._wbuf[0]
+        if self._mem:
+            return self._mem, self._mem[0]
+        return None, None
+
+    def on_connect(self, properties=None) -> None:
+        # Call from the client's on_connect to start replaying the backlog, with the CONNACK
+        # properties under MQTT v5.
+        if self.properties is not None:
+            with self._lock:
+                self.properties.on_connect(properties)
+        self._wake.set()
+
+    def on_disconnect(self) -> None:
+        if self.properties is not None:
+            with self._lock:
+                self.properties.on_disconnect()
+
+    # -- background worker
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='publish-queue', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        gap = 1.0 / self.replay_rate if self.replay_rate else 0.0
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_int)
+            self._wake.clear()
+            with self._lock:
+                if self._wbuf and time.monotonic() - self._wbuf_since >= self.flush_int:
+                    self._write_batch()
+            while not self._stop.is_set() and self.client.is_connected():
+                with self._lock:
+                    src, rec = self._next_record()
+                    if rec is None:
+                        break
+                    topic, payload, retain, qos = rec
+                    if self._send(topic, payload, retain, qos) != PUB_OK:
+                        break
+                    if src is self._wbuf:
+                        self._wbuf.pop(0)
+                    else:
+                        src.popleft()
+                    self.counts['replayed'] += 1
+                self._stop.wait(gap)
+
+    def close(self) -> None:
+        # Saves anything still in memory to the spool so it is replayed after a restart.
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        with self._lock:
+            if self.spool_dir:
+                self._wbuf.extend(self._mem)
+                self._mem.clear()
+                self._write_batch()
+                self._close_segment()
+
+
+def protocol_v5(mqtt_cfg: dict) -> bool:
+    # mqtt protocol is 3.1.1 (the default) or 5
+    return str(mqtt_cfg.get('protocol', '3.1.1')) == '5'
+
+
+class PublishPolicy:
+    # {'qos': 0, 'expiry': 900, 'topics': {'garage_dr': {'qos': 1, 'expiry': 0}}}, topics relative
+    # to topic_prefix. expiry is in seconds, 0 for never, and only applies to retained publishes
+    # with MQTT v5: the broker drops a retained reading that long after it was published, so a dead
+    # device's last readings are not served as current forever. A topic that is only published on
+    # change, like a door, wants expiry 0.
+
+    def __init__(self, policy: dict = None, topic_prefix: str = '') -> None:
+        policy = policy or {}
+        self.default_qos = policy.get('qos', 0)
+        self.default_expiry = policy.get('expiry', 0)
+        self.topics = {topic_prefix + t: rule or {} for t, rule in (policy.get('topics') or {}).items()}
+
+    def qos(self, topic: str) -> int:
+        return self.topics.get(topic, {}).get('qos', self.default_qos)
+
+    def expiry(self, topic: str) -> int:
+        return self.topics.get(topic, {}).get('expiry', self.default_expiry)
+
+
+class PublishProperties:
+    # MQTT v5 publish properties, set as a PublishQueue's properties. The queue passes on its
+    # on_connect and on_disconnect.
+    #
+    # Topic aliases: the first publish of a topic on a connection carries the topic and an alias
+    # number, later ones only the alias, a two byte property in place of the topic string. The
+    # broker says in its CONNACK how many aliases it keeps (Topic Alias Maximum, 0 for none); past
+    # that topics go out in full. Only qos 0 publishes go out with the alias alone. paho resends
+    # unacknowledged qos 1 and 2 messages after a reconnect, when the broker has forgotten the
+    # aliases, so those always carry the topic too.
+
+    def __init__(self, expiry) -> None:
+        # expiry(topic), seconds, ie PublishPolicy.expiry
+        from paho.mqtt.packettypes import PacketTypes
+        from paho.mqtt.properties import Properties
+        self._new = lambda: Properties(PacketTypes.PUBLISH)
+        self.expiry = expiry
+        self.max_aliases = 0
+        # topic -> alias on this connection
+        self.aliases = {}
+        self._assigned = None
+        self.counts = {'aliased': 0, 'full': 0}
+
+    def on_connect(self, properties) -> None:
+        # properties, the CONNACK properties
+        self.aliases = {}
+        self.max_aliases = getattr(properties, 'TopicAliasMaximum', 0) if properties is not None else 0
+
+    def on_disconnect(self) -> None:
+        self.aliases = {}
+        self.max_aliases = 0
+
+    def prepare(self, topic: str, retain: bool, qos: int) -> tuple:
+        # (topic to send, properties or None)
+        props = None
+        expiry = self.expiry(topic) if retain else 0
+        if expiry:
+            props = self._new()
+            props.MessageExpiryInterval = expiry
+        alias = self.aliases.get(topic)
+        self._assigned = None
+        if alias is None and len(self.aliases) < self.max_aliases:
+            alias = len(self.aliases) + 1
+            self.aliases[topic] = alias
+            self._assigned = topic
+        if alias is None:
+            self.counts['full'] += 1
+            return topic, props
+        if props is None:
+            props = self._new()
+        props.TopicAlias = alias
+        if self._assigned is not None or qos:
+            self.counts['full'] += 1
+            return topic, props
+        self.counts['aliased'] += 1
+        return '', props
+
+    def failed(self, topic: str) -> None:
+        # The publish just prepared did not go out. An alias it was to set up is given back.
+        if self._assigned == topic:
+            del self.aliases[topic]
+            self._assigned = None
+
+
+class PublishFilter:
+    # Change-only publishing. Each topic can have a rule; a reading is compared field by field with the
+    # last reading actually published on that topic:
+    #   deadbands {field: amount} - a numeric field must move by at least amount to count as a change
+    #   ignore [field, ...] - fields that never count as a change, ie a steadily growing uptime
+    #   any other field - counts as a change when its value differs (booleans, strings)
+    # Whatever the values, a topic is republished once max_silence seconds have passed since its last
+    # publish, as a heartbeat. Topics without a rule are always sent.
+
+    def __init__(self) -> None:
+        self.rules = {}
+        # topic -> (time.monotonic() of last publish, values published)
+        self.last = {}
+        # topic -> {'sent': n, 'suppressed': n}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add_rule(self, topic: str, deadbands: dict = None, ignore=(), max_silence: float = 300.0) -> None:
+        self.rules[topic] = (dict(deadbands or {}), set(ignore), max_silence)
+
+    def set_deadband(self, topic: str, field: str, amount: float, max_silence: float = 300.0) -> None:
+        # A topic without a rule gets one with just this deadband.
+        with self._lock:
+            deadbands, ignore, silence = self.rules.get(topic, ({}, set(), max_silence))
+            self.rules[topic] = (dict(deadbands, **{field: amount}), ignore, silence)
+
+    def deadbands(self, topic: str) -> dict:
+        with self._lock:
+            return dict(self.rules[topic][0]) if topic in self.rules else {}
+
+    def changed(self, topic: str, old: dict, new: dict) -> bool:
+        deadbands, ignore, _ = self.rules[topic]
+        for field, value in new.items():
+            if field in ignore:
+                continue
+            prev = old.get(field)
+            dead = deadbands.get(field)
+            if dead is not None and prev is not None and value is not None:
+                try:
+                    # the small epsilon keeps 72.3 - 72.1 from falling short of a 0.2 deadband
+                    if abs(float(value) - float(prev)) + 1e-9 >= dead:
+                        return True
+                    continue
+                except (TypeError, ValueError):
+                    pass
+            if value != prev:
+                return True
+        return False
+
+    def should_send(self, topic: str, values: dict) -> bool:
+        # Call with the changing fields of a reading. True means publish it; the reading is then
+        # remembered as the last one published.
+        now = time.monotonic()
+        with self._lock:
+            counts = self.counts.setdefault(topic, {'sent': 0, 'suppressed': 0})
+            rule = self.rules.get(topic)
+            last = self.last.get(topic)
+            send = (rule is None or last is None or now - last[0] >= rule[2] or
+                    self.changed(topic, last[1], values))
+            if send:
+                self.last[topic] = (now, dict(values))
+                counts['sent'] += 1
+            else:
+                counts['suppressed'] += 1
+            return send
+
+    def forget(self, topic: str = None) -> None:
+        # The next reading on topic, or on every topic, is sent regardless.
+        with self._lock:
+            if topic is None:
+                self.last.clear()
+            else:
+                self.last.pop(topic, None)
+
+    def totals(self) -> dict:
+        with self._lock:
+            return {'sent': sum(c['sent'] for c in self.counts.values()),
+                    'suppressed': sum(c['suppressed'] for c in self.counts.values())}
+
+
+class Timestamps:
+    # str(datetime.datetime.now()), 'YYYY-MM-DD HH:MM:SS.ffffff' or without the fraction when the
+    # microseconds are 0, without building a datetime. The text to the second is kept for the
+    # second; each call adds only the microseconds, rounded as datetime.fromtimestamp rounds them.
+
+    def __init__(self) -> None:
+        self._second = (None, '')
+
+    def text(self, t: float) -> str:
+        sec = int(t)
+        us = round((t - sec) * 1e6)
+        if us >= 1000000:
+            sec += 1
+            us -= 1000000
+        second = self._second
+        if second[0] != sec:
+            second = (sec, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec)))
+            self._second = second
+        return second[1] + '.%06d' % us if us else second[1]
+
+    def now(self) -> str:
+        return self.text(time.time())
+
+
+class PayloadTemplate:
+    # The payload of one sensor's readings, {"time": ..., "client_id": ..., <values>, <static>}, as
+    # json.dumps(payload, default=str) writes it. The client id and static fields are encoded once,
+    # as are the field names as they are met, so a reading only costs its values and a join. Values
+    # of types other than str, bool, int, float, None and datetime are left to json.dumps, as is a
+    # reading with a field named like a fixed one, where the dict order would differ.
+    max_strings = 64
+
+    def __init__(self, client_id: str = None, static: dict = None) -> None:
+        static = static or {}
+        self.client_id = client_id
+        self.static = dict(static)
+        self.after_time = '"' + ('' if client_id is None else ', "client_id": ' + json.dumps(client_id))
+        self.tail = ''.join(', ' + json.dumps(k) + ': ' + json.dumps(v, default=str) for k, v in static.items()) + '}'
+        self.fixed = {'time'} | ({'client_id'} if client_id is not None else set()) | set(static)
+        # field -> ', "field": ' and str value -> its JSON
+        self.keys = {}
+        self.strings = {}
+
+    def key(self, field: str) -> str:
+        text = self.keys.get(field)
+        if text is None:
+            text = ', ' + json.dumps(field) + ': '
+            self.keys[field] = text
+        return text
+
+    def value(self, value) -> str:
+        kind = type(value)
+        if kind is str:
+            text = self.strings.get(value)
+            if text is None:
+                if len(self.strings) >= self.max_strings:
+                    self.strings.clear()
+                text = json.dumps(value)
+                self.strings[value] = text
+            return text
+        if kind is float:
+            # NaN and the infinities have their own spellings in json
+            return float.__repr__(value) if value - value == 0.0 else json.dumps(value)
+        if kind is bool:
+            return 'true' if value else 'false'
+        if kind is int:
+            return int.__repr__(value)
+        if value is None:
+            return 'null'
+        if kind is datetime.datetime:
+            return '"' + str(value) + '"'
+        return json.dumps(value, default=str)
+
+    def render(self, values: dict, stamp: str) -> str:
+        # stamp is the time as str(datetime) writes it, ie Timestamps.now()
+        if not self.fixed.isdisjoint(values):
+            pld = {"time": stamp}
+            if self.client_id is not None:
+                pld["client_id"] = self.client_id
+            pld.update(values)
+            pld.update(self.static)
+            return json.dumps(pld, default=str)
+        parts = ['{"time": "', stamp, self.after_time]
+        for field, value in values.items():
+            parts.append(self.key(field))
+            parts.append(self.value(value))
+        parts.append(self.tail)
+        return ''.join(parts)
+
+
+def payload_encoder(encoding: str = 'json'):
+    # Returns a function turning a payload dict into str or bytes. CBOR and MessagePack need the
+    # cbor2 or msgpack package, ie pip install cbor2 msgpack.
+    if encoding == 'json':
+        return lambda obj: json.dumps(obj, separators=(',', ':'), default=str)
+    if encoding == 'cbor':
+        try:
+            import cbor2
+        except ImportError:
+            raise ValueError('The cbor2 package is needed for cbor encoding, ie pip install cbor2')
+        return lambda obj: cbor2.dumps(obj, default=lambda enc, value: enc.encode(str(value)))
+    if encoding == 'msgpack':
+        try:
+            import msgpack
+        except ImportError:
+            raise ValueError('The msgpack package is needed for msgpack encoding, ie pip install msgpack')
+        return lambda obj: msgpack.packb(obj, default=str)
+    raise ValueError(f'Unknown payload encoding {encoding}, use json, cbor or msgpack')
+
+
+class BatchPublisher:
+    # Readings added within window seconds of each other go out as one payload on topic:
+    #   {"time": unix seconds, "client_id": ..., "<sensor key>": {reading fields}, ...}
+    # With snapshot True every payload carries the last reading of every sensor, so a consumer
+    # (ie a Home Assistant value_template) always finds its key. Otherwise only the readings taken
+    # in the window are sent. flush() sends right away, ie for state change events.
+
+    def __init__(self,
+                 publish,
+                 topic: str,
+                 client_id: str,
+                 window: float = 1.0,
+                 encoding: str = 'json',
+                 snapshot: bool = True,
+                 retain: bool = True,
+                 qos: int = 0
+                 ) -> None:
+        self.publish = publish
+        self.topic = topic
+        self.client_id = client_id
+        self.window = window
+        self.encoding = encoding
+        self.encode = payload_encoder(encoding)
+        self.snapshot = snapshot
+        self.retain = retain
+        self.qos = qos
+        self.counts = {'batches': 0, 'readings': 0, 'bytes': 0}
+        self._state = {}
+        self._batch = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, key: str, values: dict) -> None:
+        with self._lock:
+            self._batch[key] = values
+            self.counts['readings'] += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def build(self, batch: dict) -> dict:
+        pld = {"time": round(time.time(), 3), "client_id": self.client_id}
+        if self.snapshot:
+            self._state.update(batch)
+            pld.update(self._state)
+        else:
+            pld.update(batch)
+        return pld
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._batch:
+                return
+            batch, self._batch = self._batch, {}
+            payload = self.encode(self.build(batch))
+            self.counts['batches'] += 1
+            self.counts['bytes'] += len(payload)
+        self.publish(topic=self.topic, payload=payload, retain=self.retain, qos=self.qos)
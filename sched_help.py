@@ -0,0 +1,156 @@
+# sched_help.py
+# Spreads the polling jobs over their intervals. Left alone every job starts from the same moment,
+# so jobs with intervals of 60, 30, 90 s and so on all fire in the same second at their common
+# multiples, each with a blocking read, a json.dumps and a publish, and the latency spikes.
+#
+# PhaseScheduler gives each job a phase, its first run phase seconds after start, then every
+# interval. The phases are picked one job at a time, longest interval first, to keep the jobs
+# firing in any slot over a horizon as few as possible. Phases are whole slots, so jobs that do
+# fire together have the same deadline and are run from one scheduler wake-up. At most max_io jobs
+# run at once, the others wait their turn.
+#
+# It only plans and wraps the jobs. apscheduler (start_date) or async_help.periodic (phase) runs
+# them. report() gives the jitter achieved, how late each run started against its planned time,
+# and the load, how many jobs ran per wake-up.
+#
+import math
+import threading
+import time
+from collections import deque
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))]
+
+
+class PhaseScheduler:
+
+    def __init__(self,
+                 slot: float = 1.0,
+                 horizon: float = 3600.0,
+                 max_io: int = 2,
+                 keep: int = 500
+                 ) -> None:
+        self.slot = slot
+        self.horizon = horizon
+        self.max_io = max_io
+        # job id -> [fn, interval, phase]
+        self.jobs = {}
+        self.t0 = None
+        self.io = threading.BoundedSemaphore(max_io) if max_io else None
+        self.io_waits = 0
+        # recent lateness of each run, seconds, and jobs run per wake-up {n jobs: wake-ups}
+        self.jitter = deque(maxlen=keep)
+        self.tick_load = {}
+        self._tick_at = None
+        self._tick_n = 0
+        self._lock = threading.Lock()
+
+    def add(self, job_id: str, fn, interval: float) -> None:
+        self.jobs[job_id] = [fn, interval, interval]
+
+    def slot_loads(self, phases: dict) -> list:
+        # Jobs firing in each slot over the horizon for {job id: phase}.
+        n_slots = int(self.horizon / self.slot)
+        load = [0] * n_slots
+        for job_id, phase in phases.items():
+            interval = self.jobs[job_id][1]
+            t = phase
+            while t < self.horizon:
+                load[int(t / self.slot) % n_slots] += 1
+                t += interval
+        return load
+
+    def plan(self) -> dict:
+        # Picks the phases. Returns the most jobs in one slot without and with them.
+        n_slots = int(self.horizon / self.slot)
+        load = [0] * n_slots
+        for job_id in sorted(self.jobs, key=lambda j: -self.jobs[j][1]):
+            interval = self.jobs[job_id][1]
+            best = None
+            for k in range(1, max(1, int(interval / self.slot)) + 1):
+                phase = k * self.slot
+                cost = 0
+                worst = 0
+                t = phase
+                while t < self.horizon:
+                    n = load[int(t / self.slot) % n_slots]
+                    cost += n
+                    worst = max(worst, n)
+                    t += interval
+                if best is None or (worst, cost) < best[0]:
+                    best = ((worst, cost), phase)
+            phase = best[1]
+            self.jobs[job_id][2] = phase
+            t = phase
+            while t < self.horizon:
+                load[int(t / self.slot) % n_slots] += 1
+                t += interval
+        unspread = self.slot_loads({job_id: job[1] for job_id, job in self.jobs.items()})
+        return {'max_per_slot_unspread': max(unspread, default=0), 'max_per_slot': max(load, default=0)}
+
+    def start(self) -> None:
+        # The time the phases count from; call just before the jobs are handed to the runner.
+        self.t0 = time.monotonic()
+
+    def planned(self) -> list:
+        # [(job id, wrapped function, interval, phase), ...]
+        return [(job_id, self.wrap(job_id), interval, phase) for job_id, (_, interval, phase) in self.jobs.items()]
+
+    def retime(self, job_id: str, interval: float) -> float:
+        # A new interval for a running job, ie from a command. The next run is an interval from now,
+        # on a slot boundary; the other jobs' phases are not revisited. Returns seconds to it.
+        elapsed = time.monotonic() - self.t0
+        phase = math.ceil((elapsed + interval) / self.slot) * self.slot
+        self.jobs[job_id][1:] = [interval, phase]
+        return phase - elapsed
+
+    def wrap(self, job_id: str):
+        fn = self.jobs[job_id][0]
+
+        def run():
+            _, interval, phase = self.jobs[job_id]
+            now = time.monotonic()
+            late = (now - self.t0 - phase) % interval
+            if late > interval / 2.0:
+                late -= interval
+            self._note(now, late)
+            if self.io is None:
+                return fn()
+            if not self.io.acquire(blocking=False):
+                with self._lock:
+                    self.io_waits += 1
+                self.io.acquire()
+            try:
+                return fn()
+            finally:
+                self.io.release()
+        return run
+
+    def _note(self, now: float, late: float) -> None:
+        with self._lock:
+            self.jitter.append(late)
+            if self._tick_at is not None and now - self._tick_at < self.slot:
+                self._tick_n += 1
+                return
+            if self._tick_n:
+                self.tick_load[self._tick_n] = self.tick_load.get(self._tick_n, 0) + 1
+            self._tick_at = now
+            self._tick_n = 1
+
+    def report(self) -> dict:
+        with self._lock:
+            jitter = list(self.jitter)
+            loads = dict(self.tick_load)
+            io_waits = self.io_waits
+        abs_ms = sorted(abs(j) * 1000.0 for j in jitter)
+        return {
+            "jitter_ms_p50": round(percentile(abs_ms, 50), 3),
+            "jitter_ms_p95": round(percentile(abs_ms, 95), 3),
+            "jitter_ms_max": round(abs_ms[-1], 3) if abs_ms else 0.0,
+            "tick_load": {str(n): loads[n] for n in sorted(loads)},
+            "max_tick_load": max(loads, default=0),
+            "io_waits": io_waits
+        }
@@ -1,16 +1,18 @@
 # sens_help.py    aks 01/27/24
 import os
 import glob
+import array
 import time
-from gpiozero import CPUTemperature
+import datetime
+import queue
+import threading
 import subprocess
-# from gpiozero.pins.native import NativeFactory
-from gpiozero.pins.pigpio import PiGPIOFactory
-from gpiozero import Device
+from collections import deque
+
+# Note: the pin factory is set by pizero_mqtt_monitor.py, pigpio on the Pi or gpiozero's
+# MockFactory in simulation (see sim_help.py). gpiozero is imported where it is used, so loading
+# this module does not wait on it.
 
-# setting the default pin_factory to be the enhanced pigpio
-# Device.pin_factory = NativeFactory()
-Device.pin_factory = PiGPIOFactory()
 
 def is_host_reachable(the_host):
     # Returns True if URL the_host is reachable, False otherwise.
@@ -34,45 +36,144 @@ class TheDS18x20:
     # dtoverlay=w1-gpio,gpiopin=17 # This is header pin (or 'board pin') 11.
     # save file and reboot
 
-    def __init__(self):
+    def __init__(self, base_dir: str = '/sys/bus/w1/devices/', modprobe: bool = True):
         self.device_file = ""
+        # device id (the 28-xxxxxxxxxxxx folder name) -> w1_slave file, for every DS18x20 found
+        self.device_files = {}
         try:
-            # Enable the 1-wire system handled by the OS
-            os.system('modprobe w1-gpio')
-            # Enable DS18x20 support on the 1-wire system
-            os.system('modprobe w1-therm')
+            if modprobe and not os.path.isdir('/sys/module/w1_therm'):
+                # Enable the 1-wire system handled by the OS and DS18x20 support on it, in one
+                # modprobe and only when w1-therm is not loaded yet (the dtoverlay loads both)
+                subprocess.run(['modprobe', '-a', 'w1-gpio', 'w1-therm'])
             # 1-wire devices show up as files at /sys/bus/w1/devices/
-            self.base_dir = '/sys/bus/w1/devices/'
+            self.base_dir = base_dir
             # Each DS18x20 has its own folder named 28-xxxxxxxxxxxx, where xxxxxxxxxxxx is the unique
-            # address of the DS18x20 sensor. Here, just one DS18B20 assumed, so the one 28* wildcard gets the folder.
-            self.device_folder = glob.glob(self.base_dir + '28*')[0]
+            # address of the DS18x20 sensor. The first one found (sorted) is the primary device.
+            device_folders = sorted(glob.glob(os.path.join(self.base_dir, '28*')))
+            self.device_folder = device_folders[0]
             # The w1_slave file contains the reading in Celsius x 1000.
             self.device_file = self.device_folder + '/w1_slave'
+            for folder in device_folders:
+                self.device_files[os.path.basename(folder)] = folder + '/w1_slave'
         except IndexError:
             print(f'\nDid not find 1-wire DS18x20 temperature device.')
 
-    def read_temp_raw(self):
-        if self.device_file:
-            f = open(self.device_file, 'r')
+    def read_temp_raw(self, device_file=None):
+        device_file = device_file or self.device_file
+        if device_file:
+            f = open(device_file, 'r')
             lines = f.readlines()
             f.close()
             return lines
 
-    def read_temp_f(self):
-        lines = self.read_temp_raw()
+    def read_temp_f(self, device_file=None, max_tries: int = 5, retry_wait: float = 0.2):
+        # Each read of w1_slave triggers a ~750 ms conversion. A failed CRC is retried at most
+        # max_tries times so a flaky bus can not hold the calling thread forever. Returns None
+        # when no good reading was had, ie a truncated or garbled t= line.
+        lines = self.read_temp_raw(device_file)
         if lines is not None:
-            while lines[0].strip()[-3:] != 'YES':
-                time.sleep(0.2)
-                lines = self.read_temp_raw()
+            tries = 1
+            while lines is None or len(lines) < 2 or lines[0].strip()[-3:] != 'YES':
+                if tries >= max_tries:
+                    return None
+                time.sleep(retry_wait)
+                lines = self.read_temp_raw(device_file)
+                tries += 1
             equals_pos = lines[1].find('t=')
             if equals_pos != -1:
                 temp_string = lines[1][equals_pos + 2:]
-                temp_c = float(temp_string) / 1000.0
+                try:
+                    temp_c = float(temp_string) / 1000.0
+                except ValueError:
+                    return None
                 temp_f = temp_c * 9.0 / 5.0 + 32.0
                 temp_f = '{0:.1f}'.format(temp_f)
                 return temp_f
 
 
+class DS18x20Sampler:
+    # Reads every DS18x20 found by a TheDS18x20 in the background so the publishing jobs never wait on
+    # a 1-wire conversion. Each device gets its own reader thread, so several sensors convert in
+    # parallel. The last good reading is kept along with when it was taken.
+    #
+    # Stale policy: a reading older than max_age seconds is not handed out by reading() unless
+    # hold_stale is True. A max_age of None never goes stale.
+
+    def __init__(self,
+                 ds18x20: TheDS18x20,
+                 interval: float = 60.0,
+                 max_tries: int = 5,
+                 max_age: float = None,
+                 hold_stale: bool = False
+                 ) -> None:
+        self.ds18x20 = ds18x20
+        self.interval = interval
+        self.max_tries = max_tries
+        self.max_age = max_age
+        self.hold_stale = hold_stale
+        # device id -> (temp_f string, datetime taken, monotonic taken)
+        self.readings = {}
+        self.failures = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._ready = threading.Event()
+        self._threads = []
+
+    def device_ids(self) -> list:
+        return list(self.ds18x20.device_files)
+
+    def primary_id(self) -> str:
+        if self.ds18x20.device_file:
+            return os.path.basename(self.ds18x20.device_folder)
+
+    def start(self) -> None:
+        for dev_id, device_file in self.ds18x20.device_files.items():
+            t = threading.Thread(target=self._run, args=(dev_id, device_file),
+                                 name=f'ds18x20-{dev_id}', daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        # True once any device has a reading.
+        return self._ready.wait(timeout)
+
+    def sample(self, dev_id: str, device_file: str) -> None:
+        temp_f = self.ds18x20.read_temp_f(device_file, max_tries=self.max_tries)
+        with self._lock:
+            if temp_f is None:
+                self.failures[dev_id] = self.failures.get(dev_id, 0) + 1
+            else:
+                self.readings[dev_id] = (temp_f, datetime.datetime.now(), time.monotonic())
+                self._ready.set()
+
+    def _run(self, dev_id: str, device_file: str) -> None:
+        while not self._stop.is_set():
+            t0 = time.monotonic()
+            try:
+                self.sample(dev_id, device_file)
+            except (OSError, ValueError, TypeError):
+                # the device went away, the bus is down or it gave garbage, try again next round
+                with self._lock:
+                    self.failures[dev_id] = self.failures.get(dev_id, 0) + 1
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - t0)))
+
+    def reading(self, dev_id: str = None) -> tuple:
+        # Returns (temp_f, datetime taken) for dev_id, the primary device when None, or
+        # None when there is no usable reading.
+        if dev_id is None:
+            dev_id = self.primary_id()
+        with self._lock:
+            rd = self.readings.get(dev_id)
+        if rd is None:
+            return None
+        if self.max_age is not None and not self.hold_stale and time.monotonic() - rd[2] > self.max_age:
+            return None
+        return rd[0], rd[1]
+
+
 class CPUTempState:
 
     def __init__(self,
@@ -82,6 +183,7 @@ class CPUTempState:
                  threshold: float = 80.0,
                  event_delay: float = 10.0
                  ) -> None:
+        from gpiozero import CPUTemperature
         # read gpiozero LightSensor docs
         self.cpu_temp = CPUTemperature(sensor_file=sensor_file,
                                        min_temp=min_temp,
@@ -95,3 +197,423 @@ class CPUTempState:
             return t, True
         else:
             return t, False
+
+
+class LightSampler:
+    # Samples a light level (ie a gpiozero LightSensor's value, 0 to 1) rate times a second from
+    # its own thread, for flicker, headlights and other short light events a single reading at poll
+    # time misses. The samples go into a ring of capacity unsigned 16 bit values (value * 65535),
+    # 2 bytes a sample whatever the rate, and the light/dark transitions, with hysteresis around
+    # threshold, into a bounded list. summary() reduces what was sampled since its last call to
+    # min, max, mean, percentiles and the transitions. The thread's own CPU time is measured, as a
+    # percentage of one core.
+
+    def __init__(self,
+                 read_value,
+                 rate: float = 20.0,
+                 capacity: int = 2048,
+                 threshold: float = 0.1,
+                 hysteresis: float = 0.02,
+                 max_transitions: int = 32
+                 ) -> None:
+        self.read_value = read_value
+        self.rate = rate
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+        self.max_transitions = max_transitions
+        self.ring = array.array('H', bytes(2 * capacity))
+        self.capacity = capacity
+        self._head = 0  # next slot written
+        self._fresh = 0  # samples since the last summary, at most capacity
+        self.light = None
+        # [(time.monotonic(), light), ...] since the last summary, the first max_transitions of
+        # n_transitions
+        self.transitions = []
+        self.n_transitions = 0
+        self.counts = {'samples': 0, 'overwritten': 0, 'transitions': 0, 'read_errors': 0}
+        self.cpu_s = 0.0
+        self.run_s = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, value: float, now: float) -> None:
+        value = min(1.0, max(0.0, value))
+        with self._lock:
+            self.ring[self._head] = int(value * 65535 + 0.5)
+            self._head = (self._head + 1) % self.capacity
+            if self._fresh == self.capacity:
+                self.counts['overwritten'] += 1
+            else:
+                self._fresh += 1
+            self.counts['samples'] += 1
+            if self.light is None:
+                self.light = value > self.threshold
+            elif self.light and value < self.threshold - self.hysteresis or \
+                    not self.light and value > self.threshold + self.hysteresis:
+                self.light = not self.light
+                self.counts['transitions'] += 1
+                self.n_transitions += 1
+                if len(self.transitions) < self.max_transitions:
+                    self.transitions.append((now, self.light))
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='light-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        gap = 1.0 / self.rate
+        c0 = time.thread_time()
+        t0 = time.monotonic()
+        tick = 0
+        while not self._stop.is_set():
+            now = time.monotonic()
+            try:
+                self.add(self.read_value(), now)
+            except (OSError, ValueError):
+                self.counts['read_errors'] += 1
+            self.cpu_s = time.thread_time() - c0
+            self.run_s = now - t0
+            # on a fixed grid, skipping any ticks missed
+            tick = max(tick + 1, int((time.monotonic() - t0) / gap))
+            self._stop.wait(max(0.0, t0 + tick * gap - time.monotonic()))
+
+    def cpu_pct(self) -> float:
+        return round(100.0 * self.cpu_s / self.run_s, 3) if self.run_s else 0.0
+
+    def summary(self) -> dict:
+        # The statistics of the samples since the last call, None when there are none.
+        with self._lock:
+            n = self._fresh
+            start = (self._head - n) % self.capacity
+            if start + n <= self.capacity:
+                window = self.ring[start:start + n]
+            else:
+                window = self.ring[start:] + self.ring[:self._head]
+            transitions = self.transitions
+            n_transitions = self.n_transitions
+            self.transitions = []
+            self.n_transitions = 0
+            self._fresh = 0
+            light = self.light
+        if not n:
+            return None
+        values = sorted(window)
+        now_m = time.monotonic()
+        now_dt = datetime.datetime.now()
+
+        def pct(p):
+            return round(values[min(n - 1, int(round(p / 100.0 * (n - 1))))] / 65535, 4)
+
+        return {
+            "light_min": round(values[0] / 65535, 4),
+            "light_max": round(values[-1] / 65535, 4),
+            "light_mean": round(sum(values) / n / 65535, 4),
+            "light_p10": pct(10),
+            "light_p50": pct(50),
+            "light_p90": pct(90),
+            "light_samples": n,
+            "light_now": light,
+            "transitions": n_transitions,
+            "transition_times": [[str(now_dt - datetime.timedelta(seconds=now_m - t)), lt] for t, lt in transitions],
+            "sampler_cpu_pct": self.cpu_pct()
+        }
+
+
+class MotionAggregator:
+    # Fuses the edges of several PIR motion sensors into occupancy windows, off the gpiozero callback
+    # thread. The pin callbacks only call edge(), which puts the event on a SimpleQueue; put never
+    # blocks, so a callback can not be held up by the network. A worker thread does the rest.
+    #
+    # A window opens on the first activation of any PIR and closes once none has been active for
+    # hold seconds. On open and on close publish_window(summary) is called with:
+    #   occupied, start, end, duration_s, counts {pir: activations}, first_seen, last_seen {pir: time},
+    #   duty_cycle (the fraction of the window any PIR was active)
+    #
+    # Per-edge publishing is coalesced: publish_edge(name) is called at most once per coalesce
+    # seconds per PIR, after the last of a burst of edges. A coalesce of 0 passes every edge through.
+
+    def __init__(self,
+                 publish_window,
+                 publish_edge=None,
+                 hold: float = 120.0,
+                 coalesce: float = 2.0
+                 ) -> None:
+        self.publish_window = publish_window
+        self.publish_edge = publish_edge
+        self.hold = hold
+        self.coalesce = coalesce
+        self.counts = {'edges': 0, 'edges_published': 0, 'windows': 0}
+        self._events = queue.SimpleQueue()
+        self._stop = threading.Event()
+        self._thread = None
+        self._active = set()
+        self._window = None
+        # name -> monotonic of the last edge publish, and names with an edge waiting to be published
+        self._edge_pub = {}
+        self._edge_due = {}
+
+    def edge(self, name: str, active: bool) -> None:
+        # Called from the pin callback thread.
+        self._events.put((name, active, time.monotonic(), datetime.datetime.now()))
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='motion-aggregator', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._events.put(None)
+
+    def _timeout(self, now: float):
+        deadlines = list(self._edge_due.values())
+        if self._window is not None and not self._active:
+            deadlines.append(self._window['last_mono'] + self.hold)
+        return max(0.0, min(deadlines) - now) if deadlines else None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                ev = self._events.get(timeout=self._timeout(time.monotonic()))
+            except queue.Empty:
+                ev = None
+            if ev is not None:
+                self._apply(*ev)
+            self._due(time.monotonic())
+
+    def _apply(self, name: str, active: bool, mono: float, wall) -> None:
+        self.counts['edges'] += 1
+        w = self._window
+        opened = False
+        if active:
+            if w is None:
+                w = self._window = {'start': wall, 'start_mono': mono, 'counts': {}, 'first_seen': {},
+                                    'last_seen': {}, 'active_s': 0.0, 'active_since': None, 'last_mono': mono}
+                opened = True
+            w['counts'][name] = w['counts'].get(name, 0) + 1
+            w['first_seen'].setdefault(name, wall)
+            if not self._active:
+                w['active_since'] = mono
+            self._active.add(name)
+        else:
+            self._active.discard(name)
+            if w is not None and not self._active and w['active_since'] is not None:
+                w['active_s'] += mono - w['active_since']
+                w['active_since'] = None
+        if w is not None:
+            w['last_seen'][name] = wall
+            w['last_mono'] = mono
+        if opened:
+            self._send_window(occupied=True, end_mono=mono)
+        if self.publish_edge is not None:
+            last = self._edge_pub.get(name)
+            self._edge_due[name] = mono if last is None else max(mono, last + self.coalesce)
+
+    def _due(self, now: float) -> None:
+        for name, due in list(self._edge_due.items()):
+            if due <= now:
+                del self._edge_due[name]
+                self._edge_pub[name] = now
+                self.counts['edges_published'] += 1
+                self.publish_edge(name)
+        w = self._window
+        if w is not None and not self._active and now - w['last_mono'] >= self.hold:
+            self._send_window(occupied=False, end_mono=now)
+            self._window = None
+
+    def summary(self, occupied: bool, end_mono: float = None) -> dict:
+        w = self._window
+        end_mono = end_mono or time.monotonic()
+        duration = end_mono - w['start_mono']
+        active_s = w['active_s'] + (end_mono - w['active_since'] if w['active_since'] is not None else 0.0)
+        return {
+            "occupied": occupied,
+            "start": w['start'],
+            "end": None if occupied else w['start'] + datetime.timedelta(seconds=duration),
+            "duration_s": round(duration, 1),
+            "counts": dict(w['counts']),
+            "first_seen": dict(w['first_seen']),
+            "last_seen": dict(w['last_seen']),
+            "duty_cycle": round(active_s / duration, 3) if duration > 0 else 1.0
+        }
+
+    def _send_window(self, occupied: bool, end_mono: float = None) -> None:
+        if not occupied:
+            self.counts['windows'] += 1
+        self.publish_window(self.summary(occupied, end_mono))
+
+
+class EdgeCapture:
+    # Every edge of an input pin, taken over from the gpiozero device using it (so that device's own
+    # events no longer fire and it should have no bounce_time). The pin callback only writes the
+    # factory's tick of the edge (pigpio's microsecond tick from pigpiod on the Pi) and the level
+    # into a preallocated ring of size edges. A thread of its own splits the edges into bursts, a
+    # burst ending once the pin has been steady for settle seconds, and each burst that leaves the
+    # pin at another level becomes an event, timed from its first edge, with the bounces (edges
+    # after the first) and settle time. Bursts that come back to the level they started from are
+    # counted as glitches. Every time is from the ticks, so a late thread or a slow publish delays
+    # an event but does not change it.
+    #
+    # Ticks become wall clock times through an anchor, a tick and time.time() taken together and
+    # renewed every anchor_int seconds, well inside pigpio's 71 minute tick wrap.
+
+    def __init__(self,
+                 pin,
+                 settle: float = 0.25,
+                 size: int = 256,
+                 on_event=None,
+                 anchor_int: float = 60.0,
+                 max_latencies: int = 64
+                 ) -> None:
+        self.pin = pin
+        self.factory = pin.factory
+        self.settle = settle
+        self.size = size
+        self.on_event = on_event
+        self.anchor_int = anchor_int
+        self.ticks = array.array('d', bytes(8 * size))
+        self.levels = array.array('b', bytes(size))
+        self._written = 0  # edges written by the callback, the ring slot is this modulo size
+        self._read = 0  # edges taken by the thread
+        self.level = bool(pin.state)
+        self.since = None  # wall time the pin settled at level, None until the first event
+        self.events = deque()
+        self.latencies = deque(maxlen=max_latencies)
+        self.counts = {'edges': 0, 'events': 0, 'bounces': 0, 'glitches': 0, 'overruns': 0}
+        self.settle_max = 0.0
+        self._burst = None  # [first tick, last tick, edges, level of last edge]
+        self._anchor = (0, 0.0)
+        self._anchor_at = 0.0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def on_change(self, ticks, state) -> None:
+        # gpiozero pin callback, on pigpio's callback thread on the Pi
+        slot = self._written % self.size
+        self.ticks[slot] = ticks
+        self.levels[slot] = state
+        self._written += 1
+        self._wake.set()
+
+    def start(self) -> None:
+        self.anchor()
+        self.pin.edges = 'both'
+        self.pin.when_changed = self.on_change
+        self._thread = threading.Thread(target=self._run, name='edge-capture', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def anchor(self) -> None:
+        # pigpio's ticks() asks pigpiod, so the wall time is taken either side of it
+        before = time.time()
+        tick = self.factory.ticks()
+        self._anchor = (tick, (before + time.time()) / 2)
+        self._anchor_at = time.monotonic()
+
+    def offset(self, later, earlier) -> float:
+        # seconds from earlier to later ticks, negative when later is the earlier one, across a wrap
+        ahead = self.factory.ticks_diff(later, earlier)
+        behind = self.factory.ticks_diff(earlier, later)
+        return ahead if abs(ahead) <= abs(behind) else -behind
+
+    def wall_time(self, tick) -> float:
+        return self._anchor[1] + self.offset(tick, self._anchor[0])
+
+    def _run(self) -> None:
+        wait = self.anchor_int
+        while not self._stop.is_set():
+            self._wake.wait(wait)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            if time.monotonic() - self._anchor_at >= self.anchor_int:
+                self.anchor()
+            wait = self.process()
+
+    def process(self) -> float:
+        # Takes the edges written since the last call and closes the bursts that have settled.
+        # Returns the seconds until the open burst, if any, settles.
+        now = self.factory.ticks() if self._written != self._read or self._burst is not None else None
+        written = self._written
+        if written - self._read > self.size:
+            self.counts['overruns'] += written - self._read - self.size
+            self._read = written - self.size
+        for i in range(self._read, written):
+            slot = i % self.size
+            tick = self.ticks[slot]
+            level = bool(self.levels[slot])
+            self.counts['edges'] += 1
+            burst = self._burst
+            if burst is not None and self.offset(tick, burst[1]) >= self.settle:
+                self._close(burst)
+                burst = None
+            if burst is None:
+                self._burst = [tick, tick, 1, level]
+            else:
+                burst[1] = tick
+                burst[2] += 1
+                burst[3] = level
+        self._read = written
+        burst = self._burst
+        if burst is None:
+            return self.anchor_int
+        quiet = self.offset(now, burst[1])
+        if quiet >= self.settle:
+            self._close(burst)
+            return self.anchor_int
+        return self.settle - quiet + 0.001
+
+    def _close(self, burst: list) -> None:
+        first, last, edges, level = burst
+        self._burst = None
+        self.counts['bounces'] += edges - 1
+        if level == self.level:
+            self.counts['glitches'] += 1
+            return
+        at = self.wall_time(first)
+        settle = self.offset(last, first)
+        self.settle_max = max(self.settle_max, settle)
+        self.events.append({"level": level,
+                            "time": at,
+                            "bounces": edges - 1,
+                            "settle_ms": round(settle * 1000.0, 3),
+                            "previous_s": None if self.since is None else round(at - self.since, 3)
+                            })
+        self.level = level
+        self.since = at
+        self.counts['events'] += 1
+        if self.on_event is not None:
+            self.on_event(level)
+
+    def take(self) -> list:
+        # The events not yet taken, oldest first. The time from each edge to its being taken is kept
+        # as that event's latency.
+        taken = []
+        while True:
+            try:
+                event = self.events.popleft()
+            except IndexError:
+                break
+            event["latency_ms"] = round((time.time() - event["time"]) * 1000.0, 3)
+            self.latencies.append(event["latency_ms"])
+            taken.append(event)
+        return taken
+
+    def report(self) -> dict:
+        lat = sorted(self.latencies)
+        n = len(lat)
+
+        def pct(p):
+            return lat[min(n - 1, int(round(p / 100.0 * (n - 1))))] if n else None
+
+        report = dict(self.counts)
+        report.update({"latency_ms_p50": pct(50), "latency_ms_p95": pct(95), "latency_ms_max": pct(100),
+                       "settle_ms_max": round(self.settle_max * 1000.0, 3)})
+        return report
@@ -0,0 +1,830 @@
+# sens_registry.py
+# The sensors pizero_mqtt_monitor.py publishes are described by a config file rather than by
+# module globals. Each entry in the config's sensors list names a sensor type and its pin, topic,
+# poll interval and change-only filter. SensorRegistry builds the devices from that, registers
+# the gpiozero state change callbacks and hands back the polling jobs for the scheduler. Adding
+# another door, PIR, LDR, etc. is a config change.
+#
+# The config may be YAML (needs PyYAML), TOML or JSON. Anything not given in it falls back to
+# DEFAULT_CONFIG, which matches the original pizero-z01 garage setup.
+#
+# gpiozero is imported by the sensors' setup(), so loading the config and connecting to the broker
+# do not wait on it. bring_up() builds the sensors' devices concurrently, each sensor publishing
+# its first reading as soon as it is up.
+#
+import concurrent.futures
+import contextlib
+import copy
+import datetime
+import functools
+import json
+import os
+import time
+import sens_help
+import net_help
+import pub_help
+
+DEFAULT_CONFIG = {
+    'device': {
+        'hostname': 'raspberrypi-z01',
+        'name': 'pizero-z01',
+        'client_id': 'raspberrypi-z01',
+        'topic_prefix': 'rpiz01/garage/',
+    },
+    'mqtt': {
+        'broker': '192.168.1.110',
+        'port': 1883,
+        'keepalive': 90,
+        # '3.1.1' or '5', see pub_help.PublishProperties
+        'protocol': '3.1.1',
+        'max_inflight': 10,
+        'no_delay': True,
+        # qos and (v5) retained message expiry per topic, see pub_help.PublishPolicy
+        'policy': {
+            'qos': 0,
+            'expiry': 900,
+            'topics': {'garage_dr': {'qos': 1, 'expiry': 0}},
+        },
+    },
+    'publish': {
+        'avail_topic': 'LWT',
+        'startup_topic': 'startup',
+        'still_alive_int': 62,
+        'max_silence': 300,
+        'spool_dir': 'spool',
+        'max_mem': 200,
+        'max_disk_bytes': 2_000_000,
+        'replay_rate': 20.0,
+        # aggregated mode, one device state payload instead of a publish per sensor topic
+        'batch': {
+            'enabled': False,
+            'topic': 'state',
+            'window': 1.0,
+            'encoding': 'json',
+            'snapshot': True,
+        },
+    },
+    # PIR edges fused into occupancy windows, see sens_help.MotionAggregator
+    'motion': {
+        'enabled': False,
+        'sensors': ['pir_a', 'pir_b'],
+        'topic': 'occupancy',
+        'hold': 120.0,
+        'coalesce': 2.0,
+    },
+    # Live changes sent to <topic_prefix><topic>, acknowledged on <topic_prefix><topic>/ack, see cmd_help.py.
+    # Off unless turned on, anyone who can publish to the broker can send them.
+    'command': {
+        'enabled': False,
+        'topic': 'cmd',
+        'rate': 0.5,
+        'burst': 5,
+        'max_queue': 10,
+        'min_interval': 5.0,
+    },
+    # Instrumentation, served on http://http_host:http_port/metrics and published to topic
+    'metrics': {
+        'enabled': True,
+        'http_host': '127.0.0.1',
+        'http_port': 9108,
+        'topic': 'diagnostics',
+        'publish_int': 300,
+    },
+    # Stretches the polling of the jobs in tiers when the Pi runs hot or busy, see gov_help.py.
+    # temp_high None is the cpu sensor's threshold.
+    'governor': {
+        'enabled': True,
+        'interval': 30,
+        'topic': 'governor',
+        'temp_high': None,
+        'temp_band': 10.0,
+        'load_low': 0.8,
+        'load_high': 2.0,
+        'backlog_low': 20,
+        'backlog_high': 150,
+        'max_stretch': 4.0,
+        'step': 0.5,
+        'cool_down': 3,
+        'tiers': [['wifi', 'device_ip'], ['temperature', 'lightsensed', 'diagnostics', 'history_flush']],
+    },
+    # On-device history of the readings, queried on <topic_prefix><topic>/query, see history_help.py
+    'history': {
+        'enabled': True,
+        'file': 'history.ts',
+        'size_kb': 1024,
+        'flush_int': 300,
+        'topic': 'history',
+        'chunk': 50,
+        'max_rows': 5000,
+    },
+    'discovery': {
+        'enabled': True,
+        'prefix': 'homeassistant',
+        'state_file': 'discovery_state.json',
+    },
+    # Running off a Pi, see sim_help.py and the -s argument. waves are square waves driven onto
+    # the mock input pins, each edge with bounces extra flips, events one off (seconds, pin, level)
+    # drives.
+    # Polling job phases, see sched_help.PhaseScheduler. Off, every job starts from start up.
+    'schedule': {
+        'spread': True,
+        'slot': 1.0,
+        'max_io': 2,
+    },
+    # One gateway serving several sensor groups, see fleet_help.py. No groups is this device only.
+    'fleet': {
+        'groups': [],
+        'workers': 0,
+        'connections': 1,
+        'status_topic': 'fleet/',
+        'gateway_id': None,
+    },
+    # threads: apscheduler and paho's network thread, asyncio: one event loop, see async_help.py
+    'runtime': {
+        'mode': 'threads',
+        'bring_up_workers': 4,
+    },
+    'simulate': {
+        'enabled': False,
+        'broker_port': 18830,
+        'ldr_charge_time': 0.004,
+        'waves': [
+            {'pin': 27, 'period': 30.0, 'duty': 0.5, 'bounces': 3},
+            {'pin': 24, 'period': 20.0, 'duty': 0.25, 'phase': 5.0},
+            {'pin': 11, 'period': 45.0, 'duty': 0.2, 'phase': 12.0},
+        ],
+        'events': [],
+    },
+    'sensors': [
+        {'name': 'temperature', 'type': 'ds18x20', 'topic': 'temperature', 'interval': 60,
+         'sample_int': 30, 'filter': {'deadbands': {'temperature': 0.2}}},
+        {'name': 'garage_dr', 'type': 'door', 'pin': 27, 'topic': 'garage_dr', 'interval': 60,
+         'bounce_time': 0.25, 'capture': True, 'capture_len': 256},
+        {'name': 'pir_a', 'type': 'pir', 'pin': 24, 'topic': 'pir_a_activity', 'interval': 90,
+         'queue_len': 1, 'sample_rate': 10, 'threshold': 0.5, 'warmup': 60},
+        {'name': 'pir_b', 'type': 'pir', 'pin': 11, 'topic': 'pir_b_activity', 'interval': 90,
+         'queue_len': 1, 'sample_rate': 10, 'threshold': 0.5, 'warmup': 60},
+        {'name': 'lightsensed', 'type': 'ldr', 'pin': 23, 'topic': 'lightsensed', 'interval': 66,
+         'queue_len': 5, 'charge_time_limit': 0.01, 'threshold': 0.1,
+         'filter': {'deadbands': {'light_sensed_value': 0.02}}},
+        {'name': 'cpu_temperature', 'type': 'cpu', 'topic': 'cpu_temperature', 'interval': 30,
+         'threshold': 80.0, 'event_delay': 10.0, 'filter': {'deadbands': {'cpu_temp_c': 1.0}}},
+        {'name': 'wifi', 'type': 'wifi', 'interface': 'wlan0', 'topic': 'wifi', 'interval': 60,
+         'filter': {'deadbands': {'iw_dbm': 3}, 'ignore': ['iw_ctm']}},
+        {'name': 'device_ip', 'type': 'ip', 'interface': None, 'led_pin': 20, 'topic': 'device_ip',
+         'interval': 300},
+    ],
+}
+
+
+def merge_config(base: dict, over: dict) -> dict:
+    # Nested dicts are merged key by key, anything else (including the sensors list) replaces.
+    merged = copy.deepcopy(base)
+    for key, value in (over or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def load_config(path: str = None) -> dict:
+    if not path:
+        return copy.deepcopy(DEFAULT_CONFIG)
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError(f'PyYAML is needed to read {path}, ie sudo apt install python3-yaml')
+        with open(path, 'r') as f:
+            cfg = yaml.safe_load(f)
+    elif ext == '.toml':
+        import tomllib
+        with open(path, 'rb') as f:
+            cfg = tomllib.load(f)
+    elif ext == '.json':
+        with open(path, 'r') as f:
+            cfg = json.load(f)
+    else:
+        raise ValueError(f'Config file {path} is not .yaml, .toml or .json')
+    return merge_config(DEFAULT_CONFIG, cfg)
+
+
+# -- sensor types
+class Sensor:
+    # One configured sensor. read() returns the changing payload fields of a reading, in payload
+    # order. static fields follow them in every payload. edges are the gpiozero event attributes
+    # that publish a reading when they fire. entities are the Home Assistant entities each topic
+    # gives, as (component, key suffix, discovery fields); see ha_help.py.
+    kind = ''
+    edges = ()
+    static = {}
+    entities = ()
+    with_client_id = True
+    startup_read = True
+
+    def __init__(self, spec: dict, registry) -> None:
+        self.spec = spec
+        self.registry = registry
+        self.name = spec.get('name', self.kind)
+        self.topic = registry.topic_prefix + spec.get('topic', self.name)
+        self.interval = spec.get('interval')
+        self.device = None
+
+    def opt(self, key: str, default=None):
+        return self.spec.get(key, default)
+
+    def setup(self) -> None:
+        pass
+
+    def start(self) -> None:
+        pass
+
+    def close(self) -> None:
+        if self.device is not None and hasattr(self.device, 'close'):
+            self.device.close()
+
+    def topics(self) -> list:
+        return [self.topic]
+
+    def state_key(self, topic: str) -> str:
+        # The key a reading on topic has in the batched device state payload, ie temperature or
+        # temperature/28-xxxxxxxxxxxx
+        return self.name + topic[len(self.topic):]
+
+    def read(self) -> dict:
+        raise NotImplementedError
+
+    def threshold(self):
+        # None for a sensor without one
+        return None
+
+    def set_threshold(self, value: float) -> None:
+        raise ValueError(f'{self.name} has no threshold')
+
+    def ha_entities(self) -> list:
+        # [(state topic, component, key, discovery fields), ...]. A sensor's discovery option can
+        # be false to leave it out, or a list of {component, key, ...fields} to replace the defaults.
+        entities = self.opt('discovery', self.entities)
+        if not entities:
+            return []
+        ents = []
+        for topic in self.topics():
+            key = self.state_key(topic)
+            for ent in entities:
+                if isinstance(ent, dict):
+                    fields = dict(ent)
+                    component = fields.pop('component')
+                    suffix = fields.pop('key')
+                else:
+                    component, suffix, fields = ent
+                ents.append((topic, component, f'{key}-{suffix}', fields))
+        return ents
+
+    def readings(self) -> list:
+        # [(topic, values, time taken or None for now), ...]
+        return [(self.topic, self.read(), None)]
+
+    def event_device(self):
+        # what the gpiozero state change callbacks named by edges are set on
+        return self.device
+
+
+class DS18x20Sensor(Sensor):
+    # Every 28-* device found is sampled in the background, see sens_help.DS18x20Sampler. The first
+    # publishes on topic, any others on topic/<device id>.
+    kind = 'ds18x20'
+    static = {"temp_unit": "F"}
+    entities = (
+        ('sensor', 'temp', {"device_class": "temperature", "unit_of_measurement": "°F",
+                            "state_class": "measurement", "value_template": "{{ value_json.temperature }}"}),
+    )
+
+    def setup(self) -> None:
+        sample_int = self.opt('sample_int', 30)
+        self.device = sens_help.TheDS18x20(base_dir=self.opt('w1_base_dir', '/sys/bus/w1/devices/'),
+                                           modprobe=self.opt('modprobe', True))
+        self.sampler = sens_help.DS18x20Sampler(self.device,
+                                                interval=sample_int,
+                                                max_tries=self.opt('max_tries', 5),
+                                                max_age=self.opt('max_age', 3 * sample_int)
+                                                )
+
+    def start(self) -> None:
+        self.sampler.start()
+        # give the first conversion a chance before the startup reads
+        if self.sampler.device_ids():
+            self.sampler.wait_ready(timeout=2.0)
+
+    def close(self) -> None:
+        self.sampler.stop()
+
+    def dev_topic(self, dev_id: str) -> str:
+        return self.topic if dev_id == self.sampler.primary_id() else self.topic + '/' + dev_id
+
+    def topics(self) -> list:
+        return [self.dev_topic(dev_id) for dev_id in self.sampler.device_ids()] or [self.topic]
+
+    def readings(self) -> list:
+        rds = []
+        for dev_id in self.sampler.device_ids():
+            rd = self.sampler.reading(dev_id)
+            if rd is None:
+                if self.registry.verbose:
+                    self.registry.log(f'{self.name}: no current reading from {dev_id}')
+                continue
+            rds.append((self.dev_topic(dev_id), {"temperature": rd[0]}, rd[1]))
+        return rds
+
+
+class DoorSensor(Sensor):
+    # A reed switch seeing a strong magnet. With capture every edge of the pin is captured with its
+    # pigpio tick, see sens_help.EdgeCapture, bounce_time being the time the switch must be steady.
+    # A state change is then published with the time of its first edge rather than the time it was
+    # published, along with its bounces, settle time, how long the door was in the state before
+    # and the latency from the edge. capture_len edges are buffered.
+    kind = 'door'
+    edges = ('when_activated', 'when_deactivated')
+
+    def __init__(self, spec: dict, registry) -> None:
+        super().__init__(spec, registry)
+        self.field = self.opt('field', self.name)
+        self.entities = (
+            ('binary_sensor', 'state', {"device_class": "opening", "payload_on": "open", "payload_off": "closed",
+                                        "value_template": "{{ value_json.%s }}" % self.field}),
+        )
+        self.capture = None
+        # the gpiozero state change callbacks, set in place of the Button's own when capturing
+        self.when_activated = None
+        self.when_deactivated = None
+
+    def setup(self) -> None:
+        from gpiozero import Button
+        capture = self.opt('capture', False)
+        self.device = Button(pin=self.opt('pin'),
+                             pull_up=self.opt('pull_up'),
+                             active_state=self.opt('active_state', False),
+                             bounce_time=None if capture else self.opt('bounce_time', 0.25),
+                             pin_factory=self.registry.pin_factory
+                             )
+        if capture:
+            pull_up = self.opt('pull_up')
+            self.active_level = bool(self.opt('active_state', False)) if pull_up is None else not pull_up
+            self.capture = sens_help.EdgeCapture(self.device.pin,
+                                                 settle=self.opt('bounce_time', 0.25) or 0.0,
+                                                 size=self.opt('capture_len', 256),
+                                                 on_event=self.on_capture
+                                                 )
+
+    def start(self) -> None:
+        if self.capture is not None:
+            self.capture.start()
+
+    def close(self) -> None:
+        if self.capture is not None:
+            self.capture.stop()
+        super().close()
+
+    def event_device(self):
+        return self.device if self.capture is None else self
+
+    def on_capture(self, level: bool) -> None:
+        callback = self.when_activated if level == self.active_level else self.when_deactivated
+        if callback is not None:
+            callback()
+
+    def state(self, active: bool) -> str:
+        return "closed" if active else "open"
+
+    def read(self) -> dict:
+        if self.capture is not None:
+            return {self.field: self.state(self.capture.level == self.active_level)}
+        return {self.field: self.state(self.device.is_active)}
+
+    def readings(self) -> list:
+        if self.capture is None:
+            return super().readings()
+        rds = []
+        for event in self.capture.take():
+            values = {self.field: self.state(event["level"] == self.active_level),
+                      "bounces": event["bounces"],
+                      "settle_ms": event["settle_ms"]}
+            if event["previous_s"] is not None:
+                values[self.state(event["level"] != self.active_level) + "_s"] = event["previous_s"]
+            values["latency_ms"] = event["latency_ms"]
+            rds.append((self.topic, values, datetime.datetime.fromtimestamp(event["time"])))
+        return rds or super().readings()
+
+
+class PirSensor(Sensor):
+    # The PIR motion sensor takes about 60 sec. to stabilize. Just in case it has not warmed up
+    # during the Pizero boot time, nothing is published until warmup seconds after start up.
+    kind = 'pir'
+    edges = ('when_activated', 'when_deactivated')
+    startup_read = False
+    entities = (
+        ('binary_sensor', 'motion', {"device_class": "motion", "payload_on": "True", "payload_off": "False",
+                                     "value_template": "{{ value_json.detected }}"}),
+        ('sensor', 'value', {"state_class": "measurement", "value_template": "{{ value_json.motion | round(3) }}"}),
+    )
+
+    def setup(self) -> None:
+        from gpiozero import MotionSensor
+        self.device = MotionSensor(pin=self.opt('pin'),
+                                   pull_up=self.opt('pull_up'),
+                                   queue_len=self.opt('queue_len', 1),
+                                   active_state=self.opt('active_state', True),
+                                   sample_rate=self.opt('sample_rate', 10),
+                                   threshold=self.opt('threshold', 0.5),
+                                   partial=False,
+                                   pin_factory=self.registry.pin_factory
+                                   )
+
+    def warmed_up(self) -> bool:
+        return time.monotonic() - self.registry.st_t > self.opt('warmup', 60)
+
+    def threshold(self):
+        return self.device.threshold
+
+    def set_threshold(self, value: float) -> None:
+        if not 0.0 < value < 1.0:
+            raise ValueError('threshold is between 0 and 1 exclusive')
+        self.device.threshold = value
+
+    def read(self) -> dict:
+        return {"motion": self.device.value, "detected": self.device.is_active}
+
+    def readings(self) -> list:
+        return super().readings() if self.warmed_up() else []
+
+
+class LdrSensor(Sensor):
+    # With sample_hz the light level is also sampled that many times a second in the background,
+    # see sens_help.LightSampler, and each reading carries the statistics of the samples since the
+    # one before.
+    kind = 'ldr'
+    edges = ('when_dark', 'when_light')
+    entities = (
+        ('binary_sensor', 'state', {"device_class": "light", "payload_on": "True", "payload_off": "False",
+                                    "value_template": "{{ value_json.light_sensed_state }}"}),
+        ('sensor', 'value', {"state_class": "measurement",
+                             "value_template": "{{ value_json.light_sensed_value | round(3) }}"}),
+    )
+    sampled_entities = (
+        ('sensor', 'max', {"state_class": "measurement", "value_template": "{{ value_json.light_max | round(3) }}"}),
+        ('sensor', 'transitions', {"state_class": "measurement", "value_template": "{{ value_json.transitions }}"}),
+    )
+
+    def __init__(self, spec: dict, registry) -> None:
+        super().__init__(spec, registry)
+        self.sampler = None
+        if self.opt('sample_hz'):
+            self.entities = self.entities + self.sampled_entities
+
+    def setup(self) -> None:
+        from gpiozero import LightSensor
+        sample_hz = self.opt('sample_hz')
+        self.device = LightSensor(pin=self.opt('pin'),
+                                  queue_len=self.opt('queue_len', 1 if sample_hz else 5),
+                                  charge_time_limit=self.opt('charge_time_limit', 0.01),
+                                  threshold=self.opt('threshold', 0.1),
+                                  partial=False,
+                                  pin_factory=self.registry.pin_factory
+                                  )
+        if sample_hz:
+            # room for a poll interval and a quarter of samples
+            capacity = self.opt('sample_capacity', int(sample_hz * (self.interval or 60) * 1.25))
+            self.sampler = sens_help.LightSampler(lambda: self.device.value,
+                                                  rate=sample_hz,
+                                                  capacity=capacity,
+                                                  threshold=self.opt('threshold', 0.1),
+                                                  hysteresis=self.opt('hysteresis', 0.02),
+                                                  max_transitions=self.opt('max_transitions', 32)
+                                                  )
+
+    def start(self) -> None:
+        if self.sampler is not None:
+            self.sampler.start()
+
+    def close(self) -> None:
+        if self.sampler is not None:
+            self.sampler.stop()
+        super().close()
+
+    def threshold(self):
+        return self.device.threshold
+
+    def set_threshold(self, value: float) -> None:
+        if not 0.0 < value < 1.0:
+            raise ValueError('threshold is between 0 and 1 exclusive')
+        self.device.threshold = value
+        if self.sampler is not None:
+            self.sampler.threshold = value
+
+    def read(self) -> dict:
+        values = {"light_sensed_state": self.device.light_detected,
+                  "light_sensed_value": self.device.value}
+        if self.sampler is not None:
+            values.update(self.sampler.summary() or {})
+        return values
+
+
+class CpuSensor(Sensor):
+    kind = 'cpu'
+    entities = (
+        ('sensor', 'temp-c', {"device_class": "temperature", "unit_of_measurement": "°C",
+                              "state_class": "measurement", "value_template": "{{ value_json.cpu_temp_c }}"}),
+        ('binary_sensor', 't-state', {"device_class": "heat", "payload_on": "True", "payload_off": "False",
+                                      "value_template": "{{ value_json.cpu_hot }}"}),
+    )
+
+    def setup(self) -> None:
+        self.device = sens_help.CPUTempState(sensor_file=self.opt('sensor_file', '/sys/class/thermal/thermal_zone0/temp'),
+                                             threshold=self.opt('threshold', 80.0),
+                                             event_delay=self.opt('event_delay', 10.0))
+
+    def close(self) -> None:
+        self.device.cpu_temp.close()
+
+    def threshold(self):
+        return self.device.cpu_temp.threshold
+
+    def set_threshold(self, value: float) -> None:
+        cpu_temp = self.device.cpu_temp
+        if not cpu_temp.min_temp <= value <= cpu_temp.max_temp:
+            raise ValueError(f'threshold is from {cpu_temp.min_temp} to {cpu_temp.max_temp}')
+        cpu_temp.threshold = value
+
+    def read(self) -> dict:
+        cpu_temp_c, cpu_hot = self.device.cpu_temp_state()
+        return {"cpu_temp_c": cpu_temp_c, "cpu_hot": cpu_hot}
+
+
+class WifiSensor(Sensor):
+    kind = 'wifi'
+    entities = (
+        ('sensor', 'signal', {"device_class": "signal_strength", "unit_of_measurement": "dBm",
+                              "state_class": "measurement", "value_template": "{{ value_json.iw_dbm }}"}),
+        ('sensor', 'tconnect', {"device_class": "duration", "unit_of_measurement": "s",
+                                "value_template": "{{ value_json.iw_ctm }}"}),
+    )
+
+    def setup(self) -> None:
+        self.device = net_help.wifi_stats_provider(self.opt('interface', 'wlan0'),
+                                                   self.opt('backend', 'auto'))
+
+    def read(self) -> dict:
+        iw_dbm, iw_ctm = self.device.read()
+        return {"iw_dbm": iw_dbm, "iw_ctm": iw_ctm}
+
+
+class IpSensor(Sensor):
+    # The address is kept by a net_help.IfaceMonitor, which looks again only when the kernel says a
+    # link or address changed, and a change is published right away. The LED on led_pin blinks
+    # while the Pi has an address and is off when it is off the LAN; it is only touched when the
+    # address changes, so the blink is not restarted by every poll.
+    kind = 'ip'
+    with_client_id = False
+    entities = (
+        ('sensor', 'address', {"icon": "mdi:ip-network", "value_template": "{{ value_json.device_ip }}"}),
+    )
+    startup_read = False
+
+    def setup(self) -> None:
+        self.led = None
+        if self.opt('led_pin') is not None:
+            from gpiozero import LED
+            self.led = LED(self.opt('led_pin'), pin_factory=self.registry.pin_factory)
+            self.led.off()
+        self.device = net_help.IfaceMonitor(net_help.iface_source(self.opt('backend', 'auto'),
+                                                                  poll_int=self.opt('poll_int', 60.0)),
+                                            interface_name=self.opt('interface'),
+                                            resync_int=self.opt('resync_int', 300.0))
+
+    def start(self) -> None:
+        publish = self.registry.edge_callback(self.name, functools.partial(self.registry.snd, self, True))
+
+        def on_change(address):
+            self.show(address)
+            publish()
+
+        self.device.on_change = on_change
+        self.device.start()
+        self.show(self.device.address)
+
+    def show(self, address: str) -> None:
+        if self.led is not None:
+            if address == net_help.OFF_LAN:
+                self.led.off()
+            else:
+                self.led.blink(1, 4)
+
+    def close(self) -> None:
+        self.device.stop()
+        self.device.source.close()
+        if self.led is not None:
+            self.led.close()
+
+    def read(self) -> dict:
+        return {"device_ip": self.device.address or net_help.OFF_LAN}
+
+
+sensor_kinds = {cls.kind: cls for cls in (DS18x20Sensor, DoorSensor, PirSensor, LdrSensor,
+                                          CpuSensor, WifiSensor, IpSensor)}
+
+
+class SensorRegistry:
+    # Builds the configured sensors and publishes their readings through publish(topic, payload,
+    # retain, qos). Each published reading is passed to log when verbose is set. A failed read is
+    # passed to log too and raised again for the scheduler; the monitor's log is do_msg, so that
+    # line only shows with -d.
+
+    def __init__(self, cfg: dict, publish, log=print, st_t: float = None, pin_factory=None) -> None:
+        self.cfg = cfg
+        self.client_id = cfg['device']['client_id']
+        self.topic_prefix = cfg['device']['topic_prefix']
+        self.publish = publish
+        self.log = log
+        self.verbose = False
+        # instrument(name, fn) may wrap every job and state change callback, ie to time them
+        self.instrument = None
+        # edge_runner(fn) may wrap every state change callback, ie async_help.to_loop to run them
+        # on the event loop instead of the pin factory's callback thread
+        self.edge_runner = None
+        # recorder(topic, values, when) is given every reading published, ie to keep a history
+        self.recorder = None
+        self.st_t = time.monotonic() if st_t is None else st_t
+        # None is gpiozero's default pin factory
+        self.pin_factory = pin_factory
+        self.pub_filter = pub_help.PublishFilter()
+        # sensor name -> pub_help.PayloadTemplate, made on first publish
+        self.templates = {}
+        self.clock = pub_help.Timestamps()
+        self.policy = pub_help.PublishPolicy(cfg['mqtt'].get('policy'), self.topic_prefix)
+        self.batcher = None
+        batch_cfg = cfg['publish'].get('batch') or {}
+        if batch_cfg.get('enabled'):
+            batch_topic = self.topic_prefix + batch_cfg.get('topic', 'state')
+            self.batcher = pub_help.BatchPublisher(publish,
+                                                   topic=batch_topic,
+                                                   client_id=self.client_id,
+                                                   window=batch_cfg.get('window', 1.0),
+                                                   encoding=batch_cfg.get('encoding', 'json'),
+                                                   snapshot=batch_cfg.get('snapshot', True),
+                                                   qos=self.policy.qos(batch_topic)
+                                                   )
+        self.motion = None
+        self.sensors = []
+        for spec in cfg['sensors']:
+            if not spec.get('enabled', True):
+                continue
+            if spec.get('type') not in sensor_kinds:
+                raise ValueError(f"Unknown sensor type {spec.get('type')} for {spec.get('name')}")
+            self.sensors.append(sensor_kinds[spec['type']](spec, self))
+
+    def get(self, name: str) -> Sensor:
+        for sensor in self.sensors:
+            if sensor.name == name:
+                return sensor
+        raise KeyError(name)
+
+    def setup(self) -> None:
+        for sensor in self.sensors:
+            self.setup_sensor(sensor)
+        self.setup_motion()
+
+    def setup_sensor(self, sensor: Sensor) -> None:
+        sensor.setup()
+        flt = sensor.opt('filter', {}) or {}
+        for topic in sensor.topics():
+            self.pub_filter.add_rule(topic,
+                                     deadbands=flt.get('deadbands'),
+                                     ignore=flt.get('ignore', ()),
+                                     max_silence=flt.get('max_silence', self.cfg['publish']['max_silence']))
+
+    def setup_motion(self) -> None:
+        motion_cfg = self.cfg.get('motion') or {}
+        if motion_cfg.get('enabled'):
+            self.motion = sens_help.MotionAggregator(self.snd_occupancy,
+                                                     publish_edge=lambda name: self.snd(self.get(name), True),
+                                                     hold=motion_cfg.get('hold', 120.0),
+                                                     coalesce=motion_cfg.get('coalesce', 2.0)
+                                                     )
+            self.motion_topic = self.topic_prefix + motion_cfg.get('topic', 'occupancy')
+
+    def start(self) -> None:
+        for sensor in self.sensors:
+            sensor.start()
+        if self.motion is not None:
+            self.motion.start()
+
+    def bring_up(self, workers: int = 4, phase=None) -> None:
+        # setup(), start(), register_callbacks() and startup_reads() in one, workers sensors at a
+        # time. Each sensor is read as soon as it is up rather than after the slowest (the 1-wire
+        # bus, a first DS18x20 conversion). phase(name) may be a context manager timing each
+        # sensor's bring-up, ie StartupTimer.phase. The first error raised is raised again once the
+        # others are up.
+        self.setup_motion()
+
+        def up(sensor):
+            with phase(f'device.{sensor.name}') if phase is not None else contextlib.nullcontext():
+                self.setup_sensor(sensor)
+                sensor.start()
+                self.sensor_callbacks(sensor)
+                if sensor.startup_read:
+                    self.snd(sensor)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers),
+                                                   thread_name_prefix='bring-up') as pool:
+            futures = [pool.submit(up, sensor) for sensor in self.sensors]
+        if self.motion is not None:
+            self.motion.start()
+        for future in futures:
+            future.result()
+
+    def close(self) -> None:
+        if self.motion is not None:
+            self.motion.stop()
+        for sensor in self.sensors:
+            sensor.close()
+
+    def register_callbacks(self) -> None:
+        # Register the gpiozero state change callbacks. PIRs that feed the motion aggregator hand
+        # their edges to it instead, it publishes from its own thread.
+        for sensor in self.sensors:
+            self.sensor_callbacks(sensor)
+
+    def sensor_callbacks(self, sensor: Sensor) -> None:
+        motion_names = self.cfg['motion'].get('sensors', ()) if self.motion is not None else ()
+        if sensor.name in motion_names:
+            sensor.device.when_activated = self.edge_callback(sensor.name,
+                                                              functools.partial(self.motion_edge, sensor, True))
+            sensor.device.when_deactivated = self.edge_callback(sensor.name,
+                                                                functools.partial(self.motion_edge, sensor, False))
+            return
+        for edge in sensor.edges:
+            setattr(sensor.event_device(), edge,
+                    self.edge_callback(sensor.name, functools.partial(self.snd, sensor, True)))
+
+    def wrap(self, name: str, fn):
+        return fn if self.instrument is None else self.instrument(name, fn)
+
+    def edge_callback(self, name: str, fn):
+        fn = self.wrap(f'{name}.edge', fn)
+        return fn if self.edge_runner is None else self.edge_runner(fn)
+
+    def motion_edge(self, sensor: Sensor, active: bool) -> None:
+        if sensor.warmed_up():
+            self.motion.edge(sensor.name, active)
+
+    def snd_occupancy(self, summary: dict) -> None:
+        pld = {"time": datetime.datetime.now(), "client_id": self.client_id}
+        pld.update(summary)
+        if self.verbose:
+            self.log(f'Occupancy: {summary}')
+        self.publish(topic=self.motion_topic, payload=json.dumps(pld, default=str), retain=True,
+                     qos=self.policy.qos(self.motion_topic))
+
+    def jobs(self) -> list:
+        # [(job id, function, interval seconds), ...] for every sensor with a poll interval
+        return [(sensor.name, self.wrap(sensor.name, functools.partial(self.snd, sensor)), sensor.interval)
+                for sensor in self.sensors if sensor.interval]
+
+    def startup_reads(self) -> None:
+        for sensor in self.sensors:
+            if sensor.startup_read:
+                self.snd(sensor)
+
+    def payload(self, sensor: Sensor, values: dict, when, stamp: str = None) -> str:
+        # The same bytes as json.dumps of {"time", "client_id", values, static} with default=str,
+        # from the sensor's precompiled template. stamp is the time as str(datetime) writes it.
+        template = self.templates.get(sensor.name)
+        if template is None:
+            template = pub_help.PayloadTemplate(self.client_id if sensor.with_client_id else None, sensor.static)
+            self.templates[sensor.name] = template
+        return template.render(values, stamp or (str(when) if when else self.clock.now()))
+
+    def snd(self, sensor: Sensor, event: bool = False) -> None:
+        # event is True when called for a gpiozero state change. In aggregated mode those are sent
+        # right away instead of waiting out the batch window.
+        try:
+            for topic, values, when in sensor.readings():
+                if not self.pub_filter.should_send(topic, values):
+                    continue
+                # one time for the debug output and the payload
+                stamp = str(when) if when else self.clock.now()
+                if self.verbose:
+                    self.log(f'{sensor.name}: {values} - {stamp}')
+                if self.recorder is not None:
+                    self.recorder(topic, values, when)
+                if self.batcher is not None:
+                    self.batcher.add(sensor.state_key(topic), values)
+                else:
+                    self.publish(topic=topic, payload=self.payload(sensor, values, when, stamp), retain=True,
+                                 qos=self.policy.qos(topic))
+            if event and self.batcher is not None:
+                self.batcher.flush()
+        except Exception as error:
+            self.log(f'Exception error reading {sensor.name}.')
+            raise error
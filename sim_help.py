@@ -0,0 +1,469 @@
+# sim_help.py
+# A hardware-free simulation backend for pizero_mqtt_monitor.py, for trying and benchmarking the
+# monitor off a Pi (see bench_help.py e2e). python3 pizero_mqtt_monitor.py -s -d runs the whole
+# monitor against:
+#   - gpiozero's MockFactory, with PinScript driving the input pins through scripted waveforms
+#   - FakeSysfs, a temp dir of DS18x20 w1_slave and thermal_zone temp files with drifting values
+#   - SimBroker, a minimal in-process MQTT broker that time stamps everything it receives
+#
+import heapq
+import math
+import os
+import shutil
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+
+
+# -- fake 1-wire and thermal files
+def write_w1_slave(path: str, temp_c: float, crc_ok: bool = True) -> None:
+    t = int(round(temp_c * 1000))
+    with open(path, 'w') as f:
+        f.write(f'72 01 4b 46 7f ff 0e 10 57 : crc=57 {"YES" if crc_ok else "NO"}\n')
+        f.write(f'72 01 4b 46 7f ff 0e 10 57 t={t}\n')
+
+
+def write_thermal(path: str, temp_c: float) -> None:
+    with open(path, 'w') as f:
+        f.write(f'{int(round(temp_c * 1000))}\n')
+
+
+class FakeSysfs:
+    # Stands in for /sys/bus/w1/devices/ and /sys/class/thermal/thermal_zone0/temp. The values
+    # drift along slow sine waves while started.
+
+    def __init__(self,
+                 ds_ids=('28-00000a1b2c3d',),
+                 temp_c: float = 21.5,
+                 cpu_c: float = 47.0,
+                 root: str = None
+                 ) -> None:
+        self.root = root or tempfile.mkdtemp(prefix='pizero-sim-')
+        self.w1_base_dir = os.path.join(self.root, 'w1', 'devices') + os.sep
+        self.thermal_file = os.path.join(self.root, 'thermal_zone0', 'temp')
+        self.ds_ids = list(ds_ids)
+        self.temp_c = temp_c
+        self.cpu_c = cpu_c
+        os.makedirs(os.path.dirname(self.thermal_file), exist_ok=True)
+        for ds_id in self.ds_ids:
+            os.makedirs(os.path.join(self.w1_base_dir, ds_id), exist_ok=True)
+        self._stop = threading.Event()
+        self.update(0.0)
+
+    def update(self, t: float) -> None:
+        for i, ds_id in enumerate(self.ds_ids):
+            write_w1_slave(os.path.join(self.w1_base_dir, ds_id, 'w1_slave'),
+                           self.temp_c + i + 2.0 * math.sin(t / 600.0))
+        write_thermal(self.thermal_file, self.cpu_c + 5.0 * math.sin(t / 120.0))
+
+    def start(self, interval: float = 5.0) -> None:
+        t0 = time.monotonic()
+
+        def run():
+            while not self._stop.wait(interval):
+                self.update(time.monotonic() - t0)
+
+        threading.Thread(target=run, name='fake-sysfs', daemon=True).start()
+
+    def close(self) -> None:
+        self._stop.set()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+# -- scripted pin waveforms
+def mock_factory(charging_pins=(), charge_time: float = 0.004):
+    # A gpiozero MockFactory. charging_pins (LDR pins) are MockChargingPins so a LightSensor works.
+    from gpiozero.pins.mock import MockFactory, MockChargingPin
+    factory = MockFactory()
+    for pin in charging_pins:
+        factory.pin(pin, pin_class=MockChargingPin, charge_time=charge_time)
+    return factory
+
+
+class PinScript:
+    # Drives mock input pins. waves are square waves, each {pin, period, duty (fraction high),
+    # phase (seconds), bounces, bounce_gap (seconds)}, every edge followed by bounces flips back and
+    # forth bounce_gap apart, as a switch contact bounces; events are one off (seconds from start,
+    # pin, level). Every drive is logged as (time.monotonic_ns(), pin, level) so a benchmark can
+    # match it to what the broker receives.
+
+    def __init__(self, factory, waves=(), events=(), log_len: int = 10000) -> None:
+        self.factory = factory
+        self.waves = [dict(w) for w in waves]
+        self.events = list(events)
+        self.log = deque(maxlen=log_len)
+        self.callback_errors = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def drive(self, pin: int, level: bool) -> None:
+        mock_pin = self.factory.pin(pin)
+        self.log.append((time.monotonic_ns(), pin, level))
+        try:
+            if level:
+                mock_pin.drive_high()
+            else:
+                mock_pin.drive_low()
+        except AttributeError:
+            # a device still being built on the pin, gpiozero sets its callback before it is done
+            self.callback_errors += 1
+
+    def bounce(self, pin: int, level: bool, bounces: int, gap: float) -> None:
+        # after the edge to level, bounces flips away and back
+        for _ in range(bounces):
+            time.sleep(gap)
+            self.drive(pin, not level)
+            time.sleep(gap)
+            self.drive(pin, level)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='pin-script', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        t0 = time.monotonic()
+        # (due seconds from t0, seq, pin, level, wave or None)
+        heap = []
+        seq = 0
+        for at, pin, level in self.events:
+            heap.append((at, seq, pin, level, None))
+            seq += 1
+        for w in self.waves:
+            heap.append((w.get('phase', 0.0), seq, w['pin'], True, w))
+            seq += 1
+        heapq.heapify(heap)
+        while heap and not self._stop.is_set():
+            at, _, pin, level, w = heapq.heappop(heap)
+            if self._stop.wait(max(0.0, t0 + at - time.monotonic())):
+                break
+            self.drive(pin, level)
+            if w is not None:
+                self.bounce(pin, level, w.get('bounces', 0), w.get('bounce_gap', 0.002))
+                high = w['period'] * w.get('duty', 0.5)
+                nxt = at + (high if level else w['period'] - high)
+                heapq.heappush(heap, (nxt, seq, pin, not level, w))
+                seq += 1
+
+
+# -- in-process MQTT broker stand-in
+def topic_matches(sub: str, topic: str) -> bool:
+    s_parts = sub.split('/')
+    t_parts = topic.split('/')
+    for i, s in enumerate(s_parts):
+        if s == '#':
+            return True
+        if i >= len(t_parts) or (s != '+' and s != t_parts[i]):
+            return False
+    return len(s_parts) == len(t_parts)
+
+
+def encode_remaining_length(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n % 128
+        n //= 128
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+def mqtt_string(s) -> bytes:
+    b = s.encode() if isinstance(s, str) else s
+    return struct.pack('!H', len(b)) + b
+
+
+def decode_varint(buf: bytes, pos: int) -> tuple:
+    # MQTT variable byte integer at pos, (value, position after it)
+    value, mult = 0, 1
+    while True:
+        b = buf[pos]
+        pos += 1
+        value += (b & 0x7f) * mult
+        mult *= 128
+        if not b & 0x80:
+            return value, pos
+
+
+# MQTT v5 property ids by value type, for reading PUBLISH properties
+PROP_BYTE = {0x01}
+PROP_U16 = {0x23}
+PROP_U32 = {0x02}
+PROP_VARINT = {0x0b}
+PROP_STR = {0x03, 0x08}
+PROP_BIN = {0x09}
+PROP_PAIR = {0x26}
+
+
+def decode_properties(buf: bytes, pos: int) -> tuple:
+    # MQTT v5 properties at pos, ({id: value}, position after them). User properties are skipped.
+    length, pos = decode_varint(buf, pos)
+    end = pos + length
+    props = {}
+    while pos < end:
+        pid = buf[pos]
+        pos += 1
+        if pid in PROP_BYTE:
+            props[pid] = buf[pos]
+            pos += 1
+        elif pid in PROP_U16:
+            props[pid] = struct.unpack_from('!H', buf, pos)[0]
+            pos += 2
+        elif pid in PROP_U32:
+            props[pid] = struct.unpack_from('!I', buf, pos)[0]
+            pos += 4
+        elif pid in PROP_VARINT:
+            props[pid], pos = decode_varint(buf, pos)
+        elif pid in PROP_STR or pid in PROP_BIN:
+            n = struct.unpack_from('!H', buf, pos)[0]
+            props[pid] = buf[pos + 2:pos + 2 + n]
+            pos += 2 + n
+        elif pid in PROP_PAIR:
+            for _ in range(2):
+                pos += 2 + struct.unpack_from('!H', buf, pos)[0]
+        else:
+            # not allowed in a PUBLISH, so not expected, skip the rest
+            pos = end
+    return props, end
+
+
+class SimBroker:
+    # Just enough MQTT 3.1.1 and 5 for paho: CONNECT, PUBLISH (qos 0, 1, 2), SUBSCRIBE,
+    # UNSUBSCRIBE, PINGREQ and DISCONNECT, retained messages, and forwarding at qos 0 to
+    # subscribers. Every PUBLISH received is kept in received as (time.monotonic_ns(), topic,
+    # payload, qos, retain) and bytes_in counts the PUBLISH packet bytes. v5 clients are offered
+    # topic_alias_max topic aliases in the CONNACK. The message expiry of the last PUBLISH of each
+    # topic that had one is kept in expiry, otherwise v5 properties are read and ignored.
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, keep: int = 100000,
+                 topic_alias_max: int = 10) -> None:
+        self.topic_alias_max = topic_alias_max
+        self.expiry = {}
+        self.received = deque(maxlen=keep)
+        self.retained = {}
+        self.bytes_in = 0
+        self.publishes_in = 0
+        self._subs = []  # (filter, handler)
+        self._cond = threading.Condition()
+        broker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def setup(handler):
+                handler.wlock = threading.Lock()
+                handler.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                handler.v5 = False
+                # alias -> topic, this connection's topic aliases
+                handler.aliases = {}
+
+            def send(handler, data: bytes):
+                with handler.wlock:
+                    handler.request.sendall(data)
+
+            def read_exact(handler, n: int) -> bytes:
+                buf = b''
+                while len(buf) < n:
+                    chunk = handler.request.recv(n - len(buf))
+                    if not chunk:
+                        raise ConnectionError
+                    buf += chunk
+                return buf
+
+            def handle(handler):
+                try:
+                    while True:
+                        first = handler.read_exact(1)[0]
+                        length, mult, n_len = 0, 1, 0
+                        while True:
+                            b = handler.read_exact(1)[0]
+                            n_len += 1
+                            length += (b & 0x7f) * mult
+                            mult *= 128
+                            if not b & 0x80:
+                                break
+                        body = handler.read_exact(length) if length else b''
+                        if not broker.packet(handler, first, body, 1 + n_len + length):
+                            break
+                except (ConnectionError, OSError):
+                    pass
+                finally:
+                    with broker._cond:
+                        broker._subs = [s for s in broker._subs if s[1] is not handler]
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate=False)
+        self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        self.server.server_bind()
+        self.server.server_activate()
+        self.host, self.port = self.server.server_address[:2]
+
+    def start(self) -> None:
+        threading.Thread(target=self.server.serve_forever, name='sim-broker', daemon=True).start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def packet(self, handler, first: int, body: bytes, size: int) -> bool:
+        ptype = first >> 4
+        if ptype == 1:  # CONNECT
+            # protocol name, then the protocol level, 4 for 3.1.1 and 5 for 5
+            handler.v5 = body[2 + struct.unpack_from('!H', body)[0]] == 5
+            if handler.v5:
+                props = b'\x22' + struct.pack('!H', self.topic_alias_max)
+                handler.send(b'\x20' + encode_remaining_length(3 + len(props)) + b'\x00\x00'
+                             + encode_remaining_length(len(props)) + props)
+            else:
+                handler.send(b'\x20\x02\x00\x00')
+        elif ptype == 3:  # PUBLISH
+            qos = (first >> 1) & 3
+            retain = bool(first & 1)
+            t_len = struct.unpack_from('!H', body)[0]
+            topic = body[2:2 + t_len].decode()
+            pos = 2 + t_len
+            pid = None
+            if qos:
+                pid = body[pos:pos + 2]
+                pos += 2
+            if handler.v5:
+                props, pos = decode_properties(body, pos)
+                alias = props.get(0x23)
+                if alias is not None:
+                    if topic:
+                        handler.aliases[alias] = topic
+                    else:
+                        topic = handler.aliases[alias]
+                if 0x02 in props:
+                    self.expiry[topic] = props[0x02]
+            payload = body[pos:]
+            self.deliver(topic, payload, qos, retain, size)
+            if qos == 1:
+                handler.send(b'\x40\x02' + pid)
+            elif qos == 2:
+                handler.send(b'\x50\x02' + pid)
+        elif ptype == 6:  # PUBREL
+            handler.send(b'\x70\x02' + body[:2])
+        elif ptype == 8:  # SUBSCRIBE
+            pid = body[:2]
+            pos = 2
+            if handler.v5:
+                _, pos = decode_properties(body, pos)
+            granted = bytearray()
+            subs = []
+            while pos < len(body):
+                f_len = struct.unpack_from('!H', body, pos)[0]
+                sub = body[pos + 2:pos + 2 + f_len].decode()
+                pos += 2 + f_len + 1
+                subs.append(sub)
+                granted.append(0)
+            with self._cond:
+                self._subs.extend((sub, handler) for sub in subs)
+                retained = [(t, p) for t, p in self.retained.items() if any(topic_matches(s, t) for s in subs)]
+            if handler.v5:
+                handler.send(b'\x90' + encode_remaining_length(3 + len(granted)) + pid + b'\x00' + bytes(granted))
+            else:
+                handler.send(b'\x90' + encode_remaining_length(2 + len(granted)) + pid + bytes(granted))
+            for topic, payload in retained:
+                self.forward(handler, topic, payload, retain=True)
+        elif ptype == 10:  # UNSUBSCRIBE
+            if handler.v5:
+                _, pos = decode_properties(body, 2)
+                n = 0
+                while pos < len(body):
+                    pos += 2 + struct.unpack_from('!H', body, pos)[0]
+                    n += 1
+                handler.send(b'\xb0' + encode_remaining_length(3 + n) + body[:2] + b'\x00' + bytes(n))
+            else:
+                handler.send(b'\xb0\x02' + body[:2])
+        elif ptype == 12:  # PINGREQ
+            handler.send(b'\xd0\x00')
+        elif ptype == 14:  # DISCONNECT
+            return False
+        return True
+
+    def forward(self, handler, topic: str, payload: bytes, retain: bool = False) -> None:
+        # v5 with an empty property list
+        body = mqtt_string(topic) + (b'\x00' if handler.v5 else b'') + payload
+        try:
+            handler.send(bytes([0x30 | int(retain)]) + encode_remaining_length(len(body)) + body)
+        except OSError:
+            pass
+
+    def deliver(self, topic: str, payload: bytes, qos: int, retain: bool, size: int) -> None:
+        with self._cond:
+            self.received.append((time.monotonic_ns(), topic, payload, qos, retain))
+            self.bytes_in += size
+            self.publishes_in += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            targets = [h for s, h in self._subs if topic_matches(s, topic)]
+            self._cond.notify_all()
+        for handler in targets:
+            self.forward(handler, topic, payload)
+
+    def inject(self, topic: str, payload) -> None:
+        # Publishes to the subscribers as if another client had, ie a command to the monitor.
+        self.deliver(topic, payload.encode() if isinstance(payload, str) else payload, 0, False, 0)
+
+    def wait_for(self, predicate, timeout: float = 5.0) -> bool:
+        # Waits until predicate(received) is true.
+        with self._cond:
+            return self._cond.wait_for(lambda: predicate(self.received), timeout)
+
+
+# -- putting it together
+def sim_config(cfg: dict, sysfs: FakeSysfs, broker: SimBroker) -> dict:
+    # Points a monitor config at the simulation: the SimBroker, the fake sysfs files and the fake
+    # WiFi backend. The spool and discovery state go in the temp dir too, not next to the program.
+    cfg['mqtt']['broker'] = broker.host
+    cfg['mqtt']['port'] = broker.port
+    cfg['publish']['spool_dir'] = os.path.join(sysfs.root, 'spool')
+    cfg['discovery']['state_file'] = os.path.join(sysfs.root, 'discovery_state.json')
+    cfg['history']['file'] = os.path.join(sysfs.root, 'history.ts')
+    for spec in cfg['sensors']:
+        if spec['type'] == 'ds18x20':
+            spec['w1_base_dir'] = sysfs.w1_base_dir
+            spec['modprobe'] = False
+        elif spec['type'] == 'cpu':
+            spec['sensor_file'] = sysfs.thermal_file
+        elif spec['type'] in ('wifi', 'ip'):
+            spec['backend'] = 'fake'
+    return cfg
+
+
+class Simulation:
+    # Everything the monitor needs to run off a Pi, built from the config's simulate section. With
+    # pins False there is no mock pin factory or script, ie in fleet mode where each group makes
+    # its own.
+
+    def __init__(self, cfg: dict, pins: bool = True) -> None:
+        sim_cfg = cfg.get('simulate') or {}
+        self.factory = None
+        self.script = None
+        if pins:
+            ldr_pins = [s['pin'] for s in cfg['sensors'] if s['type'] == 'ldr']
+            self.factory = mock_factory(charging_pins=ldr_pins, charge_time=sim_cfg.get('ldr_charge_time', 0.004))
+            self.script = PinScript(self.factory, waves=sim_cfg.get('waves', ()), events=sim_cfg.get('events', ()))
+        self.sysfs = FakeSysfs()
+        self.broker = SimBroker(port=sim_cfg.get('broker_port', 0))
+        sim_config(cfg, self.sysfs, self.broker)
+
+    def start(self) -> None:
+        self.broker.start()
+        self.sysfs.start()
+        if self.script is not None:
+            self.script.start()
+
+    def stop(self) -> None:
+        if self.script is not None:
+            self.script.stop()
+        self.broker.stop()
+        self.sysfs.close()